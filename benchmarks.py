@@ -0,0 +1,257 @@
+"""Benchmarks of the recommender pipeline on synthetic data sets
+
+Each stage of the pipeline (load_review_graph, get_similar_users, recommend_restaurants, get_average_review
+and get_distance) is timed on its own, on a data set made by synthetic_data.generate_dataset. The graphs
+keep the candidate restaurants of each preference profile once a request computed them, so
+recommend_restaurants is timed twice: cold, with those forgotten before every request, which is the cost of
+scoring, and warm, with every profile already computed, which is the cost of a cache hit. Results are plain
+dictionaries that can be saved as JSON baselines, and later runs can be compared against a baseline to catch
+performance regressions.
+
+The time to import the modules a scoring process needs is also checked against a budget, since short-lived
+workers pay it on every start.
+"""
+from __future__ import annotations
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from itertools import product
+from typing import Any, Callable, Optional, Sequence
+import numpy as np
+from computation_compiling import get_distance, load_review_graph
+from geospatial import load_fsa_table
+from recommender_data import User, WeightedGraph
+from synthetic_data import USER_VALUES, dataset_paths, generate_dataset
+
+# The version of the results format. Baselines saved with another version are not compared.
+RESULTS_VERSION = 1
+
+STAGES = ('load_review_graph', 'get_similar_users', 'recommend_restaurants_cold', 'recommend_restaurants_warm',
+          'get_average_review', 'get_distance')
+
+# The percentiles of the latencies reported for each stage.
+PERCENTILES = (50, 90, 99)
+
+# The most seconds each module used for scoring may take to import in a new process.
+IMPORT_BUDGETS = {'recommender_data': 0.5, 'csr_graph': 0.5, 'computation_compiling': 0.5, 'result_cache': 0.5}
+
+# The modules only needed for visualization, which the modules in IMPORT_BUDGETS must not import.
+VISUALIZATION_MODULES = ('networkx', 'plotly', 'pandas')
+
+
+def run_benchmarks(num_edges: int, directory: str, queries: int = 200, loads: int = 3,
+                   graph_type: type = WeightedGraph, limit: int = 10, seed: int = 0) -> dict[str, Any]:
+    """Return the results of timing every stage of the pipeline on a synthetic data set with num_edges
+    reviews.
+
+    The data set is kept in a subdirectory of directory named after num_edges and seed, and is only
+    generated if it is not already there. The graph is loaded loads times, and every other stage is timed
+    on queries random requests. recommend_restaurants_cold clears the graph's computed profiles before each
+    request, and recommend_restaurants_warm runs every request once before the timed ones. Every stage is
+    then run once more to measure its peak memory use, which is not included in its times.
+
+    Preconditions:
+    - num_edges >= 1
+    - queries >= 1
+    - loads >= 1
+    - limit >= 1
+    """
+    data_directory = os.path.join(directory, f'{num_edges}_edges_seed_{seed}')
+    paths = dataset_paths(data_directory)
+    if not os.path.exists(paths['rating']):
+        generate_dataset(data_directory, num_edges, seed)
+    rng = np.random.default_rng(seed)
+
+    def load() -> list[Any]:
+        with open(paths['rating']) as rating_file, open(paths['user']) as user_data, open(
+                paths['restaurant']) as restaurant_data, open(paths['cuisine']) as restaurant_cuisine:
+            return load_review_graph(rating_file, user_data, restaurant_data, restaurant_cuisine, graph_type)
+
+    stages = {'load_review_graph': measure(load, [()] * loads, items_per_call=num_edges)}
+    graph, users, restaurants = load()
+    with open(paths['geospatial']) as geospatial_coordinates:
+        fsa_table = load_fsa_table(geospatial_coordinates)
+
+    profiles = list(product(*USER_VALUES))
+    program_users = [User('U0', *profiles[i]) for i in rng.integers(0, len(profiles), queries)]
+    fsas = [fsa_table.fsas[i] for i in rng.integers(0, len(fsa_table.fsas), queries)]
+    restaurant_list = graph.get_all_items('restaurant')
+    sample = [restaurant_list[i] for i in rng.integers(0, len(restaurant_list), queries)]
+    distances = {fsa: get_distance(fsa, fsa_table, restaurants) for fsa in set(fsas)}
+
+    stages['get_similar_users'] = measure(graph.get_similar_users, [(user,) for user in program_users])
+
+    def recommend_cold(*arguments: Any) -> dict:
+        graph.clear_recommendations()
+        return graph.recommend_restaurants(*arguments)
+
+    requests = [(user, limit, users, distances[fsa]) for user, fsa in zip(program_users, fsas)]
+    stages['recommend_restaurants_cold'] = measure(recommend_cold, requests)
+    for arguments in requests:
+        graph.recommend_restaurants(*arguments)
+    stages['recommend_restaurants_warm'] = measure(graph.recommend_restaurants, requests)
+    stages['get_average_review'] = measure(graph.get_average_review, [(restaurant,) for restaurant in sample])
+    stages['get_distance'] = measure(get_distance, [(fsa, fsa_table, restaurants) for fsa in fsas])
+
+    return {'num_edges': num_edges, 'graph_type': graph_type.__name__, 'queries': queries, 'loads': loads,
+            'num_users': len(users), 'num_restaurants': len(restaurants), 'stages': stages}
+
+
+def measure(function: Callable, calls: Sequence[tuple], items_per_call: int = 1,
+            memory: bool = True) -> dict[str, float]:
+    """Return the timings of calling function with each tuple of arguments in calls, in order.
+
+    The result has the number of calls, their total time in seconds, the throughput in items per second,
+    the latency percentiles and maximum in milliseconds, and (if memory is True) the peak memory in bytes
+    allocated by one more call with the first arguments.
+
+    Preconditions:
+    - len(calls) >= 1
+    - items_per_call >= 1
+    """
+    latencies = []
+    for arguments in calls:
+        start = time.perf_counter()
+        function(*arguments)
+        latencies.append(time.perf_counter() - start)
+
+    latencies = np.array(latencies)
+    total = float(latencies.sum())
+    result = {'calls': len(calls), 'total_seconds': total,
+              'throughput': len(calls) * items_per_call / total if total > 0 else float('inf')}
+    for percentile, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+        result[f'p{percentile}_ms'] = float(value) * 1000
+    result['max_ms'] = float(latencies.max()) * 1000
+
+    if memory:
+        tracemalloc.start()
+        try:
+            function(*calls[0])
+            result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return result
+
+
+def measure_import(module: str, repeats: int = 3) -> tuple[float, list[str]]:
+    """Return the shortest time, in seconds, that importing module took in a new Python process out of
+    repeats tries, together with the VISUALIZATION_MODULES it imported.
+
+    Preconditions:
+    - repeats >= 1
+    """
+    code = ('import sys, time\n'
+            'start = time.perf_counter()\n'
+            f'import {module}\n'
+            'print(time.perf_counter() - start)\n'
+            f'print(*[name for name in {VISUALIZATION_MODULES!r} if name in sys.modules])')
+    times = []
+    imported = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split('\n')
+        times.append(float(output[0]))
+        imported = output[1].split()
+    return (min(times), imported)
+
+
+def check_import_budgets(budgets: Optional[dict[str, float]] = None) -> list[str]:
+    """Return a description of every module in budgets (by default IMPORT_BUDGETS) that takes longer than
+    its budget to import, or imports a visualization module.
+    """
+    problems = []
+    for module, budget in (budgets or IMPORT_BUDGETS).items():
+        seconds, imported = measure_import(module)
+        if seconds > budget:
+            problems.append(f'importing {module} took {seconds * 1000:.0f} ms, over its budget of '
+                            f'{budget * 1000:.0f} ms')
+        if imported:
+            problems.append(f'importing {module} imported {", ".join(imported)}')
+    return problems
+
+
+def save_results(runs: list[dict[str, Any]], path: str) -> None:
+    """Save the results of the given runs as a JSON baseline at path, with a description of this machine."""
+    baseline = {'version': RESULTS_VERSION, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                'processor': platform.processor(), 'cpus': os.cpu_count(), 'runs': runs}
+    with open(path, 'w') as file:
+        json.dump(baseline, file, indent=2)
+
+
+def load_results(path: str) -> list[dict[str, Any]]:
+    """Return the runs of the JSON baseline at path.
+
+    Raise a ValueError if path holds results of another version.
+    """
+    with open(path) as file:
+        baseline = json.load(file)
+    if baseline.get('version') != RESULTS_VERSION:
+        raise ValueError
+    return baseline['runs']
+
+
+def compare_results(runs: list[dict[str, Any]], baseline: list[dict[str, Any]],
+                    tolerance: float = 0.25) -> list[str]:
+    """Return a description of every regression of runs against baseline.
+
+    Runs are compared to the baseline run with the same number of edges and graph type, if any. A stage has
+    regressed if its median latency or peak memory grew, or its throughput fell, by more than tolerance (a
+    fraction of the baseline).
+
+    Preconditions:
+    - tolerance >= 0
+    """
+    baseline_runs = {(run['num_edges'], run['graph_type']): run for run in baseline}
+    regressions = []
+    for run in runs:
+        base = baseline_runs.get((run['num_edges'], run['graph_type']))
+        if base is None:
+            continue
+        for stage, result in run['stages'].items():
+            if stage not in base['stages']:
+                continue
+            old = base['stages'][stage]
+            for metric, higher_is_worse in [('p50_ms', True), ('peak_memory_bytes', True), ('throughput', False)]:
+                if metric not in result or metric not in old or old[metric] == 0:
+                    continue
+                change = result[metric] / old[metric] - 1
+                if (change if higher_is_worse else -change / (1 + change)) > tolerance:
+                    regressions.append(f"{run['graph_type']} {run['num_edges']} edges, {stage}: {metric} "
+                                       f"{old[metric]:.4g} -> {result[metric]:.4g} ({change:+.0%})")
+    return regressions
+
+
+def format_results(runs: list[dict[str, Any]]) -> str:
+    """Return a table of the throughput, latencies and peak memory of every stage of every run."""
+    header = ['edges', 'graph', 'stage', 'calls', 'items/s'] + [f'p{p} ms' for p in PERCENTILES] + ['max ms', 'peak MB']
+    rows = [header]
+    for run in runs:
+        for stage in STAGES:
+            if stage not in run['stages']:
+                continue
+            result = run['stages'][stage]
+            rows.append([str(run['num_edges']), run['graph_type'], stage, str(result['calls']),
+                         f"{result['throughput']:.4g}"]
+                        + [f"{result[f'p{p}_ms']:.3f}" for p in PERCENTILES] + [f"{result['max_ms']:.3f}"]
+                        + [f"{result.get('peak_memory_bytes', 0) / 2 ** 20:.2f}"])
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return '\n'.join('  '.join(value.ljust(width) for value, width in zip(row, widths)) for row in rows)
+
+
+if __name__ == '__main__':
+    import python_ta
+
+    python_ta.check_all(config={
+        'extra-imports': ['json', 'os', 'platform', 'subprocess', 'sys', 'time', 'tracemalloc', 'numpy',
+                          'computation_compiling', 'geospatial', 'recommender_data', 'synthetic_data'],
+        'allowed-io': ['run_benchmarks', 'save_results', 'load_results'],
+        'max-line-length': 120,
+        'max-nested-blocks': 4,
+        'disable': ['E1136', 'W0221']})
@@ -0,0 +1,469 @@
+"""A collaborative filtering engine that ranks restaurants by predicted rating
+
+The profile-matching engine of WeightedGraph.recommend_restaurants only uses ratings as a filter: it lists the
+restaurants rated at least 4 by the most similar users, in the order it finds them. This engine instead puts
+every rating into a sparse user x restaurant matrix and predicts how the program user would rate each
+restaurant, using the users with the closest preferences as the program user's ratings:
+
+    - 'item' mode (item-item): a restaurant is predicted from the ratings of the restaurants most similar to
+      it, where two restaurants are similar if the same users rate them alike
+    - 'user' mode (user-user): a restaurant is predicted from the ratings of the users whose ratings are most
+      like the program user's
+
+The neighbour lists and similarities are computed by refresh, either when it is called or on a background
+thread started by refresh_in_background. Requests never wait for them once they exist: they are answered from
+the last matrices built, even if the graph has changed since, until new ones replace them all at once.
+Predictions for a preference profile are then a few sparse matrix products, computed once per profile for
+each set of matrices, and precompute computes all 162 profiles in batches.
+
+This refreshing and serving is shared with random_walk.PersonalizedPageRank through MatrixRecommender, which
+has the same recommend_restaurants method and version attribute as the graphs, so either engine can be passed
+to recommend_restaurants_batch, CachedRecommender or RecommendationService.
+"""
+from __future__ import annotations
+import threading
+from typing import Any, Collection, Iterable, Optional
+import numpy as np
+from scipy import sparse
+from recommender_data import CuisineIndex, User, profile_users
+
+# The number of users with the closest preferences whose ratings stand for the program user's, when
+# recommend_restaurants is not given max_users.
+SEED_USERS = 20
+
+# The number of profiles predicted by one batch of matrix products. In user mode a batch needs a dense
+# row of weights per profile for every user, so this also bounds that memory.
+PROFILE_BATCH_SIZE = 16
+
+
+class MatrixRecommender:
+    """An engine that ranks restaurants for preference profiles from matrices built from a review graph.
+
+    This holds the refreshing and serving that CollaborativeRecommender and random_walk.PersonalizedPageRank
+    share. The matrices are built by refresh, or on a background thread by refresh_in_background, and
+    requests are answered from the last ones built until new ones replace them all at once. The ranking of
+    each preference profile is kept with the matrices it was computed from, unless it was cut short.
+
+    Subclasses build their matrices in _build_matrices and rank profiles in _rank_profiles.
+
+    Instance Attributes:
+        - graph: the WeightedGraph or CSRWeightedGraph the ratings come from
+    """
+    graph: Any
+
+    # Private Instance Attributes:
+    #     - _matrices:
+    #         The matrices requests are answered from, or None if they have not been built yet.
+    #     - _refreshing:
+    #         The thread started by the last call to refresh_in_background, or None if there was none.
+    #     - _profile_batch_size:
+    #         The number of profiles precompute ranks at once.
+    _matrices: Optional[RecommenderMatrices]
+    _refreshing: Optional[threading.Thread]
+    _profile_batch_size: int
+
+    def __init__(self, graph: Any, profile_batch_size: int) -> None:
+        """Initialize a new engine for graph, with no matrices yet.
+
+        Preconditions:
+        - profile_batch_size >= 1
+        """
+        self.graph = graph
+        self._matrices = None
+        self._refreshing = None
+        self._profile_batch_size = profile_batch_size
+
+    @property
+    def version(self) -> int:
+        """The version of the graph the matrices were built from, which changes whenever new matrices replace
+        them, or the graph's version if they have not been built yet.
+        """
+        return self.graph.version if self._matrices is None else self._matrices.version
+
+    def refresh(self) -> None:
+        """Rebuild the matrices from the graph, and answer later requests from them.
+
+        The graph must not change while this runs.
+        """
+        self._refresh_from(self.graph.version, *self.graph.to_columns())
+
+    def refresh_in_background(self) -> Optional[threading.Thread]:
+        """Start refreshing this engine on a new thread, and return that thread, unless the matrices are
+        already built from the graph's version or the last refresh started by this method is still running.
+        Return None if no thread is started.
+
+        The graph is read before this returns, so it may change afterwards: only the matrices are built on
+        the new thread. Requests are answered from the previous matrices until then.
+        """
+        if (self._refreshing is not None and self._refreshing.is_alive()) or (
+                self._matrices is not None and self._matrices.version == self.graph.version):
+            return None
+        self._refreshing = threading.Thread(target=self._refresh_from,
+                                            args=(self.graph.version, *self.graph.to_columns()), daemon=True)
+        self._refreshing.start()
+        return self._refreshing
+
+    def precompute(self, max_users: Optional[int] = None) -> None:
+        """Rank the restaurants of every preference profile with the current matrices, in batches, using
+        max_users seed users for each (or SEED_USERS if max_users is None).
+        """
+        matrices = self._get_matrices()
+        users = profile_users()
+        for start in range(0, len(users), self._profile_batch_size):
+            self._rank(matrices, users[start:start + self._profile_batch_size], max_users)
+
+    def recommend_restaurants(self, program_user: User, limit: int, all_users: dict, distances: dict,
+                              max_users: Optional[int] = None, max_distance: Optional[float] = None,
+                              include_cuisines: Optional[Collection[str]] = None,
+                              exclude_cuisines: Optional[Collection[str]] = None) -> (
+            dict[str, tuple[float, float, tuple[str, ...]]]):
+        """Return the limit restaurants ranked highest by this engine for program_user, best first, in the same
+        form as WeightedGraph.recommend_restaurants.
+
+        The ranking starts from the max_users users most similar to program_user (or SEED_USERS if max_users is
+        None). If max_distance is not None, only restaurants in distances at most max_distance kilometres away
+        are recommended. The cuisine filters are the same as those of WeightedGraph.recommend_restaurants, and
+        are applied to the ranking before any restaurant is looked up. all_users is not used.
+
+        The ranking comes from the last matrices built by refresh, which are only built here if they never
+        were.
+
+        Preconditions:
+        - distances != {}
+        - limit >= 1
+        - max_users is None or max_users >= 0
+        - max_distance is None or max_distance >= 0
+        """
+        matrices = self._get_matrices()
+        order = self._rank(matrices, [program_user], max_users)[0]
+        if include_cuisines is not None or exclude_cuisines is not None:
+            order = order[matrices.cuisine_index.mask(include_cuisines, exclude_cuisines)[order]]
+        return ranked_recommendations(self.graph, (matrices.restaurant_ids[column] for column in order),
+                                      limit, distances, max_distance)
+
+    def _get_matrices(self) -> RecommenderMatrices:
+        """Return the matrices to answer requests from, building them first if they never were."""
+        if self._matrices is None:
+            self.refresh()
+        return self._matrices
+
+    def _refresh_from(self, version: int, arrays: dict[str, np.ndarray], strings: dict[str, Any]) -> None:
+        """Build new matrices from the to_columns arrays and string tables of the given version of the graph,
+        and then replace the current ones with them.
+        """
+        matrices = self._build_matrices(version, arrays, strings)
+        matrices.cuisine_index = CuisineIndex.from_columns(
+            np.asarray(arrays['cuisine_codes']), np.asarray(arrays['cuisine_offsets']), list(strings['cuisines']))
+        self._matrices = matrices
+
+    def _rank(self, matrices: RecommenderMatrices, program_users: list[User], max_users: Optional[int]) -> (
+            list[np.ndarray]):
+        """Return, for each user in program_users, the restaurant columns of matrices in ranked order, best first,
+        ranking the profiles not already known for matrices in one batch.
+
+        Only complete rankings are kept in matrices.rankings; one cut short is only returned.
+        """
+        num_seeds = SEED_USERS if max_users is None else max_users
+        keys = [(tuple(user.preference_lst()), num_seeds) for user in program_users]
+        missing = {key: user for key, user in zip(keys, program_users) if key not in matrices.rankings}
+        rankings = {}
+        if missing:
+            for key, (order, complete) in zip(missing, self._rank_profiles(matrices, list(missing.values()),
+                                                                           num_seeds)):
+                rankings[key] = order
+                if complete:
+                    matrices.rankings[key] = order
+
+        return [rankings[key] if key in rankings else matrices.rankings[key] for key in keys]
+
+    def _seed_rows(self, matrices: RecommenderMatrices, program_user: User, num_seeds: int) -> list[int]:
+        """Return the rows in matrices of the num_seeds users most similar to program_user.
+
+        Similar users added to the graph after matrices were built are left out.
+        """
+        return [matrices.user_rows[user_id] for user_id in self.graph.get_similar_users(program_user, num_seeds)
+                if user_id in matrices.user_rows]
+
+    def _build_matrices(self, version: int, arrays: dict[str, np.ndarray], strings: dict[str, Any]) -> (
+            RecommenderMatrices):
+        """Return the matrices of this engine for the to_columns arrays and string tables of the given version
+        of the graph, without their cuisine index.
+        """
+        raise NotImplementedError
+
+    def _rank_profiles(self, matrices: RecommenderMatrices, program_users: list[User], num_seeds: int) -> (
+            list[tuple[np.ndarray, bool]]):
+        """Return, for each user in program_users, the restaurant columns of matrices in ranked order, best first,
+        starting from its num_seeds most similar users, and whether that ranking is complete.
+        """
+        raise NotImplementedError
+
+
+class RecommenderMatrices:
+    """The matrices a MatrixRecommender answers requests from, built from one version of its graph.
+
+    Instance Attributes:
+        - version: the version of the graph the matrices were built from
+        - user_rows: maps each user_id to its row in the matrices
+        - restaurant_ids: the restaurant_id of each column in the matrices
+        - cuisine_index: the restaurants serving each cuisine, by column
+        - rankings: maps each (preference_lst tuple, number of seed users) to the restaurant columns in ranked
+          order, best first
+    """
+    __slots__ = ('version', 'user_rows', 'restaurant_ids', 'cuisine_index', 'rankings')
+    version: int
+    user_rows: dict[str, int]
+    restaurant_ids: list[str]
+    cuisine_index: CuisineIndex
+    rankings: dict[tuple[tuple[int, ...], int], np.ndarray]
+
+    def __init__(self, version: int, user_ids: list[str], restaurant_ids: list[str]) -> None:
+        """Initialize new matrices of the given users and restaurants, with no rankings yet."""
+        self.version = version
+        self.user_rows = {user_id: i for i, user_id in enumerate(user_ids)}
+        self.restaurant_ids = restaurant_ids
+        self.cuisine_index = CuisineIndex()
+        self.rankings = {}
+
+
+class CollaborativeRecommender(MatrixRecommender):
+    """Recommendations ranked by ratings predicted with item-item or user-user collaborative filtering.
+
+    The ratings of the users most similar to the program user stand for the program user's own, and
+    restaurants are ranked from the highest predicted rating to the lowest.
+
+    Instance Attributes:
+        - graph: the WeightedGraph or CSRWeightedGraph the ratings come from
+        - mode: 'item' or 'user', as described in the module
+        - neighbours: the number of most similar restaurants (or users) each prediction is made from
+        - shrinkage: similarities from few common ratings are scaled down by
+          common / (common + shrinkage), so they are not trusted as much
+
+    Representation Invariants:
+        - self.mode in {'item', 'user'}
+        - self.neighbours >= 1
+        - self.shrinkage >= 0
+    """
+    mode: str
+    neighbours: int
+    shrinkage: float
+
+    def __init__(self, graph: Any, mode: str = 'item', neighbours: int = 50, shrinkage: float = 10.0) -> None:
+        """Initialize a new engine for graph. Nothing is computed until it is first needed, or refresh is called.
+
+        Preconditions:
+        - mode in {'item', 'user'}
+        - neighbours >= 1
+        - shrinkage >= 0
+        """
+        super().__init__(graph, PROFILE_BATCH_SIZE)
+        self.mode = mode
+        self.neighbours = neighbours
+        self.shrinkage = shrinkage
+
+    def _build_matrices(self, version: int, arrays: dict[str, np.ndarray], strings: dict[str, Any]) -> _Matrices:
+        """Return the rating matrices and neighbour lists of the to_columns arrays and string tables of the
+        given version of the graph.
+        """
+        num_users, num_restaurants = len(strings['user_ids']), len(strings['restaurant_ids'])
+        offsets = np.asarray(arrays['user_offsets'], dtype=np.int64)
+        columns = np.asarray(arrays['user_neighbours'], dtype=np.int64)
+        ratings = np.asarray(arrays['user_ratings'], dtype=np.float64)
+        counts = np.diff(offsets)
+        means = np.divide(np.add.reduceat(ratings, offsets[:-1]) if len(ratings) > 0 else np.zeros(num_users),
+                          counts, out=np.zeros(num_users), where=counts > 0)
+        shape = (num_users, num_restaurants)
+        matrices = _Matrices(version, list(strings['user_ids']), list(strings['restaurant_ids']),
+                             sparse.csr_matrix((ratings, columns, offsets), shape=shape),
+                             sparse.csr_matrix((ratings - np.repeat(means, counts), columns, offsets), shape=shape),
+                             sparse.csr_matrix((np.ones(len(ratings)), columns, offsets), shape=shape))
+
+        if self.mode == 'item':
+            matrices.similar = self._item_neighbours(matrices)
+        else:
+            matrices.user_norms = np.sqrt(np.asarray(matrices.centred.multiply(matrices.centred).sum(axis=1)).ravel())
+        return matrices
+
+    def _rank_profiles(self, matrices: _Matrices, program_users: list[User], num_seeds: int) -> (
+            list[tuple[np.ndarray, bool]]):
+        """Return, for each user in program_users, the restaurant columns with a predicted rating ordered from
+        the highest predicted rating to the lowest, predicted in one batch. Every prediction is complete.
+        """
+        seeds, known_mask, known = self._seed_ratings(matrices, program_users, num_seeds)
+        if self.mode == 'item':
+            deviations = self._item_deviations(matrices, seeds, known_mask)
+        else:
+            deviations = self._user_deviations(matrices, seeds)
+
+        # A restaurant rated by the seed users keeps their average rating, and every other restaurant is
+        # predicted as the seed users' average rating plus its predicted deviation.
+        seed_means = np.divide(known.sum(axis=1), known_mask.sum(axis=1), out=np.zeros(len(program_users)),
+                               where=known_mask.sum(axis=1) > 0)
+        scores = np.where(known_mask > 0, known, seed_means[:, None] + deviations)
+        rankings = []
+        for row in scores:
+            order = np.argsort(-row, kind='stable')
+            rankings.append((order[~np.isnan(row[order])], True))
+        return rankings
+
+    def _seed_ratings(self, matrices: _Matrices, program_users: list[User], num_seeds: int) -> (
+            tuple[sparse.csr_matrix, np.ndarray, np.ndarray]):
+        """Return, for each user in program_users, the centred ratings of its num_seeds most similar users
+        averaged into one row, together with dense matrices of which restaurants they rated and their average
+        rating of each.
+
+        Similar users added to the graph after matrices were built are left out.
+        """
+        selector_rows, selector_columns, selector_values = [], [], []
+        for i, user in enumerate(program_users):
+            rows = self._seed_rows(matrices, user, num_seeds)
+            selector_rows.extend([i] * len(rows))
+            selector_columns.extend(rows)
+            selector_values.extend([1.0] * len(rows))
+        selector = sparse.csr_matrix((selector_values, (selector_rows, selector_columns)),
+                                     shape=(len(program_users), len(matrices.user_rows)))
+
+        # The sums over the seed users of their centred ratings, ratings and number of ratings.
+        centred_sums = selector @ matrices.centred
+        rating_sums = (selector @ matrices.ratings).toarray()
+        rating_counts = (selector @ matrices.rated).toarray()
+        seeds = centred_sums.multiply(1 / np.maximum(rating_counts, 1)).tocsr()
+        known = np.divide(rating_sums, rating_counts, out=np.zeros_like(rating_sums), where=rating_counts > 0)
+        return (seeds, (rating_counts > 0).astype(np.float64), known)
+
+    def _item_neighbours(self, matrices: _Matrices) -> sparse.csr_matrix:
+        """Return the matrix whose row i holds the similarities of the neighbours restaurants most similar to
+        restaurant i in matrices, by adjusted cosine similarity shrunk towards 0 when few users rated both.
+        """
+        num_restaurants = len(matrices.restaurant_ids)
+        common = (matrices.rated.T @ matrices.rated).tocsr()
+        common.sort_indices()
+        products = (matrices.centred.T @ matrices.centred).tocsr()
+        products.sort_indices()
+        norms = np.sqrt(np.maximum(products.diagonal(), 0))
+
+        # Every pair of restaurants with a product was rated by a common user, so the products can be lined
+        # up with the common counts by their (row, column) keys.
+        rows = np.repeat(np.arange(num_restaurants), np.diff(common.indptr))
+        keys = rows * num_restaurants + common.indices
+        product_keys = np.repeat(np.arange(num_restaurants), np.diff(products.indptr)) * num_restaurants \
+            + products.indices
+        dot_products = np.zeros(len(keys))
+        dot_products[np.searchsorted(keys, product_keys)] = products.data
+
+        denominators = norms[rows] * norms[common.indices]
+        similarities = np.divide(dot_products, denominators, out=np.zeros(len(keys)), where=denominators > 0)
+        similarities *= common.data / (common.data + self.shrinkage)
+        similarities[rows == common.indices] = 0
+
+        # Keep the neighbours most similar restaurants of each row.
+        keep = np.zeros(len(similarities), dtype=bool)
+        for i in range(num_restaurants):
+            start, end = common.indptr[i], common.indptr[i + 1]
+            if end - start <= self.neighbours:
+                keep[start:end] = True
+            else:
+                keep[start + np.argpartition(-similarities[start:end], self.neighbours)[:self.neighbours]] = True
+        keep &= similarities > 0
+        return sparse.csr_matrix((similarities[keep], (rows[keep], common.indices[keep])),
+                                 shape=(num_restaurants, num_restaurants))
+
+    @staticmethod
+    def _item_deviations(matrices: _Matrices, seeds: sparse.csr_matrix, known_mask: np.ndarray) -> np.ndarray:
+        """Return the predicted deviation from the mean of each restaurant for each row of seeds, from the
+        restaurants most similar to it in matrices that the seed users rated, or NaN if there are none.
+        """
+        numerators = (seeds @ matrices.similar.T).toarray()
+        denominators = (matrices.similar @ known_mask.T).T
+        return np.divide(numerators, denominators, out=np.full_like(numerators, np.nan), where=denominators > 0)
+
+    def _user_deviations(self, matrices: _Matrices, seeds: sparse.csr_matrix) -> np.ndarray:
+        """Return the predicted deviation from the mean of each restaurant for each row of seeds, from the
+        users of matrices whose ratings are most like it, or NaN if none of them rated the restaurant.
+        """
+        weights = (seeds @ matrices.centred.T).toarray()
+        seed_norms = np.sqrt(np.asarray(seeds.multiply(seeds).sum(axis=1)).ravel())
+        denominators = seed_norms[:, None] * matrices.user_norms[None, :]
+        weights = np.divide(weights, denominators, out=np.zeros_like(weights), where=denominators > 0)
+
+        # Keep the neighbours users with the most similar ratings for each row.
+        if weights.shape[1] > self.neighbours:
+            cutoff = np.partition(weights, -self.neighbours, axis=1)[:, -self.neighbours][:, None]
+            weights[weights < cutoff] = 0
+        weights[weights < 0] = 0
+
+        weights = sparse.csr_matrix(weights)
+        numerators = (weights @ matrices.centred).toarray()
+        denominators = (weights @ matrices.rated).toarray()
+        return np.divide(numerators, denominators, out=np.full_like(numerators, np.nan), where=denominators > 0)
+
+
+class _Matrices(RecommenderMatrices):
+    """The matrices a CollaborativeRecommender answers requests from, built from one version of its graph.
+
+    Instance Attributes:
+        - version: the version of the graph the matrices were built from
+        - user_rows: maps each user_id to its row in the matrices
+        - restaurant_ids: the restaurant_id of each column in the matrices
+        - ratings: the users x restaurants matrix of ratings
+        - centred: the same matrix, with the mean rating of each user subtracted from their ratings
+        - rated: the users x restaurants matrix with a 1 for every rating
+        - similar: in item mode, the restaurants x restaurants matrix whose row i holds the similarities of
+          the neighbours most similar restaurants to restaurant i
+        - user_norms: in user mode, the length of each row of centred
+        - cuisine_index: the restaurants serving each cuisine, by column
+        - rankings: maps each (preference_lst tuple, number of seed users) to the restaurant columns
+          ordered by predicted rating, best first
+    """
+    __slots__ = ('ratings', 'centred', 'rated', 'similar', 'user_norms')
+    ratings: sparse.csr_matrix
+    centred: sparse.csr_matrix
+    rated: sparse.csr_matrix
+    similar: Optional[sparse.csr_matrix]
+    user_norms: Optional[np.ndarray]
+
+    def __init__(self, version: int, user_ids: list[str], restaurant_ids: list[str], ratings: sparse.csr_matrix,
+                 centred: sparse.csr_matrix, rated: sparse.csr_matrix) -> None:
+        """Initialize new matrices with the given ratings, and no similarities or rankings yet."""
+        super().__init__(version, user_ids, restaurant_ids)
+        self.ratings = ratings
+        self.centred = centred
+        self.rated = rated
+        self.similar = None
+        self.user_norms = None
+
+
+def ranked_recommendations(graph: Any, restaurant_ids: Iterable[str], limit: int, distances: dict,
+                           max_distance: Optional[float] = None) -> dict[str, tuple[float, float, tuple[str, ...]]]:
+    """Return the first limit restaurants of graph in restaurant_ids, best first, in the same form as
+    WeightedGraph.recommend_restaurants.
+
+    Restaurants are skipped if a restaurant with the same name came before them, if they are not in
+    distances, or if max_distance is not None and they are more than max_distance kilometres away.
+
+    Preconditions:
+    - limit >= 1
+    """
+    dict_so_far = {}
+    for restaurant_id in restaurant_ids:
+        restaurant = graph.get_restaurant(restaurant_id)
+        name = restaurant.name
+        if name in dict_so_far or name not in distances or (
+                max_distance is not None and distances[name] > max_distance):
+            continue
+        dict_so_far[name] = (graph.get_average_review(restaurant), distances[name], restaurant.cuisine)
+        if len(dict_so_far) == limit:
+            break
+
+    return dict_so_far
+
+
+if __name__ == '__main__':
+    import python_ta
+
+    python_ta.check_all(config={
+        'extra-imports': ['threading', 'numpy', 'scipy', 'recommender_data'],  # the names (strs) of imported modules
+        'allowed-io': [],  # the names (strs) of functions that call print/open/input
+        'max-line-length': 120,
+        'max-nested-blocks': 4,
+        'disable': ['E1136', 'W0221']})
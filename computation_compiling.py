@@ -1,71 +1,310 @@
 """Computing the distance and getting the user answers on their prefrences"""
-import math
-from typing import Any, TextIO
+from typing import Any, Iterable, Iterator, Optional, TextIO, Union
 import csv
-from math import acos, sin, cos, radians
-from recommender_data import Restaurant, WeightedGraph, User
+import time
+import numpy as np
+import instrumentation
+from graph_snapshot import snapshot_is_current
+from geospatial import FSATable, PostalGeocoder, SpatialIndex, load_fsa_table, load_geocoder
+from recommender_data import Restaurant, WeightedGraph, User, intern_cuisines
 
 
-def load_review_graph(rating_file: TextIO, user_data: TextIO, restaurant_data: TextIO, restaurant_cuisine: TextIO) -> (
-        list)[Any]:
-    """Return a graph of users' restaurants reviews"""
+def load_review_graph(rating_file: TextIO, user_data: TextIO, restaurant_data: TextIO, restaurant_cuisine: TextIO,
+                      graph_type: type = WeightedGraph) -> list[Any]:
+    """Return a graph of users' restaurants reviews
+
+    graph_type is the graph class to build, WeightedGraph or CSRWeightedGraph for large data sets.
+    """
+
+    with instrumentation.stage('load_review_graph'):
+        review_graph = graph_type()
+        with instrumentation.stage('load_review_graph.cuisines'):
+            all_cuisines = add_cuisine(restaurant_cuisine)
+
+        user_dictionary = {}
+        with instrumentation.stage('load_review_graph.users'):
+            for user in read_users(user_data):
+                user_dictionary[user.user_id] = user
+
+        restaurant_dictionary = {}
+        with instrumentation.stage('load_review_graph.restaurants'):
+            reader2 = csv.reader(restaurant_data)
+            for row2 in reader2:
+                restaurant = Restaurant(row2[0], row2[1], row2[2])
+                restaurant_dictionary[row2[0]] = restaurant
+                if row2[0] in all_cuisines:
+                    restaurant.cuisine = all_cuisines[restaurant.restaurant_id]
+
+        reader = csv.reader(rating_file)
+        edges = []
+        with instrumentation.stage('load_review_graph.ratings'):
+            for row in reader:
+                user = user_dictionary[row[0]]
+                restaurant = restaurant_dictionary[row[1]]
+                review_graph.add_vertex(user, 'user')
+                review_graph.add_vertex(restaurant, 'restaurant')
+                edges.append((user, restaurant, int(row[2])))
+        instrumentation.count('ratings_read', len(edges))
+
+        with instrumentation.stage('load_review_graph.edges'):
+            review_graph.add_edges(edges)
+
+    return [review_graph, user_dictionary, restaurant_dictionary]
+
+
+def load_review_graph_streaming(rating_file: TextIO, user_data: TextIO, restaurant_data: TextIO,
+                                restaurant_cuisine: TextIO, graph_type: type = WeightedGraph,
+                                chunk_size: int = 100000) -> list[Any]:
+    """Return the same [graph, users, restaurants] list as load_review_graph, followed by a list of problems,
+    while keeping memory use in proportion to the graph rather than to the csv files.
+
+    The rating file is read twice in chunks of chunk_size rows: first to find the users and restaurants
+    that are reviewed, then to add the reviews. Only those users and restaurants (and their cuisines) are
+    kept from the other files, which are read one row at a time.
+
+    Malformed rows and reviews of unknown users or restaurants are skipped, and each one is reported in
+    the list of problems as (file, line number, reason), where file is 'ratings', 'users', 'restaurants'
+    or 'cuisines'.
+
+    Preconditions:
+    - rating_file is seekable
+    - chunk_size >= 1
+    """
+    problems = []
+    start = rating_file.tell()
+    reviewed_users, reviewed_restaurants = set(), set()
+    for _, user_ids, restaurant_ids, _ in read_rating_chunks(rating_file, chunk_size, problems):
+        reviewed_users.update(user_ids)
+        reviewed_restaurants.update(restaurant_ids)
 
-    review_graph = WeightedGraph()
-    all_cuisines = add_cuisine(restaurant_cuisine)
     user_dictionary = {}
-    reader1 = csv.reader(user_data)
-    for row1 in reader1:
-        user_dictionary[row1[0]] = User(row1[0], row1[1], row1[2], row1[3], row1[4], row1[5])
+    for line_number, row in enumerate(csv.reader(user_data), 1):
+        if len(row) != 6:
+            problems.append(('users', line_number, 'expected 6 columns'))
+        elif row[0] in reviewed_users:
+            user_dictionary[row[0]] = User(row[0], row[1], row[2], row[3], row[4], row[5])
+
+    cuisines = {}
+    for line_number, row in enumerate(csv.reader(restaurant_cuisine), 1):
+        if len(row) != 2:
+            problems.append(('cuisines', line_number, 'expected 2 columns'))
+        elif row[0] in reviewed_restaurants:
+            cuisines.setdefault(row[0], []).append(row[1])
 
     restaurant_dictionary = {}
-    reader2 = csv.reader(restaurant_data)
-    for row2 in reader2:
-        restaurant = Restaurant(row2[0], row2[1], row2[2])
-        restaurant_dictionary[row2[0]] = restaurant
-        if row2[0] in all_cuisines:
-            restaurant.cuisine = all_cuisines[restaurant.restaurant_id]
-
-    reader = csv.reader(rating_file)
-    for row in reader:
-        if row[0] not in review_graph.get_all_vertices('user'):
-            review_graph.add_vertex(user_dictionary[row[0]], 'user')
+    for line_number, row in enumerate(csv.reader(restaurant_data), 1):
+        if len(row) != 3:
+            problems.append(('restaurants', line_number, 'expected 3 columns'))
+        elif row[0] in reviewed_restaurants:
+            restaurant = Restaurant(row[0], row[1], row[2])
+            restaurant.cuisine = intern_cuisines(cuisines.get(row[0], ()))
+            restaurant_dictionary[row[0]] = restaurant
+
+    review_graph = graph_type()
+    rating_file.seek(start)
+    for line_numbers, user_ids, restaurant_ids, ratings in read_rating_chunks(rating_file, chunk_size):
+        edges = []
+        for line_number, user_id, restaurant_id, rating in zip(line_numbers, user_ids, restaurant_ids,
+                                                               ratings.tolist()):
+            if user_id not in user_dictionary:
+                problems.append(('ratings', line_number, 'unknown user ' + user_id))
+            elif restaurant_id not in restaurant_dictionary:
+                problems.append(('ratings', line_number, 'unknown restaurant ' + restaurant_id))
+            else:
+                user, restaurant = user_dictionary[user_id], restaurant_dictionary[restaurant_id]
+                review_graph.add_vertex(user, 'user')
+                review_graph.add_vertex(restaurant, 'restaurant')
+                edges.append((user, restaurant, rating))
+        review_graph.add_edges(edges)
+
+    return [review_graph, user_dictionary, restaurant_dictionary, problems]
+
+
+def read_rating_chunks(rating_file: TextIO, chunk_size: int = 100000, problems: Optional[list] = None) -> (
+        Iterator[tuple[list[int], list[str], list[str], np.ndarray]]):
+    """Yield the rows of rating_file in chunks of up to chunk_size rows, as (line numbers, user_ids,
+    restaurant_ids, ratings), with the ratings decoded into an int32 array.
+
+    Rows that do not have 3 columns or an integer rating are skipped, and reported in problems (if it is
+    not None) as ('ratings', line number, reason).
+
+    Preconditions:
+    - chunk_size >= 1
+    """
+    line_numbers, user_ids, restaurant_ids, ratings = [], [], [], []
+    for line_number, row in enumerate(csv.reader(rating_file), 1):
+        if len(row) != 3:
+            _report(problems, ('ratings', line_number, 'expected 3 columns'))
+        elif not row[2].strip().lstrip('-').isdigit():
+            _report(problems, ('ratings', line_number, 'rating is not an integer'))
+        else:
+            line_numbers.append(line_number)
+            user_ids.append(row[0])
+            restaurant_ids.append(row[1])
+            ratings.append(int(row[2]))
+            if len(line_numbers) == chunk_size:
+                yield (line_numbers, user_ids, restaurant_ids, np.array(ratings, dtype=np.int32))
+                line_numbers, user_ids, restaurant_ids, ratings = [], [], [], []
+
+    if line_numbers:
+        yield (line_numbers, user_ids, restaurant_ids, np.array(ratings, dtype=np.int32))
+
 
-        if row[1] not in review_graph.get_all_vertices('restaurant'):
-            review_graph.add_vertex(restaurant_dictionary[row[1]], 'restaurant')
+def _report(problems: Optional[list], problem: tuple[str, int, str]) -> None:
+    """Append problem to problems, unless problems is None."""
+    if problems is not None:
+        problems.append(problem)
 
-        review_graph.add_edge(user_dictionary[row[0]], restaurant_dictionary[row[1]], int(row[2]))
 
+def load_review_graph_cached(snapshot_path: str, rating_path: str, user_path: str, restaurant_path: str,
+                             cuisine_path: str, graph_type: type = WeightedGraph) -> list[Any]:
+    """Return the same [graph, users, restaurants] list as load_review_graph for the csv files at the given
+    paths, reading it from the snapshot in the directory snapshot_path when none of the files have changed.
+
+    Otherwise, the csv files are loaded and a new snapshot is saved at snapshot_path.
+    The returned users and restaurants only include the ones that appear in the graph.
+    """
+    sources = [rating_path, user_path, restaurant_path, cuisine_path]
+    if snapshot_is_current(snapshot_path, sources):
+        review_graph = graph_type.load_snapshot(snapshot_path)
+    else:
+        with open(rating_path) as rating_file, open(user_path) as user_data, open(
+                restaurant_path) as restaurant_data, open(cuisine_path) as restaurant_cuisine:
+            review_graph = load_review_graph(rating_file, user_data, restaurant_data, restaurant_cuisine,
+                                             graph_type)[0]
+        review_graph.save_snapshot(snapshot_path, sources)
+
+    user_dictionary = {user.user_id: user for user in review_graph.get_all_items('user')}
+    restaurant_dictionary = {restaurant.restaurant_id: restaurant
+                             for restaurant in review_graph.get_all_items('restaurant')}
     return [review_graph, user_dictionary, restaurant_dictionary]
 
 
-def get_distance(user_postal_code: str, geospatial_coordinates: TextIO, restaurants: dict) -> dict[str, str]:
-    """Return the distance (in kilometeres) between the user and the restaurant.
+def follow_ratings(review_graph: Any, rating_file: TextIO, user_dictionary: dict, restaurant_dictionary: dict,
+                   poll_interval: float = 1.0, problems: Optional[list] = None) -> Iterator[int]:
+    """Apply the rows appended to rating_file to review_graph as the file grows, and yield the number of
+    rows applied after each read of the file.
+
+    Reading starts at the current position of rating_file, so passing the file that the graph was loaded
+    from only applies the rows added after loading. Each row is user_id,restaurant_id,rating, and a row with
+    an empty rating deletes that review. Users and restaurants reviewed for the first time are added to the
+    graph from user_dictionary and restaurant_dictionary. When there are no new rows, this waits
+    poll_interval seconds before reading again, so stop iterating to stop following the file.
+
+    Rows that do not have 2 or 3 columns or an integer (or empty) rating, and rows of users or restaurants
+    that are not in the dictionaries, are skipped without stopping the feed. Each one is reported in
+    problems (if it is not None) as ('ratings', line number, reason), counting the lines from where
+    reading started.
+
+    Preconditions:
+    - poll_interval >= 0
+    """
+    partial_line, line_count = '', 0
+    while True:
+        lines = (partial_line + rating_file.read()).split('\n')
+        # The last line is kept until it is complete.
+        partial_line = lines.pop()
+        ratings = []
+        for line_number, row in ((number, next(csv.reader([line])))
+                                 for number, line in enumerate(lines, line_count + 1) if line.strip() != ''):
+            if len(row) not in (2, 3):
+                _report(problems, ('ratings', line_number, 'expected 2 or 3 columns'))
+            elif len(row) == 3 and row[2] != '' and not row[2].strip().lstrip('-').isdigit():
+                _report(problems, ('ratings', line_number, 'rating is not an integer'))
+            elif row[0] not in user_dictionary:
+                _report(problems, ('ratings', line_number, 'unknown user ' + row[0]))
+            elif row[1] not in restaurant_dictionary:
+                _report(problems, ('ratings', line_number, 'unknown restaurant ' + row[1]))
+            else:
+                review_graph.add_vertex(user_dictionary[row[0]], 'user')
+                review_graph.add_vertex(restaurant_dictionary[row[1]], 'restaurant')
+                ratings.append((row[0], row[1], int(row[2]) if len(row) > 2 and row[2] != '' else None))
+        line_count += len(lines)
+
+        review_graph.apply_ratings(ratings)
+        yield len(ratings)
+        if not ratings:
+            time.sleep(poll_interval)
+
+
+def get_distance(user_postal_code: str, geospatial_coordinates: Union[TextIO, FSATable, PostalGeocoder],
+                 restaurants: dict) -> dict[str, float]:
+    """Return the distance (in kilometeres) between the user and each restaurant, rounded to 2 decimals.
+
+    geospatial_coordinates is either the csv file of FSA coordinates, an FSATable already loaded from it,
+    or a PostalGeocoder. Pass the FSATable when calling this function more than once, so the file is only
+    read once. With a PostalGeocoder, the user's and the restaurants' postal codes are located at their
+    longest prefix in it, so they can be full postal codes from any region it covers.
 
     Preconditions:
-    - user_postal_code in geospatial_coordinates
+    - user_postal_code[:3] in geospatial_coordinates, or user_postal_code in it if it is a PostalGeocoder
     - restaurants != {}
     """
+    with instrumentation.stage('get_distance'):
+        if not isinstance(geospatial_coordinates, (FSATable, PostalGeocoder)):
+            geospatial_coordinates = load_fsa_table(geospatial_coordinates)
+
+        restaurant_list = list(restaurants.values())
+        distances = geospatial_coordinates.distances_from(_location_code(user_postal_code, geospatial_coordinates),
+                                                          [restaurant.postal_code for restaurant in restaurant_list])
+        instrumentation.count('distances_computed', len(restaurant_list))
+
+        return {restaurant.name: round(float(distance), 2)
+                for restaurant, distance in zip(restaurant_list, distances)}
+
+
+def build_restaurant_index(fsa_table: Union[FSATable, PostalGeocoder], restaurants: dict) -> SpatialIndex:
+    """Return a spatial index of the given restaurants, located by their postal codes in fsa_table, an
+    FSATable or a PostalGeocoder.
+
+    Preconditions:
+    - all(restaurant.postal_code in fsa_table for restaurant in restaurants.values())
+    """
+    return SpatialIndex((restaurant, *fsa_table.coordinates(restaurant.postal_code))
+                        for restaurant in restaurants.values())
+
+
+def get_nearby_distances(user_postal_code: str, fsa_table: Union[FSATable, PostalGeocoder],
+                         restaurant_index: SpatialIndex, max_distance: float) -> dict[str, float]:
+    """Return the distance (in kilometeres) between the user and each restaurant at most max_distance
+    kilometres away, rounded to 2 decimals.
+
+    Unlike get_distance, only the restaurants near the user are looked at.
+
+    Preconditions:
+    - user_postal_code[:3] in fsa_table, or user_postal_code in it if it is a PostalGeocoder
+    - max_distance >= 0
+    """
+    latitude, longitude = fsa_table.coordinates(_location_code(user_postal_code, fsa_table))
+    nearby = restaurant_index.within(latitude, longitude, max_distance)
+    return {restaurant.name: round(distance, 2) for restaurant, distance in nearby.items()}
 
-    val = {}
-    dict_geospatial = {}
-    reader = csv.reader(geospatial_coordinates)
-    for row in reader:
-        dict_geospatial[row[0]] = (float(row[1]), float(row[2]))
 
-    user_latitude, user_longitude = dict_geospatial[user_postal_code[:3]]
-    for restaurant in restaurants:
-        restaurant_latitude, restaurant_longitude = dict_geospatial[restaurants[restaurant].postal_code]
-        distance = acos(
-            (sin(radians(user_latitude)) * sin(radians(restaurant_latitude))
-             + (cos(radians(user_latitude)) * cos(radians(restaurant_latitude))
-                * cos(radians(restaurant_longitude - user_longitude))))) * 6371
-        val[restaurants[restaurant].name] = f'{round(distance, 2)} km'
+def load_geocoder_cached(geocoder_path: str, coordinates_path: str) -> PostalGeocoder:
+    """Return the geocoder of the csv file of postal_code,latitude,longitude rows at coordinates_path,
+    reading it from the directory geocoder_path when the file has not changed.
 
-    return val
+    Otherwise, the file is loaded and the geocoder is saved at geocoder_path. Either way, the returned
+    geocoder is memory-mapped from geocoder_path.
+    """
+    if snapshot_is_current(geocoder_path, [coordinates_path]):
+        return PostalGeocoder.load(geocoder_path)
+    with open(coordinates_path) as postal_coordinates:
+        return load_geocoder(postal_coordinates, geocoder_path, [coordinates_path])
 
 
-def add_cuisine(restaurant_cuisine: TextIO) -> dict[str, list[str]]:
-    """Returns a dictionary with a list of cuisines for each restaurant."""
+def _location_code(user_postal_code: str, table: Union[FSATable, PostalGeocoder]) -> str:
+    """Return the code to look user_postal_code up by in table: its FSA in an FSATable, and the whole code in
+    a PostalGeocoder.
+    """
+    return user_postal_code if isinstance(table, PostalGeocoder) else user_postal_code[:3]
+
+
+def add_cuisine(restaurant_cuisine: TextIO) -> dict[str, tuple[str, ...]]:
+    """Returns a dictionary with a tuple of cuisines for each restaurant.
+
+    Restaurants serving the same cuisines share the same tuple (see intern_cuisines).
+    """
 
     cuisines = {}
     reader = csv.reader(restaurant_cuisine)
@@ -75,7 +314,40 @@ def add_cuisine(restaurant_cuisine: TextIO) -> dict[str, list[str]]:
         else:
             cuisines[row[0]].append(row[1])
 
-    return cuisines
+    return {restaurant_id: intern_cuisines(cuisine_list) for restaurant_id, cuisine_list in cuisines.items()}
+
+
+def read_users(user_data: TextIO) -> Iterator[User]:
+    """Yield the users in the given user profile csv file, one row at a time."""
+    reader = csv.reader(user_data)
+    for row in reader:
+        yield User(row[0], row[1], row[2], row[3], row[4], row[5])
+
+
+def recommend_restaurants_batch(review_graph: Any, users: Iterable[User], limit: int, distances: dict,
+                                max_users: Optional[int] = None, max_distance: Optional[float] = None) -> (
+        Iterator[tuple[str, dict[str, tuple[float, float, tuple[str, ...]]]]]):
+    """Yield (user_id, recommended restaurants) for each user in users, in order.
+
+    review_graph is a WeightedGraph or CSRWeightedGraph, and the recommendations are the ones its
+    recommend_restaurants method gives with the other arguments. Recommendations only depend on the
+    preference_lst of the user, so they are computed once for each of the (at most 162) different
+    preference_lsts, however many users there are. users may be a stream, such as read_users(user_data).
+
+    Preconditions:
+    - distances != {}
+    - limit >= 1
+    - max_users is None or max_users >= 0
+    - max_distance is None or max_distance >= 0
+    """
+    recommendations_by_preferences = {}
+    for user in users:
+        preferences = tuple(user.preference_lst())
+        if preferences not in recommendations_by_preferences:
+            recommendations_by_preferences[preferences] = review_graph.recommend_restaurants(
+                user, limit, {}, distances, max_users, max_distance)
+
+        yield (user.user_id, dict(recommendations_by_preferences[preferences]))
 
 
 def get_user_answer(questions: list[str]) -> User:
@@ -104,8 +376,11 @@ if __name__ == '__main__':
     import python_ta
 
     python_ta.check_all(config={
-        'extra-imports': ['TextIO', 'csv', 'math', 'recommender_data'],  # the names (strs) of imported modules
-        'allowed-io': ["get_user_answer"],  # the names (strs) of functions that call print/open/input
+        # the names (strs) of imported modules
+        'extra-imports': ['TextIO', 'csv', 'time', 'numpy', 'instrumentation', 'geospatial', 'graph_snapshot',
+                          'recommender_data'],
+        # the names (strs) of functions that call print/open/input
+        'allowed-io': ["get_user_answer", "load_review_graph_cached", "follow_ratings"],
         'max-line-length': 120,
         'max-nested-blocks': 4,
         'disable': ['E1136', 'W0221']})
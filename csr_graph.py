@@ -0,0 +1,688 @@
+"""An array-backed review graph for large data sets"""
+
+from __future__ import annotations
+from typing import Any, Collection, Iterable, Iterator, Optional, Union
+import numpy as np
+import instrumentation
+from graph_snapshot import intern_strings, read_snapshot, write_snapshot
+from recommender_data import RANKING_BLOCK_SIZE, USER_ATTRIBUTES, CuisineIndex, RecommendationTable, Restaurant, User, \
+    intern_cuisines, similarity_keys, top_ranked
+
+# The least number of edges the overlay of changed users may hold before it is merged into the edge arrays.
+# Larger graphs wait until the overlay holds an eighth of their edges, so each merge, which takes time in
+# proportion to the size of the graph, is paid for by as many changes.
+DELTA_MERGE_SIZE = 65536
+
+
+class CSRWeightedGraph:
+    """A weighted user review graph that stores its edges in compressed sparse row (CSR) arrays.
+
+    This graph has the same public methods as WeightedGraph and gives the same recommendations, but every
+    user and restaurant is an integer position, and edges are stored in NumPy arrays rather than in one
+    dictionary per vertex. It uses a small fraction of the memory of WeightedGraph, which remains the
+    default for small data sets.
+
+    Users and restaurants are identified by their user_id and restaurant_id, and every edge is between a
+    user and a restaurant.
+
+    Edges added or removed after the arrays were built are kept in an overlay holding the current edges of
+    every changed user, which reads consult before the arrays. The overlay is merged into the arrays only
+    once it grows past DELTA_MERGE_SIZE edges (or an eighth of the edges of the graph), or when the arrays
+    are exported by to_columns, so a stream of small changes does not rebuild the arrays each time.
+
+    Instance Attributes:
+        - version: a counter increased every time a vertex or edge is added, as in WeightedGraph
+    """
+    version: int
+
+    # Private Instance Attributes:
+    #     - _users:
+    #         The user at each user position, or None if it has not been built from _columns yet.
+    #     - _restaurants:
+    #         The restaurant at each restaurant position, or None if it has not been built from _columns yet.
+    #     - _user_positions:
+    #         Maps each user_id to its user position. None until it is first needed.
+    #     - _restaurant_positions:
+    #         Maps each restaurant_id to its restaurant position. None until it is first needed.
+    #     - _columns:
+    #         The arrays and string tables of the snapshot this graph was loaded from, if any.
+    #     - _user_offsets, _user_neighbours, _user_ratings:
+    #         The edges of user i are to the restaurants _user_neighbours[_user_offsets[i]:_user_offsets[i + 1]],
+    #         with the matching ratings in _user_ratings, in the order they were added. Users and restaurants
+    #         added since the arrays were built may be past the end of the offsets, and have no edges there.
+    #     - _restaurant_offsets, _restaurant_neighbours, _restaurant_ratings:
+    #         The same edges, grouped by restaurant.
+    #     - _changes:
+    #         The overlay: maps the position of each user whose edges changed since the arrays were built to
+    #         its current edges, from restaurant position to rating, in neighbour order. The arrays' edges of
+    #         these users are out of date.
+    #     - _num_changes:
+    #         The number of edges held by _changes.
+    #     - _review_sums, _review_counts:
+    #         The sum and number of the ratings of each restaurant. None until they are first needed, and then
+    #         kept up to date by every change.
+    #     - _preference_order:
+    #         The user positions sorted by user_id. None until it is first needed.
+    #     - _preference_matrix:
+    #         Row i is the preference_lst of the user at position _preference_order[i].
+    #     - _cuisine_index:
+    #         The restaurants serving each cuisine, by restaurant position. None until it is first needed.
+    #     - _recommendations:
+    #         The candidate restaurants of each preference profile, by restaurant position.
+    _users: list[Optional[User]]
+    _restaurants: list[Optional[Restaurant]]
+    _user_positions: Optional[dict[str, int]]
+    _restaurant_positions: Optional[dict[str, int]]
+    _columns: Optional[tuple[dict[str, np.ndarray], dict[str, Any]]]
+    _user_offsets: np.ndarray
+    _user_neighbours: np.ndarray
+    _user_ratings: np.ndarray
+    _restaurant_offsets: np.ndarray
+    _restaurant_neighbours: np.ndarray
+    _restaurant_ratings: np.ndarray
+    _changes: dict[int, dict[int, Union[int, float]]]
+    _num_changes: int
+    _review_sums: Optional[np.ndarray]
+    _review_counts: Optional[np.ndarray]
+    _preference_order: Optional[np.ndarray]
+    _preference_matrix: Optional[np.ndarray]
+    _cuisine_index: Optional[CuisineIndex]
+    _recommendations: RecommendationTable
+
+    def __init__(self) -> None:
+        """Initialize an empty graph (no vertices or edges)."""
+        self.version = 0
+        self._users = []
+        self._restaurants = []
+        self._user_positions = {}
+        self._restaurant_positions = {}
+        self._columns = None
+        self._user_offsets = np.zeros(1, dtype=np.int64)
+        self._user_neighbours = np.zeros(0, dtype=np.int32)
+        self._user_ratings = np.zeros(0, dtype=np.int32)
+        self._restaurant_offsets = np.zeros(1, dtype=np.int64)
+        self._restaurant_neighbours = np.zeros(0, dtype=np.int32)
+        self._restaurant_ratings = np.zeros(0, dtype=np.int32)
+        self._changes = {}
+        self._num_changes = 0
+        self._review_sums = None
+        self._review_counts = None
+        self._preference_order = None
+        self._preference_matrix = None
+        self._cuisine_index = CuisineIndex()
+        self._recommendations = RecommendationTable(
+            self._iter_similar_users, lambda position: (self._user_id(position),
+                                                        tuple(self._user(position).preference_lst())),
+            self._rated_restaurants)
+
+    def add_vertex(self, item: Any, kind: str) -> None:
+        """Add a vertex with the given item and kind to this graph.
+
+        The new vertex is not adjacent to any other vertices.
+        Do nothing if the given item is already in this graph.
+
+        Preconditions:
+            - kind in {'user', 'restaurant'}
+        """
+        if kind == 'user':
+            positions = self._get_user_positions()
+            if item.user_id not in positions:
+                positions[item.user_id] = len(self._users)
+                self._users.append(item)
+                self._preference_order = None
+                self.version += 1
+                self._recommendations.user_added(item)
+        else:
+            positions = self._get_restaurant_positions()
+            if item.restaurant_id not in positions:
+                positions[item.restaurant_id] = len(self._restaurants)
+                self.get_cuisine_index().add(len(self._restaurants), item.cuisine)
+                self._restaurants.append(item)
+                if self._review_sums is not None:
+                    self._review_sums = np.append(self._review_sums, 0.0)
+                    self._review_counts = np.append(self._review_counts, 0.0)
+                self.version += 1
+
+    def add_edge(self, item1: Any, item2: Any, weight: Union[int, float] = 1) -> None:
+        """Add an edge between the two vertices with the given items in this graph,
+        with the given weight.
+
+        Raise a ValueError if item1 or item2 do not appear as vertices in this graph.
+
+        Preconditions:
+            - one of item1 and item2 is a User, and the other is a Restaurant
+        """
+        user_position, restaurant_position = self._edge_positions(item1, item2)
+        self._change_edge(user_position, restaurant_position, weight)
+        self.version += 1
+        self._recommendations.user_changed(self._user(user_position))
+
+    def add_edges(self, edges: Iterable[tuple[Any, Any, Union[int, float]]]) -> None:
+        """Add every (item1, item2, weight) edge in edges to this graph.
+
+        This is the bulk version of add_edge, for loading many reviews at once.
+
+        Raise a ValueError if an item in edges does not appear as a vertex in this graph.
+        Edges before the invalid one are still added.
+        """
+        for item1, item2, weight in edges:
+            self.add_edge(item1, item2, weight)
+
+    def remove_edge(self, item1: Any, item2: Any) -> None:
+        """Remove the edge between the two vertices with the given items in this graph.
+
+        Do nothing if item1 and item2 are not adjacent.
+        Raise a ValueError if item1 or item2 do not appear as vertices in this graph.
+        """
+        user_position, restaurant_position = self._edge_positions(item1, item2)
+        self._change_edge(user_position, restaurant_position, None)
+        self.version += 1
+        self._recommendations.user_changed(self._user(user_position))
+
+    def apply_ratings(self, ratings: Iterable[tuple[str, str, Optional[Union[int, float]]]]) -> None:
+        """Apply every (user_id, restaurant_id, rating) event in ratings to this graph, in order.
+
+        Ratings are applied as in WeightedGraph.apply_ratings, and a rating of None deletes a review.
+        Each event only updates the overlay of changed users and the rating aggregates; the edge arrays are
+        rebuilt once the overlay is large enough, as described in the class.
+
+        Raise a ValueError if a user_id or restaurant_id does not appear in this graph.
+        Events before the invalid one are still applied.
+        """
+        for user_id, restaurant_id, rating in ratings:
+            user, restaurant = self.get_user(user_id), self.get_restaurant(restaurant_id)
+            if rating is None:
+                self.remove_edge(user, restaurant)
+            else:
+                self.add_edge(user, restaurant, rating)
+
+    def get_weight(self, item1: Any, item2: Any) -> Union[int, float]:
+        """Return the weight of the edge between the given items.
+
+        Return 0 if item1 and item2 are not adjacent.
+
+        Preconditions:
+            - item1 and item2 are vertices in this graph
+        """
+        weight = self._edge_weight(*self._edge_positions(item1, item2))
+        return 0 if weight is None else weight
+
+    def adjacent(self, item1: Any, item2: Any) -> bool:
+        """Return whether item1 and item2 are adjacent vertices in this graph.
+
+        Return False if item1 or item2 do not appear as vertices in this graph.
+        """
+        try:
+            return self._edge_weight(*self._edge_positions(item1, item2)) is not None
+        except ValueError:
+            return False
+
+    def get_neighbours(self, item: Any) -> set:
+        """Return a set of the neighbours of the given item.
+
+        Raise a ValueError if item does not appear as a vertex in this graph.
+        """
+        if isinstance(item, User):
+            position = self._position(self._get_user_positions(), item.user_id)
+            return {self._restaurant(r) for r in self._user_edges(position)[0]}
+        else:
+            position = self._position(self._get_restaurant_positions(), item.restaurant_id)
+            return {self._user(u) for u in self._reviewers(position)}
+
+    def get_user(self, user_id: str) -> User:
+        """Return the user in this graph with the given user_id.
+
+        Raise a ValueError if no such user appears in this graph.
+        """
+        return self._user(self._position(self._get_user_positions(), user_id))
+
+    def get_restaurant(self, restaurant_id: str) -> Restaurant:
+        """Return the restaurant in this graph with the given restaurant_id.
+
+        Raise a ValueError if no such restaurant appears in this graph.
+        """
+        return self._restaurant(self._position(self._get_restaurant_positions(), restaurant_id))
+
+    def get_all_items(self, kind: str) -> list[Any]:
+        """Return the items of every vertex of the given kind in this graph, in the order they were added.
+
+        Preconditions:
+            - kind in {'user', 'restaurant'}
+        """
+        if kind == 'user':
+            return [self._user(i) for i in range(len(self._users))]
+        else:
+            return [self._restaurant(i) for i in range(len(self._restaurants))]
+
+    def get_similar_users(self, program_user: User, limit: Optional[int] = None) -> list[str]:
+        """Return a list of the similar users that match the program user's preferences.
+
+        Users are ranked the same way as in WeightedGraph.get_similar_users.
+
+        Preconditions:
+        - limit is None or limit >= 0
+        """
+        with instrumentation.stage('get_similar_users'):
+            keys = self._similarity_keys(program_user)
+            instrumentation.count('users_ranked', len(keys))
+            return [self._user_id(self._preference_order[i]) for i in top_ranked(keys, limit).tolist()]
+
+    def recommend_restaurants(self, program_user: User, limit: int, all_users: dict, distances: dict,
+                              max_users: Optional[int] = None, max_distance: Optional[float] = None,
+                              include_cuisines: Optional[Collection[str]] = None,
+                              exclude_cuisines: Optional[Collection[str]] = None) -> (
+            dict[str, tuple[float, float, tuple[str, ...]]]):
+        """Return a list of recommended restaurants based on user's preferences
+
+        This takes the same arguments and returns the same restaurants as WeightedGraph.recommend_restaurants.
+
+        Preconditions:
+        - distances != {}
+        - limit >= 1
+        - max_users is None or max_users >= 0
+        - max_distance is None or max_distance >= 0
+        """
+        with instrumentation.stage('recommend_restaurants'):
+            allowed = None
+            if max_distance is not None:
+                allowed = {name for name, distance in distances.items() if distance <= max_distance}
+
+            mask = None
+            if include_cuisines is not None or exclude_cuisines is not None:
+                mask = self.get_cuisine_index().mask(include_cuisines, exclude_cuisines)
+
+            with instrumentation.stage('recommend_restaurants.candidates'):
+                candidates = self._recommendations.candidates(
+                    program_user, limit, max_users, allowed, None if mask is None else mask.__getitem__)
+
+            dict_so_far = {}
+            with instrumentation.stage('recommend_restaurants.averages'):
+                for position in candidates:
+                    restaurant = self._restaurant(position)
+                    dict_so_far[restaurant.name] = (self._average_review(position), distances[restaurant.name],
+                                                    restaurant.cuisine)
+            instrumentation.count('candidates_produced', len(dict_so_far))
+
+        return dict_so_far
+
+    def precompute_recommendations(self, max_users: Optional[int] = None) -> None:
+        """Compute the candidate restaurants of every preference profile ahead of time, as in
+        WeightedGraph.precompute_recommendations.
+        """
+        self._recommendations.precompute(max_users)
+
+    def clear_recommendations(self) -> None:
+        """Forget the candidate restaurants computed for every preference profile, as in
+        WeightedGraph.clear_recommendations.
+        """
+        self._recommendations.clear()
+
+    def get_cuisine_index(self) -> CuisineIndex:
+        """Return the index of the restaurants serving each cuisine, by restaurant position, building it from
+        the snapshot columns if needed.
+        """
+        if self._cuisine_index is None:
+            arrays, strings = self._columns
+            self._cuisine_index = CuisineIndex.from_columns(arrays['cuisine_codes'], arrays['cuisine_offsets'],
+                                                            list(strings['cuisines']))
+        return self._cuisine_index
+
+    def get_average_review(self, restaurant: Restaurant) -> float:
+        """
+        Return the average rating given by users of the restaurant.
+
+        Return 0.0 if no user has reviewed the restaurant.
+
+        Preconditions:
+        - restaurant is a vertex in this graph
+        """
+        return self._average_review(self._position(self._get_restaurant_positions(), restaurant.restaurant_id))
+
+    def get_all_average_reviews(self) -> tuple[list[str], np.ndarray]:
+        """Return the restaurant_ids of every restaurant in this graph, in sorted order, together with
+        an array of their average ratings.
+
+        The i-th average belongs to the i-th restaurant_id, and is 0.0 for a restaurant with no reviews.
+        """
+        sums, counts = self._aggregates()
+        restaurant_ids = [self._restaurant_id(i) for i in range(len(self._restaurants))]
+        order = sorted(range(len(restaurant_ids)), key=lambda i: restaurant_ids[i])
+        averages = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+        return ([restaurant_ids[i] for i in order], np.round(averages[order], 2))
+
+    def save_snapshot(self, path: str, sources: Iterable[str] = ()) -> None:
+        """Save this graph as a binary snapshot in the directory path.
+
+        The snapshot has the same format as WeightedGraph.save_snapshot, so either class can load it.
+        """
+        arrays, strings = self.to_columns()
+        write_snapshot(path, arrays, strings, sources)
+
+    def to_columns(self) -> tuple[dict[str, np.ndarray], dict[str, list[str]]]:
+        """Return the arrays and string tables of a snapshot of this graph, as written by save_snapshot.
+
+        The overlay of changed users is merged into the edge arrays first.
+        """
+        self._merge_changes()
+        users = self.get_all_items('user')
+        restaurants = self.get_all_items('restaurant')
+
+        arrays = {'vertex_kinds': np.repeat(np.array([0, 1], dtype=np.int8), [len(users), len(restaurants)])}
+        strings = {'user_ids': [user.user_id for user in users],
+                   'restaurant_ids': [restaurant.restaurant_id for restaurant in restaurants],
+                   'restaurant_names': [restaurant.name for restaurant in restaurants]}
+
+        for attribute in USER_ATTRIBUTES:
+            strings['user_' + attribute + '_values'], arrays['user_' + attribute] = intern_strings(
+                getattr(user, attribute) for user in users)
+        strings['postal_codes'], arrays['restaurant_postal_codes'] = intern_strings(
+            restaurant.postal_code for restaurant in restaurants)
+        strings['cuisines'], arrays['cuisine_codes'] = intern_strings(
+            cuisine for restaurant in restaurants for cuisine in restaurant.cuisine)
+        arrays['cuisine_offsets'] = np.concatenate(
+            [[0], np.cumsum([len(restaurant.cuisine) for restaurant in restaurants], dtype=np.int64)])
+
+        arrays.update({'user_offsets': self._user_offsets, 'user_neighbours': self._user_neighbours,
+                       'user_ratings': self._user_ratings, 'restaurant_offsets': self._restaurant_offsets,
+                       'restaurant_neighbours': self._restaurant_neighbours,
+                       'restaurant_ratings': self._restaurant_ratings})
+
+        return (arrays, strings)
+
+    @classmethod
+    def load_snapshot(cls, path: str) -> CSRWeightedGraph:
+        """Return the graph saved in the snapshot in the directory path.
+
+        The edge arrays are used straight from the memory-mapped snapshot, and users and restaurants are
+        only built when they are first accessed, so loading takes about the same time at any size.
+
+        Raise a ValueError if path does not hold a complete snapshot.
+        """
+        return cls.from_columns(*read_snapshot(path))
+
+    @classmethod
+    def from_columns(cls, arrays: dict[str, np.ndarray], strings: dict[str, Any]) -> CSRWeightedGraph:
+        """Return the graph with the given snapshot arrays and string tables, using the arrays without
+        copying them.
+
+        strings maps each name to a sequence of strings, such as a StringTable.
+        """
+        graph = cls()
+        graph._columns = (arrays, strings)
+        graph._users = [None] * len(strings['user_ids'])
+        graph._restaurants = [None] * len(strings['restaurant_ids'])
+        graph._user_positions = None
+        graph._restaurant_positions = None
+        graph._cuisine_index = None
+        graph._user_offsets = arrays['user_offsets']
+        graph._user_neighbours = arrays['user_neighbours']
+        graph._user_ratings = arrays['user_ratings']
+        graph._restaurant_offsets = arrays['restaurant_offsets']
+        graph._restaurant_neighbours = arrays['restaurant_neighbours']
+        graph._restaurant_ratings = arrays['restaurant_ratings']
+        return graph
+
+    def _similarity_keys(self, program_user: User) -> np.ndarray:
+        """Return an array where the i-th value is the ranking key of the user at position
+        _preference_order[i].
+        """
+        if self._preference_order is None:
+            user_ids = [self._user_id(i) for i in range(len(self._users))]
+            self._preference_order = np.array(sorted(range(len(user_ids)), key=lambda i: user_ids[i]),
+                                              dtype=np.int64)
+            self._preference_matrix = self._preferences()[self._preference_order]
+
+        return similarity_keys(self._preference_matrix, program_user)
+
+    def _iter_similar_users(self, program_user: User, max_users: Optional[int] = None) -> Iterator[int]:
+        """Yield the positions of the users of get_similar_users(program_user, max_users) in order.
+
+        Users are ranked in growing blocks, so only about as many users as are consumed get sorted.
+        """
+        keys = self._similarity_keys(program_user)
+        order = self._preference_order
+        num_users = len(keys) if max_users is None else min(max_users, len(keys))
+        start = 0
+        block = RANKING_BLOCK_SIZE
+        while start < num_users:
+            end = min(start + block, num_users)
+            yield from order[top_ranked(keys, end)[start:]].tolist()
+            start = end
+            block *= 2
+
+    def _rated_restaurants(self, user_position: int) -> list[tuple[int, str]]:
+        """Return (position, name) for each restaurant rated at least 4 by the user at the given position,
+        in neighbour order.
+        """
+        neighbours, ratings = self._user_edges(user_position)
+        return [(position, self._restaurant_name(position))
+                for position, rating in zip(neighbours, ratings) if rating >= 4]
+
+    def _average_review(self, position: int) -> float:
+        """Return the average rating of the restaurant at the given position, or 0.0 if it has none."""
+        sums, counts = self._aggregates()
+        if counts[position] == 0:
+            return 0.0
+        return round(float(sums[position] / counts[position]), 2)
+
+    def _aggregates(self) -> tuple[np.ndarray, np.ndarray]:
+        """Return arrays of the sum and number of the ratings of every restaurant, by position."""
+        if self._review_sums is None:
+            self._merge_changes()
+            self._review_counts = np.diff(self._restaurant_offsets).astype(np.float64)
+            restaurant_of_edge = np.repeat(np.arange(len(self._restaurants)), np.diff(self._restaurant_offsets))
+            self._review_sums = np.bincount(restaurant_of_edge, weights=self._restaurant_ratings,
+                                            minlength=len(self._restaurants)).astype(np.float64)
+        return (self._review_sums, self._review_counts)
+
+    def _change_edge(self, user_position: int, restaurant_position: int,
+                     weight: Optional[Union[int, float]]) -> None:
+        """Set the weight of the edge between the given user and restaurant in the overlay, removing the edge
+        if weight is None, and merge the overlay into the edge arrays if it has grown too large.
+
+        As in WeightedGraph, an edge that is added again keeps its position and takes the new weight, and an
+        edge that is removed and added again moves to the end of its user's neighbours.
+        """
+        edges = self._changes.get(user_position)
+        if edges is None:
+            edges = dict(zip(*self._user_edges(user_position)))
+            self._changes[user_position] = edges
+            self._num_changes += len(edges)
+
+        size = len(edges)
+        old_weight = edges.pop(restaurant_position, None) if weight is None else edges.get(restaurant_position)
+        if weight is not None:
+            edges[restaurant_position] = weight
+        self._num_changes += len(edges) - size
+
+        if self._review_sums is not None:
+            if old_weight is not None:
+                self._review_sums[restaurant_position] -= old_weight
+                self._review_counts[restaurant_position] -= 1
+            if weight is not None:
+                self._review_sums[restaurant_position] += weight
+                self._review_counts[restaurant_position] += 1
+
+        if self._num_changes > max(DELTA_MERGE_SIZE, len(self._user_neighbours) // 8):
+            self._merge_changes()
+
+    def _merge_changes(self) -> None:
+        """Rebuild the edge arrays to include the overlay of changed users and every vertex added since they
+        were last built, and empty the overlay.
+
+        The edges of the users that did not change keep their order, and each restaurant's edges are ordered
+        by user position.
+        """
+        num_users, num_restaurants = len(self._users), len(self._restaurants)
+        if not self._changes and len(self._user_offsets) == num_users + 1 \
+                and len(self._restaurant_offsets) == num_restaurants + 1:
+            return
+
+        changed = sorted(self._changes)
+        old_users = np.repeat(np.arange(len(self._user_offsets) - 1), np.diff(self._user_offsets))
+        kept = ~np.isin(old_users, changed)
+        new_weights = [weight for user in changed for weight in self._changes[user].values()]
+        dtype = np.result_type(self._user_ratings,
+                               np.int32 if all(isinstance(weight, int) for weight in new_weights) else np.float64)
+
+        users = np.concatenate([old_users[kept], np.repeat(np.array(changed, dtype=np.int64),
+                                                           [len(self._changes[user]) for user in changed])])
+        restaurants = np.concatenate([self._user_neighbours[kept], np.array(
+            [restaurant for user in changed for restaurant in self._changes[user]], dtype=np.int32)])
+        ratings = np.concatenate([self._user_ratings[kept].astype(dtype), np.array(new_weights, dtype=dtype)])
+
+        # Both parts are sorted by user, so this stable sort only merges them.
+        by_user = np.argsort(users, kind='stable')
+        users, restaurants, ratings = users[by_user], restaurants[by_user].astype(np.int32), ratings[by_user]
+        self._user_offsets = _offsets(users, num_users)
+        self._user_neighbours = restaurants
+        self._user_ratings = ratings
+        by_restaurant = np.argsort(restaurants, kind='stable')
+        self._restaurant_offsets = _offsets(restaurants, num_restaurants)
+        self._restaurant_neighbours = users[by_restaurant].astype(np.int32)
+        self._restaurant_ratings = ratings[by_restaurant]
+
+        self._changes = {}
+        self._num_changes = 0
+
+    def _user_edges(self, user_position: int) -> tuple[list[int], list[Union[int, float]]]:
+        """Return the restaurant positions and ratings of the current edges of the given user, in order."""
+        edges = self._changes.get(user_position)
+        if edges is not None:
+            return (list(edges), list(edges.values()))
+        start, end = _edge_range(self._user_offsets, user_position)
+        return (self._user_neighbours[start:end].tolist(), self._user_ratings[start:end].tolist())
+
+    def _reviewers(self, restaurant_position: int) -> list[int]:
+        """Return the positions of the users with a current edge to the given restaurant."""
+        start, end = _edge_range(self._restaurant_offsets, restaurant_position)
+        reviewers = [user for user in self._restaurant_neighbours[start:end].tolist() if user not in self._changes]
+        reviewers.extend(user for user, edges in self._changes.items() if restaurant_position in edges)
+        return reviewers
+
+    def _edge_weight(self, user_position: int, restaurant_position: int) -> Optional[Union[int, float]]:
+        """Return the weight of the edge between the given user and restaurant, or None if they are not
+        adjacent.
+        """
+        edges = self._changes.get(user_position)
+        if edges is not None:
+            return edges.get(restaurant_position)
+        start, end = _edge_range(self._user_offsets, user_position)
+        matches = np.flatnonzero(self._user_neighbours[start:end] == restaurant_position)
+        return self._user_ratings[start + matches[0]].item() if len(matches) > 0 else None
+
+    def _edge_positions(self, item1: Any, item2: Any) -> tuple[int, int]:
+        """Return the user position and restaurant position of the two items of an edge.
+
+        Raise a ValueError if either item does not appear as a vertex in this graph.
+        """
+        user, restaurant = (item1, item2) if isinstance(item1, User) else (item2, item1)
+        if not isinstance(user, User) or not isinstance(restaurant, Restaurant):
+            raise ValueError
+        return (self._position(self._get_user_positions(), user.user_id),
+                self._position(self._get_restaurant_positions(), restaurant.restaurant_id))
+
+    @staticmethod
+    def _position(positions: dict[str, int], item_id: str) -> int:
+        """Return positions[item_id], raising a ValueError if it is missing."""
+        if item_id in positions:
+            return positions[item_id]
+        else:
+            raise ValueError
+
+    def _get_user_positions(self) -> dict[str, int]:
+        """Return the dictionary mapping each user_id to its position, building it if needed."""
+        if self._user_positions is None:
+            self._user_positions = {self._user_id(i): i for i in range(len(self._users))}
+        return self._user_positions
+
+    def _get_restaurant_positions(self) -> dict[str, int]:
+        """Return the dictionary mapping each restaurant_id to its position, building it if needed."""
+        if self._restaurant_positions is None:
+            self._restaurant_positions = {self._restaurant_id(i): i for i in range(len(self._restaurants))}
+        return self._restaurant_positions
+
+    def _user_id(self, position: int) -> str:
+        """Return the user_id of the user at the given position, without building the user."""
+        user = self._users[position]
+        return user.user_id if user is not None else self._columns[1]['user_ids'][position]
+
+    def _restaurant_id(self, position: int) -> str:
+        """Return the restaurant_id of the restaurant at the given position, without building it."""
+        restaurant = self._restaurants[position]
+        return restaurant.restaurant_id if restaurant is not None else self._columns[1]['restaurant_ids'][position]
+
+    def _restaurant_name(self, position: int) -> str:
+        """Return the name of the restaurant at the given position, without building it."""
+        restaurant = self._restaurants[position]
+        return restaurant.name if restaurant is not None else self._columns[1]['restaurant_names'][position]
+
+    def _user(self, position: int) -> User:
+        """Return the user at the given position, building it from the snapshot columns if needed."""
+        if self._users[position] is None:
+            arrays, strings = self._columns
+            preferences = [strings['user_' + attribute + '_values'][int(arrays['user_' + attribute][position])]
+                           for attribute in USER_ATTRIBUTES]
+            self._users[position] = User(strings['user_ids'][position], *preferences)
+        return self._users[position]
+
+    def _restaurant(self, position: int) -> Restaurant:
+        """Return the restaurant at the given position, building it from the snapshot columns if needed."""
+        if self._restaurants[position] is None:
+            arrays, strings = self._columns
+            restaurant = Restaurant(strings['restaurant_ids'][position], strings['restaurant_names'][position],
+                                    strings['postal_codes'][int(arrays['restaurant_postal_codes'][position])])
+            start, end = arrays['cuisine_offsets'][position], arrays['cuisine_offsets'][position + 1]
+            restaurant.cuisine = intern_cuisines(strings['cuisines'][code]
+                                                 for code in arrays['cuisine_codes'][start:end].tolist())
+            self._restaurants[position] = restaurant
+        return self._restaurants[position]
+
+    def _preferences(self) -> np.ndarray:
+        """Return a matrix whose row i is the preference_lst of the user at position i.
+
+        Users that were loaded from a snapshot are not built: every distinct combination of preference
+        codes is converted once.
+        """
+        rows = np.zeros((len(self._users), 5), dtype=np.int8)
+        num_loaded = 0 if self._columns is None else len(self._columns[1]['user_ids'])
+        if num_loaded > 0:
+            arrays, strings = self._columns
+            codes = np.stack([arrays['user_' + attribute] for attribute in USER_ATTRIBUTES], axis=1)
+            combinations, inverse = np.unique(codes, axis=0, return_inverse=True)
+            encoded = np.array([User('', *(strings['user_' + attribute + '_values'][code]
+                                           for attribute, code in zip(USER_ATTRIBUTES, combination.tolist())))
+                                .preference_lst() for combination in combinations], dtype=np.int8).reshape(-1, 5)
+            rows[:num_loaded] = encoded[inverse.reshape(-1)]
+
+        for i in range(num_loaded, len(self._users)):
+            rows[i] = self._users[i].preference_lst()
+        return rows
+
+
+def _edge_range(offsets: np.ndarray, position: int) -> tuple[int, int]:
+    """Return the start and end of the edges of the vertex at position in compressed sparse row offsets,
+    which are empty if the vertex is past the end of the offsets.
+    """
+    if position + 1 >= len(offsets):
+        return (0, 0)
+    return (int(offsets[position]), int(offsets[position + 1]))
+
+
+def _offsets(rows: np.ndarray, num_rows: int) -> np.ndarray:
+    """Return the compressed sparse row offsets of the given sorted row numbers."""
+    offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_rows), out=offsets[1:])
+    return offsets
+
+
+if __name__ == '__main__':
+    import python_ta
+
+    python_ta.check_all(config={
+        # the names (strs) of imported modules
+        'extra-imports': ['numpy', 'instrumentation', 'graph_snapshot', 'recommender_data'],
+        'allowed-io': [],  # the names (strs) of functions that call print/open/input
+        'max-line-length': 120,
+        'max-nested-blocks': 4,
+        'disable': ['E1136', 'W0221', 'W0212', 'R0902']})
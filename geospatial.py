@@ -0,0 +1,416 @@
+"""Postal code coordinates and the distances between them"""
+from __future__ import annotations
+import csv
+import math
+from typing import Any, Iterable, Iterator, Optional, TextIO
+import numpy as np
+from graph_snapshot import read_snapshot, write_snapshot
+
+# The radius of the Earth, in kilometres.
+EARTH_RADIUS = 6371
+
+# The length of one degree of latitude, in kilometres.
+KM_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+# The number of rows of a postal code file read at once when building a PostalGeocoder.
+GEOCODER_CHUNK_SIZE = 1000000
+
+
+class FSATable:
+    """The coordinates of every forward sortation area (FSA), the first 3 characters of a postal code,
+    with the distance between every pair of FSAs computed once.
+
+    Instance Attributes:
+        - fsas: the FSAs in this table, in the order they were given
+
+    Representation Invariants:
+        - all(len(fsa) == 3 for fsa in self.fsas)
+    """
+    fsas: list[str]
+
+    # Private Instance Attributes:
+    #     - _index:
+    #         Maps each FSA to its position in self.fsas.
+    #     - _coordinates:
+    #         Row i is the (latitude, longitude) of self.fsas[i], in degrees.
+    #     - _distances:
+    #         _distances[i, j] is the distance in kilometres between self.fsas[i] and self.fsas[j].
+    _index: dict[str, int]
+    _coordinates: np.ndarray
+    _distances: np.ndarray
+
+    def __init__(self, rows: Iterable[tuple[str, float, float]]) -> None:
+        """Initialize a new table from (fsa, latitude, longitude) rows.
+        """
+        self.fsas = []
+        self._index = {}
+        coordinates = []
+        for fsa, latitude, longitude in rows:
+            if fsa not in self._index:
+                self._index[fsa] = len(self.fsas)
+                self.fsas.append(fsa)
+                coordinates.append((latitude, longitude))
+
+        self._coordinates = np.array(coordinates, dtype=np.float64).reshape(-1, 2)
+        self._distances = spherical_distances(self._coordinates, self._coordinates)
+
+    def __contains__(self, fsa: str) -> bool:
+        """Return whether fsa is in this table."""
+        return fsa in self._index
+
+    def coordinates(self, fsa: str) -> tuple[float, float]:
+        """Return the (latitude, longitude) of fsa.
+
+        Raise a KeyError if fsa is not in this table.
+        """
+        latitude, longitude = self._coordinates[self._index[fsa]]
+        return (float(latitude), float(longitude))
+
+    def distance(self, fsa1: str, fsa2: str) -> float:
+        """Return the distance in kilometres between fsa1 and fsa2.
+
+        Raise a KeyError if fsa1 or fsa2 is not in this table.
+        """
+        return float(self._distances[self._index[fsa1], self._index[fsa2]])
+
+    def distances_from(self, fsa: str, others: list[str]) -> np.ndarray:
+        """Return an array of the distances in kilometres between fsa and each FSA in others.
+
+        Raise a KeyError if fsa or an FSA in others is not in this table.
+        """
+        columns = np.array([self._index[other] for other in others], dtype=np.intp)
+        return self._distances[self._index[fsa], columns]
+
+
+class SpatialIndex:
+    """A grid index over located items, for finding the items within a radius of a point or nearest to it.
+
+    Items are bucketed into square cells of cell_size degrees of latitude and longitude, so a query only
+    computes the distances to the items in the cells that can be within range.
+
+    Instance Attributes:
+        - cell_size: the width and height of each grid cell, in degrees
+
+    Representation Invariants:
+        - self.cell_size > 0
+    """
+    cell_size: float
+
+    # Private Instance Attributes:
+    #     - _items:
+    #         The items in this index.
+    #     - _coordinates:
+    #         Row i is the (latitude, longitude) of _items[i], in degrees.
+    #     - _cells:
+    #         Maps each non-empty grid cell to the positions in _items of the items inside it.
+    _items: list[Any]
+    _coordinates: np.ndarray
+    _cells: dict[tuple[int, int], np.ndarray]
+
+    def __init__(self, points: Iterable[tuple[Any, float, float]], cell_size: float = 0.05) -> None:
+        """Initialize a new index from (item, latitude, longitude) points.
+
+        Preconditions:
+        - cell_size > 0
+        """
+        self.cell_size = cell_size
+        self._items = []
+        coordinates = []
+        cells = {}
+        for item, latitude, longitude in points:
+            cells.setdefault(self._cell(latitude, longitude), []).append(len(self._items))
+            self._items.append(item)
+            coordinates.append((latitude, longitude))
+
+        self._coordinates = np.array(coordinates, dtype=np.float64).reshape(-1, 2)
+        self._cells = {cell: np.array(positions, dtype=np.intp) for cell, positions in cells.items()}
+
+    def __len__(self) -> int:
+        """Return the number of items in this index."""
+        return len(self._items)
+
+    def within(self, latitude: float, longitude: float, radius: float) -> dict[Any, float]:
+        """Return a dictionary mapping every item at most radius kilometres from (latitude, longitude)
+        to its distance in kilometres.
+
+        Preconditions:
+        - radius >= 0
+        """
+        positions = self._positions_near(latitude, longitude, radius)
+        distances = spherical_distances(np.array([[latitude, longitude]]), self._coordinates[positions])[0]
+        return {self._items[i]: float(d) for i, d in zip(positions, distances) if d <= radius}
+
+    def nearest(self, latitude: float, longitude: float, k: int) -> list[tuple[Any, float]]:
+        """Return the k items nearest to (latitude, longitude) with their distances in kilometres,
+        from nearest to furthest.
+
+        Return every item if there are fewer than k items in this index.
+
+        Preconditions:
+        - k >= 0
+        """
+        if k == 0:
+            return []
+
+        radius = self.cell_size * KM_PER_DEGREE
+        found = self.within(latitude, longitude, radius)
+        while len(found) < min(k, len(self._items)):
+            radius *= 2
+            found = self.within(latitude, longitude, radius)
+
+        return sorted(found.items(), key=lambda pair: pair[1])[:k]
+
+    def _cell(self, latitude: float, longitude: float) -> tuple[int, int]:
+        """Return the grid cell containing (latitude, longitude)."""
+        return (math.floor(latitude / self.cell_size), math.floor(longitude / self.cell_size))
+
+    def _positions_near(self, latitude: float, longitude: float, radius: float) -> np.ndarray:
+        """Return the positions in self._items of the items in every cell that may be within radius
+        kilometres of (latitude, longitude).
+        """
+        latitude_span = radius / KM_PER_DEGREE
+        cos_latitude = math.cos(math.radians(min(abs(latitude) + latitude_span, 90)))
+        if latitude_span >= 90 or cos_latitude < 1e-9 or radius >= math.pi * EARTH_RADIUS:
+            return np.arange(len(self._items))
+
+        longitude_span = min(latitude_span / cos_latitude, 180)
+        low_row, low_column = self._cell(latitude - latitude_span, longitude - longitude_span)
+        high_row, high_column = self._cell(latitude + latitude_span, longitude + longitude_span)
+
+        if (high_row - low_row + 1) * (high_column - low_column + 1) > len(self._cells):
+            # Checking every non-empty cell is cheaper than checking every cell in range.
+            cells = [positions for (row, column), positions in self._cells.items() if low_row <= row <= high_row
+                     and _column_in_range(column, low_column, high_column, self.cell_size)]
+        else:
+            cells = [self._cells[(row, column)] for row in range(low_row, high_row + 1)
+                     for column in _wrapped_columns(low_column, high_column, self.cell_size)
+                     if (row, column) in self._cells]
+
+        return np.concatenate(cells) if cells else np.arange(0)
+
+
+class PostalGeocoder:
+    """The coordinates of postal codes of any length, such as full Canadian postal codes, FSAs and ZIP codes,
+    for tables of millions of codes.
+
+    Codes are normalized by normalize_postal_code and kept in one sorted array of fixed-width byte strings,
+    with their coordinates in a matching array. A code that is not in the table is located at the longest
+    prefix of it that is, so a full postal code falls back to its FSA: each character of the code narrows
+    the range of codes starting with it by binary search, so a lookup takes O(length * log(len(self)))
+    comparisons. A geocoder loaded with load reads both arrays through memory maps, so only the pages that
+    lookups touch are read into memory.
+
+    Representation Invariants:
+        - the codes are sorted and distinct
+    """
+    # Private Instance Attributes:
+    #     - _codes:
+    #         The normalized postal codes, ASCII encoded, in sorted order.
+    #     - _coordinates:
+    #         Row i is the (latitude, longitude) of _codes[i], in degrees.
+    _codes: np.ndarray
+    _coordinates: np.ndarray
+
+    def __init__(self, codes: np.ndarray, coordinates: np.ndarray) -> None:
+        """Initialize a new geocoder from an array of normalized postal codes and their coordinates.
+
+        Preconditions:
+        - codes is a sorted array of distinct byte strings (of a numpy 'S' dtype)
+        - coordinates.shape == (len(codes), 2)
+        """
+        self._codes = codes
+        self._coordinates = coordinates
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple[str, float, float]], path: Optional[str] = None,
+                  sources: Iterable[str] = ()) -> PostalGeocoder:
+        """Return a geocoder of (postal code, latitude, longitude) rows. The first row of each code is kept.
+
+        If path is not None, the geocoder is also saved to the directory path, recording the given source
+        files as a graph snapshot does, and the returned geocoder reads it from there.
+        """
+        code_chunks, coordinate_chunks = [], []
+        for codes, coordinates in _row_chunks(rows):
+            code_chunks.append(codes)
+            coordinate_chunks.append(coordinates)
+        codes = np.concatenate(code_chunks) if code_chunks else np.zeros(0, dtype='S1')
+        coordinates = np.concatenate(coordinate_chunks) if coordinate_chunks else np.zeros((0, 2))
+
+        order = np.argsort(codes, kind='stable')
+        codes, coordinates = codes[order], coordinates[order]
+        first = np.ones(len(codes), dtype=bool)
+        first[1:] = codes[1:] != codes[:-1]
+        geocoder = cls(codes[first], coordinates[first])
+
+        if path is not None:
+            geocoder.save(path, sources)
+            geocoder = cls.load(path)
+        return geocoder
+
+    @classmethod
+    def load(cls, path: str) -> PostalGeocoder:
+        """Return the geocoder saved in the directory path, memory-mapped.
+
+        Raise a ValueError if path does not hold a complete saved geocoder.
+        """
+        arrays = read_snapshot(path)[0]
+        if 'postal_codes' not in arrays:
+            raise ValueError
+        return cls(arrays['postal_codes'], arrays['postal_coordinates'])
+
+    def save(self, path: str, sources: Iterable[str] = ()) -> None:
+        """Save this geocoder to the directory path, in the snapshot format of graph_snapshot."""
+        write_snapshot(path, {'postal_codes': self._codes, 'postal_coordinates': self._coordinates}, {}, sources)
+
+    def __len__(self) -> int:
+        """Return the number of postal codes in this geocoder."""
+        return len(self._codes)
+
+    def __contains__(self, postal_code: str) -> bool:
+        """Return whether postal_code, or a prefix of it, is in this geocoder."""
+        return self._position(postal_code) is not None
+
+    def match(self, postal_code: str) -> str:
+        """Return the longest prefix of the normalized postal_code in this geocoder.
+
+        Raise a KeyError if no prefix of postal_code is in this geocoder.
+        """
+        return self._codes[self._find(postal_code)].decode('ascii')
+
+    def coordinates(self, postal_code: str) -> tuple[float, float]:
+        """Return the (latitude, longitude) of the longest prefix of postal_code in this geocoder.
+
+        Raise a KeyError if no prefix of postal_code is in this geocoder.
+        """
+        latitude, longitude = self._coordinates[self._find(postal_code)]
+        return (float(latitude), float(longitude))
+
+    def locate(self, postal_codes: Iterable[str]) -> np.ndarray:
+        """Return an array whose row i is the coordinates of the i-th code of postal_codes, each code being
+        looked up once.
+
+        Raise a KeyError if no prefix of one of postal_codes is in this geocoder.
+        """
+        positions = {}
+        rows = [positions[code] if code in positions else positions.setdefault(code, self._find(code))
+                for code in postal_codes]
+        return np.asarray(self._coordinates[np.array(rows, dtype=np.intp)], dtype=np.float64).reshape(-1, 2)
+
+    def distances_from(self, postal_code: str, others: list[str]) -> np.ndarray:
+        """Return an array of the distances in kilometres between postal_code and each code in others, as
+        located by coordinates.
+
+        Raise a KeyError if no prefix of postal_code or of a code in others is in this geocoder.
+        """
+        return spherical_distances(np.array([self.coordinates(postal_code)]), self.locate(others))[0]
+
+    def _find(self, postal_code: str) -> int:
+        """Return the position in _codes of the longest prefix of postal_code, raising a KeyError if there is
+        none.
+        """
+        position = self._position(postal_code)
+        if position is None:
+            raise KeyError(postal_code)
+        return position
+
+    def _position(self, postal_code: str) -> Optional[int]:
+        """Return the position in _codes of the longest prefix of the normalized postal_code, or None if there
+        is none.
+        """
+        key = normalize_postal_code(postal_code).encode('ascii', 'ignore')[:self._codes.dtype.itemsize]
+        low, high = 0, len(self._codes)
+        found = None
+        for length in range(1, len(key) + 1):
+            # The codes starting with key[:length] are the ones from key[:length] (inclusive) to
+            # key[:length] followed by a byte above every ASCII character (exclusive).
+            prefix = key[:length]
+            codes = self._codes[low:high]
+            high = low + int(np.searchsorted(codes, prefix + b'\xff'))
+            low += int(np.searchsorted(codes, prefix))
+            if low == high:
+                break
+            if self._codes[low] == prefix:
+                found = low
+        return found
+
+
+def normalize_postal_code(postal_code: str) -> str:
+    """Return postal_code in upper case, without spaces or hyphens.
+
+    >>> normalize_postal_code(' m5s 1a1 ')
+    'M5S1A1'
+    """
+    return ''.join(postal_code.split()).replace('-', '').upper()
+
+
+def load_geocoder(postal_coordinates: TextIO, path: Optional[str] = None, sources: Iterable[str] = ()) -> (
+        PostalGeocoder):
+    """Return the geocoder of the given csv file of postal_code,latitude,longitude rows, such as
+    Geospatial_Coordinates.csv, saving it to the directory path if path is not None (see
+    PostalGeocoder.from_rows).
+    """
+    reader = csv.reader(postal_coordinates)
+    return PostalGeocoder.from_rows(((row[0], float(row[1]), float(row[2])) for row in reader if len(row) >= 3),
+                                    path, sources)
+
+
+def load_fsa_table(geospatial_coordinates: TextIO) -> FSATable:
+    """Return the FSA table stored in the given csv file of fsa,latitude,longitude rows."""
+    reader = csv.reader(geospatial_coordinates)
+    return FSATable((row[0], float(row[1]), float(row[2])) for row in reader)
+
+
+def spherical_distances(points1: np.ndarray, points2: np.ndarray) -> np.ndarray:
+    """Return the matrix of distances in kilometres between every point in points1 and every point in points2.
+
+    Points are rows of (latitude, longitude) in degrees, and entry [i, j] is the distance between
+    points1[i] and points2[j], computed with the spherical law of cosines.
+    """
+    latitudes1, longitudes1 = np.radians(points1[:, 0])[:, None], np.radians(points1[:, 1])[:, None]
+    latitudes2, longitudes2 = np.radians(points2[:, 0])[None, :], np.radians(points2[:, 1])[None, :]
+    cosines = (np.sin(latitudes1) * np.sin(latitudes2)
+               + np.cos(latitudes1) * np.cos(latitudes2) * np.cos(longitudes2 - longitudes1))
+    return np.arccos(np.clip(cosines, -1, 1)) * EARTH_RADIUS
+
+
+def _row_chunks(rows: Iterable[tuple[str, float, float]]) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """Yield the normalized, ASCII encoded codes and the coordinates of GEOCODER_CHUNK_SIZE rows at a time,
+    leaving out rows whose normalized code is empty.
+    """
+    codes, coordinates = [], []
+    for postal_code, latitude, longitude in rows:
+        code = normalize_postal_code(postal_code).encode('ascii', 'ignore')
+        if code:
+            codes.append(code)
+            coordinates.append((latitude, longitude))
+        if len(codes) == GEOCODER_CHUNK_SIZE:
+            yield (np.array(codes), np.array(coordinates, dtype=np.float64))
+            codes, coordinates = [], []
+    if codes:
+        yield (np.array(codes), np.array(coordinates, dtype=np.float64))
+
+
+def _wrapped_columns(low_column: int, high_column: int, cell_size: float) -> list[int]:
+    """Return the grid columns from low_column to high_column, wrapping across the antimeridian.
+    """
+    columns_per_turn = math.ceil(360 / cell_size)
+    lowest = math.floor(-180 / cell_size)
+    return [lowest + (column - lowest) % columns_per_turn for column in range(low_column, high_column + 1)]
+
+
+def _column_in_range(column: int, low_column: int, high_column: int, cell_size: float) -> bool:
+    """Return whether column is one of _wrapped_columns(low_column, high_column, cell_size).
+    """
+    columns_per_turn = math.ceil(360 / cell_size)
+    return (column - low_column) % columns_per_turn <= high_column - low_column
+
+
+if __name__ == '__main__':
+    import python_ta
+
+    python_ta.check_all(config={
+        'extra-imports': ['csv', 'math', 'numpy', 'graph_snapshot'],  # the names (strs) of imported modules
+        'allowed-io': [],  # the names (strs) of functions that call print/open/input
+        'max-line-length': 120,
+        'max-nested-blocks': 4,
+        'disable': ['E1136', 'W0221']})
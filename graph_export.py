@@ -0,0 +1,242 @@
+"""Exporting the review graph to Parquet files, and importing it back
+
+A graph is exported to a directory holding two Parquet files, which pandas reads with pandas.read_parquet:
+    - vertices.parquet, one row per vertex in the order they were added, with the columns id, kind ('user' or
+      'restaurant'), the user attributes smoker, drink_level, dress_preference, ambience and budget (null for
+      restaurants), and the restaurant attributes name, postal_code and cuisines, a list of strings (null for
+      users)
+    - edges.parquet, one row per review with the columns user_id, restaurant_id and rating, grouped by user in
+      the order each user's reviews were added, and restaurant_order, the position of the review among the
+      reviews of its restaurant, which keeps the order of each restaurant's reviewers too
+
+Both files are written one batch of rows at a time, with each batch gathered from the arrays of to_columns by
+pyarrow rather than row by row in Python. import_graph reads them back one batch at a time into the same
+arrays, and builds the graph from those with from_columns, without adding vertices and edges one by one.
+
+The files are read and written with pyarrow, which is only imported when they are.
+"""
+from __future__ import annotations
+import os
+from typing import Any, Iterator
+import numpy as np
+from graph_snapshot import intern_strings
+from recommender_data import USER_ATTRIBUTES, WeightedGraph
+
+VERTICES_FILE = 'vertices.parquet'
+EDGES_FILE = 'edges.parquet'
+
+# The number of rows written or read at once, which is also the size of each row group of the files.
+BATCH_SIZE = 1000000
+
+
+def export_graph(graph: Any, path: str, batch_size: int = BATCH_SIZE) -> None:
+    """Export graph, a WeightedGraph or CSRWeightedGraph, to the directory path.
+
+    Each file is written under a temporary name that is replaced once it is complete, so a file that was
+    only partly written is never read.
+
+    Preconditions:
+    - batch_size >= 1
+    """
+    import pyarrow.parquet as pq
+
+    os.makedirs(path, exist_ok=True)
+    arrays, strings = graph.to_columns()
+    for name, batches in [(VERTICES_FILE, vertex_batches(arrays, strings, batch_size)),
+                          (EDGES_FILE, edge_batches(arrays, strings, batch_size))]:
+        file_path = os.path.join(path, name)
+        first = next(batches)
+        with pq.ParquetWriter(file_path + '.tmp', first.schema) as writer:
+            writer.write_batch(first, row_group_size=batch_size)
+            for batch in batches:
+                writer.write_batch(batch, row_group_size=batch_size)
+        os.replace(file_path + '.tmp', file_path)
+
+
+def import_graph(path: str, graph_type: type = WeightedGraph, batch_size: int = BATCH_SIZE) -> Any:
+    """Return the graph exported to the directory path, as a graph_type (WeightedGraph or CSRWeightedGraph).
+
+    The files may also be written by other tools, in the format described in the module. The reviews of
+    each user keep the order they have in edges.parquet, and the reviews of each restaurant are ordered by
+    restaurant_order, or keep their order in edges.parquet if there is no such column.
+
+    Raise a ValueError naming the id if an edge has a user_id or restaurant_id that is not a vertex of that kind.
+
+    Preconditions:
+    - every id in vertices.parquet is different
+    - every (user_id, restaurant_id) pair appears at most once in edges.parquet
+    - batch_size >= 1
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    kinds, users, restaurants = [], {'id': []}, {'id': [], 'name': [], 'postal_code': [], 'cuisines': []}
+    for attribute in USER_ATTRIBUTES:
+        users[attribute] = []
+    for batch in pq.ParquetFile(os.path.join(path, VERTICES_FILE)).iter_batches(batch_size):
+        is_restaurant = pc.equal(batch.column('kind'), 'restaurant')
+        kinds.append(np.asarray(is_restaurant.fill_null(False), dtype=np.int8))
+        for columns, mask in [(users, pc.invert(is_restaurant)), (restaurants, is_restaurant)]:
+            for column, values in columns.items():
+                values.extend(pc.filter(batch.column(column), mask).to_pylist())
+
+    arrays = {'vertex_kinds': np.concatenate(kinds) if kinds else np.zeros(0, dtype=np.int8)}
+    strings = {'user_ids': users['id'], 'restaurant_ids': restaurants['id'], 'restaurant_names': restaurants['name']}
+    for attribute in USER_ATTRIBUTES:
+        strings['user_' + attribute + '_values'], arrays['user_' + attribute] = intern_strings(users[attribute])
+    strings['postal_codes'], arrays['restaurant_postal_codes'] = intern_strings(restaurants['postal_code'])
+    cuisine_lists = [cuisines or [] for cuisines in restaurants['cuisines']]
+    strings['cuisines'], arrays['cuisine_codes'] = intern_strings(
+        cuisine for cuisines in cuisine_lists for cuisine in cuisines)
+    arrays['cuisine_offsets'] = _offsets(np.array([len(cuisines) for cuisines in cuisine_lists], dtype=np.int64))
+
+    user_ids = pa.array(users['id'], pa.string())
+    restaurant_ids = pa.array(restaurants['id'], pa.string())
+    edges_file = pq.ParquetFile(os.path.join(path, EDGES_FILE))
+    has_order = 'restaurant_order' in edges_file.schema_arrow.names
+    edge_users, edge_restaurants, ratings, restaurant_order = [], [], [], []
+    for batch in edges_file.iter_batches(batch_size):
+        edge_users.append(_positions(batch.column('user_id'), user_ids))
+        edge_restaurants.append(_positions(batch.column('restaurant_id'), restaurant_ids))
+        ratings.append(batch.column('rating').to_numpy(zero_copy_only=False))
+        if has_order:
+            restaurant_order.append(batch.column('restaurant_order').to_numpy(zero_copy_only=False))
+    edge_users = np.concatenate(edge_users) if edge_users else np.zeros(0, dtype=np.int64)
+    edge_restaurants = np.concatenate(edge_restaurants) if edge_restaurants else np.zeros(0, dtype=np.int64)
+    ratings = np.concatenate(ratings) if ratings else np.zeros(0, dtype=np.int32)
+    if np.issubdtype(ratings.dtype, np.integer):
+        ratings = ratings.astype(np.int32)
+    restaurant_order = np.concatenate(restaurant_order) if has_order and restaurant_order else np.arange(len(ratings))
+
+    # Group the edges by user, keeping their order in the file, and by restaurant, in restaurant_order.
+    by_user = np.argsort(edge_users, kind='stable')
+    arrays['user_offsets'] = _offsets(np.bincount(edge_users, minlength=len(users['id'])))
+    arrays['user_neighbours'] = edge_restaurants[by_user].astype(np.int32)
+    arrays['user_ratings'] = ratings[by_user]
+    by_restaurant = np.lexsort((restaurant_order, edge_restaurants))
+    arrays['restaurant_offsets'] = _offsets(np.bincount(edge_restaurants, minlength=len(restaurants['id'])))
+    arrays['restaurant_neighbours'] = edge_users[by_restaurant].astype(np.int32)
+    arrays['restaurant_ratings'] = ratings[by_restaurant]
+
+    return graph_type.from_columns(arrays, strings)
+
+
+def vertex_batches(arrays: dict[str, np.ndarray], strings: dict[str, Any], batch_size: int = BATCH_SIZE) -> (
+        Iterator[Any]):
+    """Yield the rows of vertices.parquet for the graph with the given to_columns arrays and string tables, as
+    pyarrow RecordBatches of at most batch_size rows. At least one batch is yielded, even if it is empty.
+
+    Preconditions:
+    - batch_size >= 1
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    kinds = np.asarray(arrays['vertex_kinds'])
+    is_user = kinds == 0
+    # The position of each vertex among the vertices of its kind.
+    ranks = np.where(is_user, np.cumsum(is_user) - 1, np.cumsum(~is_user) - 1)
+
+    user_columns = {'id': pa.array(list(strings['user_ids']), pa.string())}
+    for attribute in USER_ATTRIBUTES:
+        user_columns[attribute] = pa.array(list(strings['user_' + attribute + '_values']), pa.string()).take(
+            pa.array(np.asarray(arrays['user_' + attribute])))
+    cuisines = pa.array(list(strings['cuisines']), pa.string()).take(pa.array(np.asarray(arrays['cuisine_codes'])))
+    restaurant_columns = {
+        'id': pa.array(list(strings['restaurant_ids']), pa.string()),
+        'name': pa.array(list(strings['restaurant_names']), pa.string()),
+        'postal_code': pa.array(list(strings['postal_codes']), pa.string()).take(
+            pa.array(np.asarray(arrays['restaurant_postal_codes']))),
+        'cuisines': pa.ListArray.from_arrays(pa.array(np.asarray(arrays['cuisine_offsets'], dtype=np.int32)),
+                                             cuisines)}
+
+    for start in range(0, max(len(kinds), 1), batch_size):
+        users = is_user[start:start + batch_size]
+        user_rows = pa.array(ranks[start:start + batch_size], mask=~users)
+        restaurant_rows = pa.array(ranks[start:start + batch_size], mask=users)
+        columns = {'id': pc.if_else(users, user_columns['id'].take(user_rows),
+                                    restaurant_columns['id'].take(restaurant_rows)),
+                   'kind': pc.if_else(users, pa.scalar('user'), pa.scalar('restaurant'))}
+        for attribute in USER_ATTRIBUTES:
+            columns[attribute] = user_columns[attribute].take(user_rows)
+        for column in ('name', 'postal_code', 'cuisines'):
+            columns[column] = restaurant_columns[column].take(restaurant_rows)
+        yield pa.RecordBatch.from_pydict(columns)
+
+
+def edge_batches(arrays: dict[str, np.ndarray], strings: dict[str, Any], batch_size: int = BATCH_SIZE) -> (
+        Iterator[Any]):
+    """Yield the rows of edges.parquet for the graph with the given to_columns arrays and string tables, as
+    pyarrow RecordBatches of at most batch_size rows. At least one batch is yielded, even if it is empty.
+
+    Preconditions:
+    - batch_size >= 1
+    """
+    import pyarrow as pa
+
+    user_ids = pa.array(list(strings['user_ids']), pa.string())
+    restaurant_ids = pa.array(list(strings['restaurant_ids']), pa.string())
+    offsets = np.asarray(arrays['user_offsets'])
+    neighbours = np.asarray(arrays['user_neighbours'])
+    ratings = np.asarray(arrays['user_ratings'])
+    restaurant_order = _restaurant_order(arrays)
+
+    for start in range(0, max(len(neighbours), 1), batch_size):
+        end = min(start + batch_size, len(neighbours))
+        users = np.searchsorted(offsets, np.arange(start, end), side='right') - 1
+        yield pa.RecordBatch.from_pydict({'user_id': user_ids.take(pa.array(users, pa.int64())),
+                                          'restaurant_id': restaurant_ids.take(pa.array(neighbours[start:end])),
+                                          'rating': pa.array(ratings[start:end]),
+                                          'restaurant_order': pa.array(restaurant_order[start:end], pa.int64())})
+
+
+def _restaurant_order(arrays: dict[str, np.ndarray]) -> np.ndarray:
+    """Return the position of each edge of the to_columns arrays, in user order, among the edges of its
+    restaurant.
+    """
+    user_offsets, restaurant_offsets = np.asarray(arrays['user_offsets']), np.asarray(arrays['restaurant_offsets'])
+    neighbours = np.asarray(arrays['user_neighbours']).astype(np.int64)
+    num_restaurants = len(restaurant_offsets) - 1
+    users = np.repeat(np.arange(len(user_offsets) - 1), np.diff(user_offsets))
+    restaurants = np.repeat(np.arange(num_restaurants), np.diff(restaurant_offsets))
+
+    # Match each edge in user order to the same edge in restaurant order by its (user, restaurant) key.
+    restaurant_keys = np.asarray(arrays['restaurant_neighbours']).astype(np.int64) * num_restaurants + restaurants
+    by_key = np.argsort(restaurant_keys, kind='stable')
+    matches = by_key[np.searchsorted(restaurant_keys[by_key], users * num_restaurants + neighbours)]
+    return matches - restaurant_offsets[neighbours]
+
+
+def _positions(values: Any, ids: Any) -> np.ndarray:
+    """Return the position in the pyarrow array ids of each value in the pyarrow array values.
+
+    Raise a ValueError naming the first value that is not in ids.
+    """
+    import pyarrow.compute as pc
+
+    positions = pc.index_in(values, value_set=ids)
+    if positions.null_count > 0:
+        unknown = pc.filter(values, pc.is_null(positions))[0].as_py()
+        raise ValueError('unknown id ' + repr(unknown))
+    return positions.to_numpy().astype(np.int64)
+
+
+def _offsets(lengths: np.ndarray) -> np.ndarray:
+    """Return the compressed sparse row offsets of rows with the given lengths."""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+if __name__ == '__main__':
+    import python_ta
+
+    python_ta.check_all(config={
+        # the names (strs) of imported modules
+        'extra-imports': ['os', 'numpy', 'pyarrow', 'pyarrow.compute', 'pyarrow.parquet', 'graph_snapshot',
+                          'recommender_data'],
+        'allowed-io': [],  # the names (strs) of functions that call print/open/input
+        'max-line-length': 120,
+        'max-nested-blocks': 4,
+        'disable': ['E1136', 'W0221']})
@@ -0,0 +1,224 @@
+"""Reading and writing binary snapshots of the review graph
+
+A snapshot is a directory holding one .npy file per array, one blob of UTF-8 text per string table, and a
+manifest.json file that records the snapshot format and the size and modification time of the csv files the
+graph was loaded from. Arrays and string tables are memory-mapped when read, so loading a snapshot does not
+copy it into memory, and processes reading the same snapshot share the same pages.
+
+Each write of a snapshot is a new generation: its files are named after a generation id recorded in the
+manifest, and the files of the previous generation are only removed once the new manifest replaces the old
+one. No file is ever rewritten in place, so processes that have the previous snapshot memory-mapped keep
+reading it unchanged.
+"""
+from __future__ import annotations
+import json
+import os
+from typing import Iterable, Iterator
+import numpy as np
+
+# The version of the snapshot format. Snapshots written with another version are never read.
+SNAPSHOT_VERSION = 3
+
+MANIFEST_FILE = 'manifest.json'
+
+
+class StringTable:
+    """A read-only sequence of strings stored as one block of UTF-8 bytes.
+
+    Strings are only decoded when they are accessed.
+
+    Representation Invariants:
+        - len(self._offsets) >= 1
+    """
+    # Private Instance Attributes:
+    #     - _data:
+    #         The encoded strings, one after another.
+    #     - _offsets:
+    #         String i is encoded in _data[_offsets[i]:_offsets[i + 1]].
+    _data: np.ndarray
+    _offsets: np.ndarray
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray) -> None:
+        """Initialize a new string table from its bytes and offsets."""
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        """Return the number of strings in this table."""
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        """Return the i-th string in this table.
+
+        Raise an IndexError if i is not a valid position.
+        """
+        if not -len(self) <= i < len(self):
+            raise IndexError
+        i %= len(self)
+        return self._data[self._offsets[i]:self._offsets[i + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        """Return an iterator over the strings in this table."""
+        return (self[i] for i in range(len(self)))
+
+
+def intern_strings(values: Iterable[str]) -> tuple[list[str], np.ndarray]:
+    """Return the distinct strings in values, in order of first appearance, and an array giving the
+    position of each value in that list.
+    """
+    vocabulary = {}
+    codes = [vocabulary.setdefault(value, len(vocabulary)) for value in values]
+    return (list(vocabulary), np.array(codes, dtype=np.int32))
+
+
+def encode_strings(values: Iterable[str]) -> tuple[np.ndarray, np.ndarray]:
+    """Return the UTF-8 bytes and offsets of a StringTable holding the given strings."""
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return (np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+
+def source_fingerprints(sources: Iterable[str]) -> dict[str, list[int]]:
+    """Return a dictionary mapping the absolute path of each source file to its size and modification time."""
+    fingerprints = {}
+    for source in sources:
+        status = os.stat(source)
+        fingerprints[os.path.abspath(source)] = [status.st_size, status.st_mtime_ns]
+    return fingerprints
+
+
+def write_snapshot(path: str, arrays: dict[str, np.ndarray], strings: dict[str, list[str]],
+                   sources: Iterable[str] = ()) -> None:
+    """Write a snapshot of the given arrays and string tables to the directory path.
+
+    The files are written under a new generation id, and the manifest is replaced last, so a snapshot that
+    was only partly written is never read. Then the files of the snapshot it replaced are removed; readers
+    that have them memory-mapped keep their pages until they unmap them.
+
+    Preconditions:
+        - all names in arrays and strings are valid file names, and no name is in both
+    """
+    os.makedirs(path, exist_ok=True)
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    previous = _read_manifest(path, any_version=True)
+    generation = os.urandom(8).hex()
+
+    for name, array in arrays.items():
+        np.save(_file_path(path, generation, name, '.npy'), np.ascontiguousarray(array))
+
+    for name, values in strings.items():
+        data, offsets = encode_strings(values)
+        np.save(_file_path(path, generation, name, '.offsets.npy'), offsets)
+        with open(_file_path(path, generation, name, '.strings'), 'wb') as file:
+            file.write(data.tobytes())
+
+    manifest = {'version': SNAPSHOT_VERSION, 'generation': generation, 'arrays': sorted(arrays),
+                'strings': sorted(strings), 'sources': source_fingerprints(sources)}
+    with open(manifest_path + '.' + generation + '.tmp', 'w') as file:
+        json.dump(manifest, file)
+    os.replace(manifest_path + '.' + generation + '.tmp', manifest_path)
+
+    if previous is not None and previous.get('generation') != generation:
+        for file_path in _snapshot_files(path, previous):
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+
+def read_snapshot(path: str) -> tuple[dict[str, np.ndarray], dict[str, StringTable]]:
+    """Return the arrays and string tables of the snapshot in the directory path, memory-mapped.
+
+    Raise a ValueError if path does not hold a complete snapshot of the current version. If a new snapshot
+    replaces the one being read, and removes its files before they are all mapped, the new one is read.
+    """
+    manifest = _read_manifest(path)
+    while manifest is not None:
+        try:
+            return _map_snapshot(path, manifest)
+        except OSError:
+            latest = _read_manifest(path)
+            if latest is not None and latest['generation'] == manifest['generation']:
+                break
+            manifest = latest
+
+    raise ValueError
+
+
+def snapshot_is_current(path: str, sources: Iterable[str]) -> bool:
+    """Return whether path holds a complete snapshot written from exactly the given source files,
+    none of which have changed since.
+    """
+    manifest = _read_manifest(path)
+    try:
+        return manifest is not None and manifest['sources'] == source_fingerprints(sources)
+    except OSError:
+        return False
+
+
+def _map_snapshot(path: str, manifest: dict) -> tuple[dict[str, np.ndarray], dict[str, StringTable]]:
+    """Return the arrays and string tables of the snapshot in the directory path with the given manifest,
+    memory-mapped.
+    """
+    generation = manifest['generation']
+    arrays = {name: np.load(_file_path(path, generation, name, '.npy'), mmap_mode='r')
+              for name in manifest['arrays']}
+    strings = {}
+    for name in manifest['strings']:
+        offsets = np.load(_file_path(path, generation, name, '.offsets.npy'), mmap_mode='r')
+        data_path = _file_path(path, generation, name, '.strings')
+        if os.path.getsize(data_path) == 0:
+            data = np.zeros(0, dtype=np.uint8)
+        else:
+            data = np.memmap(data_path, dtype=np.uint8, mode='r')
+        strings[name] = StringTable(data, offsets)
+
+    return (arrays, strings)
+
+
+def _file_path(path: str, generation: str | None, name: str, suffix: str) -> str:
+    """Return the path of the file of the given generation of the snapshot in the directory path that holds
+    name, with the given suffix. Snapshots from before generations have None as theirs.
+    """
+    if generation is None:
+        return os.path.join(path, name + suffix)
+    return os.path.join(path, name + '.' + generation + suffix)
+
+
+def _snapshot_files(path: str, manifest: dict) -> list[str]:
+    """Return the paths of the array and string files of the snapshot in the directory path with the given
+    manifest, of any version.
+    """
+    generation = manifest.get('generation')
+    files = [_file_path(path, generation, name, '.npy') for name in manifest.get('arrays', [])]
+    for name in manifest.get('strings', []):
+        files.append(_file_path(path, generation, name, '.offsets.npy'))
+        files.append(_file_path(path, generation, name, '.strings'))
+    return files
+
+
+def _read_manifest(path: str, any_version: bool = False) -> dict | None:
+    """Return the manifest of the snapshot in the directory path, or None if there is no snapshot of the
+    current version there (or of any version, if any_version is True).
+    """
+    try:
+        with open(os.path.join(path, MANIFEST_FILE)) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(manifest, dict) or (not any_version and manifest.get('version') != SNAPSHOT_VERSION):
+        return None
+    return manifest
+
+
+if __name__ == '__main__':
+    import python_ta
+
+    python_ta.check_all(config={
+        'extra-imports': ['json', 'os', 'numpy'],  # the names (strs) of imported modules
+        'allowed-io': ['write_snapshot', '_map_snapshot', '_read_manifest'],
+        'max-line-length': 120,
+        'max-nested-blocks': 4,
+        'disable': ['E1136', 'W0221']})
@@ -0,0 +1,361 @@
+"""Opt-in timing and counting of the stages of the recommender
+
+The loaders and the recommendation methods mark their stages with stage(name) and report how much work they
+did with count(name, amount). Nothing is recorded until a sink is added with add_sink (or instrumented);
+until then, stage returns a shared context manager that does nothing and count returns immediately, so the
+cost of the instrumentation is one function call per marked stage.
+
+A sink is any object with these two methods:
+    - record_stage(name, seconds), called when a stage ends with the time it took
+    - record_count(name, amount), called for each count
+
+Stages:
+    - load_review_graph, with the nested stages load_review_graph.cuisines, .users, .restaurants,
+      .ratings (parsing the rating file) and .edges (adding the reviews to the graph)
+    - get_similar_users
+    - recommend_restaurants, with the nested stages recommend_restaurants.candidates (ranking users and
+      expanding their reviews into candidates) and recommend_restaurants.averages
+    - get_distance
+
+Counters:
+    - ratings_read: rows of the rating file parsed
+    - users_ranked: users ranked by get_similar_users
+    - users_scanned: similar users whose reviews were expanded into candidates
+    - edges_visited: reviews of at least 4 read from those users
+    - candidates_produced: restaurants recommended
+    - distances_computed: restaurants whose distance was computed by get_distance
+"""
+from __future__ import annotations
+import logging
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from typing import Any, ContextManager, Iterator, Optional
+
+# The upper bounds, in seconds, of the buckets of a HistogramSink, as in the Prometheus client libraries.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+
+# The sinks every stage and count is recorded to. Instrumentation is disabled while this is empty.
+_SINKS = []
+
+# Maps the id of each thread to the names of the stages it is in, from outermost to innermost.
+# Only kept up to date while instrumentation is enabled.
+_ACTIVE_STAGES = {}
+
+# The context manager returned by stage while instrumentation is disabled.
+_NO_STAGE = nullcontext()
+
+
+def add_sink(sink: Any) -> None:
+    """Record every stage and count to sink from now on."""
+    _SINKS.append(sink)
+
+
+def remove_sink(sink: Any) -> None:
+    """Stop recording to sink. Do nothing if it was not added."""
+    if sink in _SINKS:
+        _SINKS.remove(sink)
+
+
+def enabled() -> bool:
+    """Return whether any sink is recording."""
+    return bool(_SINKS)
+
+
+@contextmanager
+def instrumented(*sinks: Any) -> Iterator[None]:
+    """Record every stage and count to the given sinks for the duration of a with statement."""
+    for sink in sinks:
+        add_sink(sink)
+    try:
+        yield
+    finally:
+        for sink in sinks:
+            remove_sink(sink)
+
+
+def stage(name: str) -> ContextManager:
+    """Return a context manager that records the time spent in the stage with the given name."""
+    if not _SINKS:
+        return _NO_STAGE
+    return _Stage(name)
+
+
+def count(name: str, amount: int = 1) -> None:
+    """Add amount to the counter with the given name."""
+    if _SINKS:
+        for sink in list(_SINKS):
+            sink.record_count(name, amount)
+
+
+def active_stages(thread_id: int) -> tuple[str, ...]:
+    """Return the names of the stages the thread with the given id is in, from outermost to innermost."""
+    return tuple(_ACTIVE_STAGES.get(thread_id, ()))
+
+
+class _Stage:
+    """A stage being timed."""
+    __slots__ = ('name', 'start')
+    name: str
+    start: float
+
+    def __init__(self, name: str) -> None:
+        """Initialize a new stage with the given name."""
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> _Stage:
+        """Start timing this stage."""
+        _ACTIVE_STAGES.setdefault(threading.get_ident(), []).append(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        """Record the time spent in this stage."""
+        seconds = time.perf_counter() - self.start
+        stages = _ACTIVE_STAGES.get(threading.get_ident())
+        if stages:
+            stages.pop()
+        for sink in list(_SINKS):
+            sink.record_stage(self.name, seconds)
+
+
+class LogSink:
+    """A sink that logs every stage and count.
+
+    Instance Attributes:
+        - logger: the logger the records are written to
+        - level: the level of the records
+    """
+    logger: logging.Logger
+    level: int
+
+    def __init__(self, logger: Optional[logging.Logger] = None, level: int = logging.DEBUG) -> None:
+        """Initialize a new sink writing to logger, or to the 'recommender' logger if it is None."""
+        self.logger = logger or logging.getLogger('recommender')
+        self.level = level
+
+    def record_stage(self, name: str, seconds: float) -> None:
+        """Log the time spent in a stage."""
+        self.logger.log(self.level, 'stage %s took %.3f ms', name, seconds * 1000)
+
+    def record_count(self, name: str, amount: int) -> None:
+        """Log a count."""
+        self.logger.log(self.level, 'count %s += %d', name, amount)
+
+
+class HistogramSink:
+    """A sink that keeps a histogram of the times of each stage and the total of each counter in memory.
+
+    Instance Attributes:
+        - buckets: the upper bounds of the buckets of every histogram, in seconds
+        - counters: maps each counter name to its total
+
+    Representation Invariants:
+        - self.buckets == sorted(self.buckets)
+    """
+    buckets: tuple[float, ...]
+    counters: dict[str, int]
+
+    # Private Instance Attributes:
+    #     - _histograms:
+    #         Maps each stage name to the number of its times in each bucket, followed by the number of times
+    #         above the last bucket.
+    #     - _sums:
+    #         Maps each stage name to the total time spent in it.
+    #     - _lock:
+    #         Held while recording, since stages may end on several threads at once.
+    _histograms: dict[str, list[int]]
+    _sums: dict[str, float]
+    _lock: threading.Lock
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        """Initialize a new sink with nothing recorded.
+
+        Preconditions:
+        - buckets == tuple(sorted(buckets))
+        """
+        self.buckets = buckets
+        self.counters = {}
+        self._histograms = {}
+        self._sums = {}
+        self._lock = threading.Lock()
+
+    def record_stage(self, name: str, seconds: float) -> None:
+        """Add the time spent in a stage to its histogram."""
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = [0] * (len(self.buckets) + 1)
+                self._sums[name] = 0.0
+            self._histograms[name][bisect_left(self.buckets, seconds)] += 1
+            self._sums[name] += seconds
+
+    def record_count(self, name: str, amount: int) -> None:
+        """Add amount to the total of a counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def stages(self) -> list[str]:
+        """Return the names of the stages recorded, in sorted order."""
+        return sorted(self._histograms)
+
+    def stage_count(self, name: str) -> int:
+        """Return the number of times the stage with the given name was recorded."""
+        return sum(self._histograms.get(name, ()))
+
+    def stage_seconds(self, name: str) -> float:
+        """Return the total time spent in the stage with the given name."""
+        return self._sums.get(name, 0.0)
+
+    def percentile(self, name: str, percent: float) -> float:
+        """Return an upper bound of the given percentile of the times of a stage: the upper bound of the
+        bucket it falls in, or infinity if it is above every bucket.
+
+        Preconditions:
+        - self.stage_count(name) > 0
+        - 0 <= percent <= 100
+        """
+        histogram = self._histograms[name]
+        rank = percent / 100 * sum(histogram)
+        so_far = 0
+        for bound, number in zip(self.buckets, histogram):
+            so_far += number
+            if so_far >= rank and so_far > 0:
+                return bound
+        return float('inf')
+
+    def clear(self) -> None:
+        """Forget everything recorded."""
+        with self._lock:
+            self.counters = {}
+            self._histograms = {}
+            self._sums = {}
+
+    def prometheus_text(self, prefix: str = 'recommender') -> str:
+        """Return everything recorded in the Prometheus text exposition format.
+
+        Stage times are one histogram, <prefix>_stage_seconds, labelled by stage, and every counter is a
+        counter named <prefix>_<name>_total.
+        """
+        with self._lock:
+            lines = [f'# HELP {prefix}_stage_seconds Time spent in each stage of the recommender.',
+                     f'# TYPE {prefix}_stage_seconds histogram']
+            for name in sorted(self._histograms):
+                so_far = 0
+                bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+                for bound, number in zip(bounds, self._histograms[name]):
+                    so_far += number
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {so_far}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {self._sums[name]!r}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {so_far}')
+
+            for name in sorted(self.counters):
+                metric = f'{prefix}_{name}_total'
+                lines.extend([f'# TYPE {metric} counter', f'{metric} {self.counters[name]}'])
+
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """A profiler that samples the call stack of one thread at a fixed interval from a background thread.
+
+    Each sample is labelled with the stages the thread was in, so the time of a slow stage can be broken
+    down by function. While the profiler runs it is also a sink (recording nothing itself), which keeps
+    the stages up to date.
+
+    Instance Attributes:
+        - interval: the number of seconds between samples
+        - samples: maps each sampled stack, from outermost to innermost, to the number of times it was seen.
+          Stages appear as 'stage:<name>' before the functions.
+    """
+    interval: float
+    samples: Counter[tuple[str, ...]]
+
+    # Private Instance Attributes:
+    #     - _thread_id:
+    #         The id of the thread being sampled.
+    #     - _stopped:
+    #         Set to stop sampling.
+    #     - _sampler:
+    #         The background thread taking the samples, while the profiler runs.
+    _thread_id: Optional[int]
+    _stopped: threading.Event
+    _sampler: Optional[threading.Thread]
+
+    def __init__(self, interval: float = 0.005, thread_id: Optional[int] = None) -> None:
+        """Initialize a new profiler of the thread with the given id, or of the thread that starts it.
+
+        Preconditions:
+        - interval > 0
+        """
+        self.interval = interval
+        self.samples = Counter()
+        self._thread_id = thread_id
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    def __enter__(self) -> SamplingProfiler:
+        """Start profiling."""
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        """Stop profiling."""
+        self.stop()
+
+    def start(self) -> None:
+        """Start sampling, if this profiler is not already running."""
+        if self._sampler is None:
+            thread_id = self._thread_id or threading.get_ident()
+            self._stopped.clear()
+            self._sampler = threading.Thread(target=self._sample, args=(thread_id,), daemon=True)
+            add_sink(self)
+            self._sampler.start()
+
+    def stop(self) -> None:
+        """Stop sampling, and wait for the background thread to end."""
+        if self._sampler is not None:
+            self._stopped.set()
+            self._sampler.join()
+            self._sampler = None
+            remove_sink(self)
+
+    def record_stage(self, name: str, seconds: float) -> None:
+        """Do nothing: stages are read from the sampled thread instead."""
+
+    def record_count(self, name: str, amount: int) -> None:
+        """Do nothing."""
+
+    def folded(self) -> str:
+        """Return the samples in the folded format read by flame graph tools: one line per stack, with its
+        frames separated by semicolons, followed by its number of samples.
+        """
+        return ''.join(f"{';'.join(stack)} {number}\n" for stack, number in self.samples.most_common())
+
+    def _sample(self, thread_id: int) -> None:
+        """Sample the stack of the thread with the given id until this profiler is stopped."""
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            functions = []
+            while frame is not None:
+                functions.append(f'{frame.f_code.co_filename.rsplit("/", 1)[-1]}:{frame.f_code.co_name}')
+                frame = frame.f_back
+            stages = tuple('stage:' + name for name in active_stages(thread_id))
+            self.samples[stages + tuple(reversed(functions))] += 1
+
+
+if __name__ == '__main__':
+    import python_ta
+
+    python_ta.check_all(config={
+        'extra-imports': ['logging', 'sys', 'threading', 'time', 'bisect', 'collections', 'contextlib'],
+        'allowed-io': [],  # the names (strs) of functions that call print/open/input
+        'max-line-length': 120,
+        'max-nested-blocks': 4,
+        'disable': ['E1136', 'W0221', 'W0212']})
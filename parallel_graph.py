@@ -0,0 +1,361 @@
+"""Building the review graph and scoring users on several processes
+
+The graph is built in two rounds on a pool of processes. First, the rating file is split into byte ranges,
+and each range is parsed into arrays of user numbers, restaurant numbers and ratings, split into shards by a
+hash of the user_id. Then each shard, which holds every review of its users, is handled by one process: it
+numbers its users, drops repeated reviews and groups the reviews by user into compressed sparse row arrays.
+The parent only numbers the restaurants of each range, and merges the shards' arrays with NumPy into the
+arrays of to_columns, so the graph is built by from_columns without adding vertices and edges one by one.
+
+Batch scoring copies the graph's arrays into shared memory once, and every worker process reads them from
+there instead of receiving its own pickled copy of the graph.
+"""
+from __future__ import annotations
+import csv
+import io
+import os
+import zlib
+from multiprocessing import Pool, shared_memory
+from typing import Any, Iterable, Iterator, Optional
+import numpy as np
+from computation_compiling import add_cuisine
+from csr_graph import CSRWeightedGraph
+from graph_snapshot import StringTable, encode_strings, intern_strings
+from recommender_data import USER_ATTRIBUTES, User, WeightedGraph
+
+# The reviews of one shard of users in a range of the rating file: the user_ids of the shard's users in the
+# range, in order of first appearance, and the position in that list of the user of each review, with its
+# restaurant, rating and row number. Restaurants are numbered by the range's own table until the parent
+# renumbers them, and rows by their position in the range until the parent adds the rows before it.
+Piece = tuple[list[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+# The reviews of one shard of users: the user_ids of its users, the row number of each user's first review,
+# and the compressed sparse row offsets, restaurant numbers, ratings and row numbers of their reviews.
+Shard = tuple[list[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+def load_review_graph_parallel(rating_path: str, user_path: str, restaurant_path: str, cuisine_path: str,
+                               graph_type: type = WeightedGraph, processes: Optional[int] = None) -> list[Any]:
+    """Return the same [graph, users, restaurants] list as load_review_graph on the given files, parsing the
+    rating file and building the reviews of each shard of users on a pool of processes.
+
+    processes is the number of processes to use, and of ranges and shards, or None to use one for each CPU.
+    As in load_review_graph_cached, the returned users and restaurants only include the ones that appear in
+    the graph.
+
+    Preconditions:
+    - processes is None or processes >= 1
+    """
+    processes = processes or os.cpu_count() or 1
+    with open(cuisine_path) as restaurant_cuisine:
+        all_cuisines = add_cuisine(restaurant_cuisine)
+    with open(user_path) as user_data:
+        user_rows = {row[0]: row for row in csv.reader(user_data)}
+    with open(restaurant_path) as restaurant_data:
+        restaurant_rows = {row[0]: row for row in csv.reader(restaurant_data)}
+
+    size = os.path.getsize(rating_path)
+    bounds = [size * i // processes for i in range(processes + 1)]
+    with Pool(processes) as pool:
+        ranges = pool.starmap(_parse_range, [(rating_path, bounds[i], bounds[i + 1], processes)
+                                             for i in range(processes)])
+
+        # The ranges are in file order, so numbering their restaurants in order numbers them by first
+        # appearance. Only the distinct restaurants of each range are numbered here.
+        restaurant_numbers, first_row = {}, 0
+        pieces = [[] for _ in range(processes)]
+        for restaurant_ids, num_rows, range_pieces in ranges:
+            restaurants = np.array([restaurant_numbers.setdefault(restaurant_id, len(restaurant_numbers))
+                                    for restaurant_id in restaurant_ids], dtype=np.int32)
+            for shard, (user_ids, user_codes, restaurant_codes, ratings, rows) in enumerate(range_pieces):
+                pieces[shard].append((user_ids, user_codes, restaurants[restaurant_codes], ratings, rows + first_row))
+            first_row += num_rows
+
+        shards = pool.starmap(_build_shard, [(shard_pieces, len(restaurant_numbers)) for shard_pieces in pieces])
+
+    user_ids = [user_id for shard in shards for user_id in shard[0]]
+    arrays = _merge_shards(shards, len(restaurant_numbers))
+    user_ids = [user_ids[i] for i in arrays.pop('user_order')]
+    vertex_arrays, strings = _vertex_columns([user_rows[user_id] for user_id in user_ids],
+                                             [restaurant_rows[restaurant_id] for restaurant_id in restaurant_numbers],
+                                             all_cuisines)
+    arrays.update(vertex_arrays)
+    review_graph = graph_type.from_columns(arrays, strings)
+
+    user_dictionary = {user.user_id: user for user in review_graph.get_all_items('user')}
+    restaurant_dictionary = {restaurant.restaurant_id: restaurant
+                             for restaurant in review_graph.get_all_items('restaurant')}
+    return [review_graph, user_dictionary, restaurant_dictionary]
+
+
+def recommend_restaurants_parallel(review_graph: Any, users: Iterable[User], limit: int, distances: dict,
+                                   max_users: Optional[int] = None, max_distance: Optional[float] = None,
+                                   processes: Optional[int] = None) -> (
+        Iterator[tuple[str, dict[str, tuple[float, float, tuple[str, ...]]]]]):
+    """Yield (user_id, recommended restaurants) for each user in users, in order, as
+    computation_compiling.recommend_restaurants_batch does, scoring the different preference_lsts on a pool of
+    processes that share one copy of the graph.
+
+    users is read in full before any recommendations are yielded.
+
+    Preconditions:
+    - distances != {}
+    - limit >= 1
+    - max_users is None or max_users >= 0
+    - max_distance is None or max_distance >= 0
+    - processes is None or processes >= 1
+    """
+    users = list(users)
+    profiles = {}
+    for user in users:
+        profiles.setdefault(tuple(user.preference_lst()), user)
+
+    with SharedGraph(review_graph) as shared, \
+            Pool(processes, _attach_worker, (shared.spec, distances, limit, max_users, max_distance)) as pool:
+        results = dict(zip(profiles, pool.map(_recommend, profiles.values())))
+
+    for user in users:
+        yield (user.user_id, dict(results[tuple(user.preference_lst())]))
+
+
+class SharedGraph:
+    """A copy of the arrays and string tables of a review graph in shared memory.
+
+    Other processes can build a CSRWeightedGraph on the same memory with attach_graph(spec), without copying
+    it. The shared memory is released by close, or at the end of a with statement.
+
+    Instance Attributes:
+        - spec: maps each array name to its (shared memory name, dtype, shape), and each string table name
+          to the specs of its bytes and offsets
+    """
+    spec: dict[str, Any]
+
+    # Private Instance Attributes:
+    #     - _blocks:
+    #         The shared memory blocks holding the arrays.
+    _blocks: list[shared_memory.SharedMemory]
+
+    def __init__(self, graph: Any) -> None:
+        """Copy the arrays of graph, a WeightedGraph or CSRWeightedGraph, into shared memory."""
+        self._blocks = []
+        arrays, strings = graph.to_columns()
+        self.spec = {'arrays': {name: self._share(array) for name, array in arrays.items()},
+                     'strings': {name: tuple(self._share(array) for array in encode_strings(values))
+                                 for name, values in strings.items()}}
+
+    def __enter__(self) -> SharedGraph:
+        """Return this shared graph."""
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        """Release the shared memory."""
+        self.close()
+
+    def close(self) -> None:
+        """Release the shared memory. Graphs attached to it must not be used afterwards."""
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def _share(self, array: np.ndarray) -> tuple[str, str, tuple[int, ...]]:
+        """Copy array into a new shared memory block, and return its (shared memory name, dtype, shape)."""
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self._blocks.append(block)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        return (block.name, array.dtype.str, array.shape)
+
+
+def attach_graph(spec: dict[str, Any]) -> tuple[CSRWeightedGraph, list[shared_memory.SharedMemory]]:
+    """Return a CSRWeightedGraph on the shared memory described by spec, the spec of a SharedGraph, together
+    with the shared memory blocks it uses.
+
+    The blocks must be kept until the graph is no longer used, and then closed.
+    """
+    blocks = []
+
+    def attach(array_spec: tuple[str, str, tuple[int, ...]]) -> np.ndarray:
+        name, dtype, shape = array_spec
+        blocks.append(shared_memory.SharedMemory(name=name))
+        array = np.ndarray(shape, dtype=dtype, buffer=blocks[-1].buf)
+        array.flags.writeable = False
+        return array
+
+    arrays = {name: attach(array_spec) for name, array_spec in spec['arrays'].items()}
+    strings = {name: StringTable(attach(data), attach(offsets)) for name, (data, offsets) in spec['strings'].items()}
+    return (CSRWeightedGraph.from_columns(arrays, strings), blocks)
+
+
+def _parse_range(rating_path: str, start: int, end: int, num_shards: int) -> (
+        tuple[list[str], int, list[Piece]]):
+    """Return the restaurant_ids of the rows of rating_path that start in the bytes from start to end
+    (exclusive), in order of first appearance, the number of those rows, and their reviews split into
+    num_shards shards by a hash of their user_id.
+    """
+    with open(rating_path, 'rb') as file:
+        if start > 0:
+            # Skip the end of the row that started in the previous range.
+            file.seek(start - 1)
+            file.readline()
+        data = file.read(max(end - file.tell(), 0))
+        if data and not data.endswith(b'\n'):
+            # Finish the last row, which started in this range.
+            data += file.readline()
+
+    user_numbers, restaurant_numbers = {}, {}
+    user_codes, restaurant_codes, ratings = [], [], []
+    for row in csv.reader(io.StringIO(data.decode('utf-8'))):
+        user_codes.append(user_numbers.setdefault(row[0], len(user_numbers)))
+        restaurant_codes.append(restaurant_numbers.setdefault(row[1], len(restaurant_numbers)))
+        ratings.append(int(row[2]))
+    user_codes = np.array(user_codes, dtype=np.int32)
+    restaurant_codes = np.array(restaurant_codes, dtype=np.int32)
+    ratings = np.array(ratings, dtype=np.int32)
+
+    user_ids = list(user_numbers)
+    user_shards = np.array([zlib.crc32(user_id.encode('utf-8')) % num_shards for user_id in user_ids],
+                           dtype=np.int64)
+    users_by_shard = np.argsort(user_shards, kind='stable')
+    user_bounds = _offsets(user_shards, num_shards)
+    shard_codes = np.empty(len(user_ids), dtype=np.int32)
+    shard_codes[users_by_shard] = np.arange(len(user_ids)) - user_bounds[user_shards[users_by_shard]]
+
+    row_shards = user_shards[user_codes]
+    rows_by_shard = np.argsort(row_shards, kind='stable')
+    row_bounds = _offsets(row_shards, num_shards)
+    pieces = []
+    for shard in range(num_shards):
+        rows = rows_by_shard[row_bounds[shard]:row_bounds[shard + 1]]
+        pieces.append(([user_ids[i] for i in users_by_shard[user_bounds[shard]:user_bounds[shard + 1]]],
+                       shard_codes[user_codes[rows]], restaurant_codes[rows], ratings[rows], rows.astype(np.int64)))
+    return (list(restaurant_numbers), len(ratings), pieces)
+
+
+def _build_shard(pieces: list[Piece], num_restaurants: int) -> Shard:
+    """Return the users and reviews of one shard, given its pieces of every range in file order, with
+    restaurants and rows numbered across the whole file.
+
+    Users are numbered by first appearance. As in load_review_graph, a repeated review keeps the position of
+    the first and the rating of the last. Each user's reviews are in file order.
+    """
+    user_numbers = {}
+    users, restaurants, ratings, rows = [], [], [], []
+    for user_ids, user_codes, piece_restaurants, piece_ratings, piece_rows in pieces:
+        numbers = np.array([user_numbers.setdefault(user_id, len(user_numbers)) for user_id in user_ids],
+                           dtype=np.int32)
+        users.append(numbers[user_codes])
+        restaurants.append(piece_restaurants)
+        ratings.append(piece_ratings)
+        rows.append(piece_rows)
+    users, restaurants = np.concatenate(users), np.concatenate(restaurants)
+    ratings, rows = np.concatenate(ratings), np.concatenate(rows)
+    first_rows = rows[np.unique(users, return_index=True)[1]]
+
+    keys = users.astype(np.int64) * num_restaurants + restaurants
+    order = np.argsort(keys, kind='stable')
+    starts = np.flatnonzero(np.diff(keys[order], prepend=-1))
+    ends = np.append(starts[1:], len(keys))[:len(starts)] - 1
+    by_row = np.argsort(order[starts])
+    firsts, lasts = order[starts][by_row], order[ends][by_row]
+
+    edge_users = users[firsts]
+    by_user = np.argsort(edge_users, kind='stable')
+    return (list(user_numbers), first_rows, _offsets(edge_users, len(user_numbers)), restaurants[firsts][by_user],
+            ratings[lasts][by_user], rows[firsts][by_user])
+
+
+def _merge_shards(shards: list[Shard], num_restaurants: int) -> dict[str, np.ndarray]:
+    """Return the vertex_kinds array and the arrays of the edges of to_columns for the reviews of shards,
+    with a user_order array giving the position of each user, in order, among the users of all shards.
+
+    Users are numbered by first appearance, and every vertex is added at its first review, the user before
+    the restaurant, as in load_review_graph. Each restaurant's reviews are in file order.
+    """
+    first_rows = np.concatenate([shard[1] for shard in shards])
+    counts = np.concatenate([np.diff(shard[2]) for shard in shards])
+    restaurants = np.concatenate([shard[3] for shard in shards])
+    ratings = np.concatenate([shard[4] for shard in shards])
+    rows = np.concatenate([shard[5] for shard in shards])
+    num_users = len(first_rows)
+
+    user_order = np.argsort(first_rows)
+    user_numbers = np.empty(num_users, dtype=np.int32)
+    user_numbers[user_order] = np.arange(num_users)
+    arrays = {'user_order': user_order}
+
+    # Each user's reviews are one block of the shards' arrays, so the blocks are moved into user order.
+    starts = np.zeros(num_users + 1, dtype=np.int64)
+    np.cumsum(counts, out=starts[1:])
+    arrays['user_offsets'] = np.zeros(num_users + 1, dtype=np.int64)
+    np.cumsum(counts[user_order], out=arrays['user_offsets'][1:])
+    blocks = np.repeat(starts[user_order] - arrays['user_offsets'][:-1], counts[user_order]) + np.arange(len(rows))
+    arrays['user_neighbours'] = restaurants[blocks]
+    arrays['user_ratings'] = ratings[blocks]
+
+    edge_users = np.repeat(user_numbers, counts)
+    by_restaurant = np.lexsort((rows, restaurants))
+    arrays['restaurant_offsets'] = _offsets(restaurants, num_restaurants)
+    arrays['restaurant_neighbours'] = edge_users[by_restaurant]
+    arrays['restaurant_ratings'] = ratings[by_restaurant]
+
+    restaurant_first_rows = np.full(num_restaurants, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(restaurant_first_rows, restaurants, rows)
+    first_reviews = np.concatenate([first_rows[user_order] * 2, restaurant_first_rows * 2 + 1])
+    arrays['vertex_kinds'] = (np.argsort(first_reviews) >= num_users).astype(np.int8)
+    return arrays
+
+
+def _vertex_columns(user_rows: list[list[str]], restaurant_rows: list[list[str]],
+                    all_cuisines: dict[str, tuple[str, ...]]) -> tuple[dict[str, np.ndarray], dict[str, list[str]]]:
+    """Return the to_columns arrays and string tables of the users and restaurants in the given rows of the
+    user and restaurant csv files, without the vertex_kinds array and the arrays of the edges.
+    """
+    arrays = {}
+    strings = {'user_ids': [row[0] for row in user_rows],
+               'restaurant_ids': [row[0] for row in restaurant_rows],
+               'restaurant_names': [row[1] for row in restaurant_rows]}
+    for column, attribute in enumerate(USER_ATTRIBUTES, 1):
+        strings['user_' + attribute + '_values'], arrays['user_' + attribute] = intern_strings(
+            row[column] for row in user_rows)
+    strings['postal_codes'], arrays['restaurant_postal_codes'] = intern_strings(row[2] for row in restaurant_rows)
+    cuisines = [all_cuisines.get(row[0], ()) for row in restaurant_rows]
+    strings['cuisines'], arrays['cuisine_codes'] = intern_strings(
+        cuisine for restaurant_cuisines in cuisines for cuisine in restaurant_cuisines)
+    arrays['cuisine_offsets'] = np.zeros(len(restaurant_rows) + 1, dtype=np.int64)
+    np.cumsum([len(restaurant_cuisines) for restaurant_cuisines in cuisines], out=arrays['cuisine_offsets'][1:])
+    return (arrays, strings)
+
+
+def _offsets(rows: np.ndarray, num_rows: int) -> np.ndarray:
+    """Return the compressed sparse row offsets of the given row numbers."""
+    offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_rows), out=offsets[1:])
+    return offsets
+
+
+# The state of a scoring worker process, set by _attach_worker.
+_WORKER = {}
+
+
+def _attach_worker(spec: dict[str, Any], distances: dict, limit: int, max_users: Optional[int],
+                   max_distance: Optional[float]) -> None:
+    """Attach this worker process to the shared graph with the given spec, and keep the scoring arguments."""
+    graph, blocks = attach_graph(spec)
+    _WORKER.update(graph=graph, blocks=blocks, arguments=(limit, {}, distances, max_users, max_distance))
+
+
+def _recommend(user: User) -> dict[str, tuple[float, float, tuple[str, ...]]]:
+    """Return the recommended restaurants for user from this worker's shared graph."""
+    return _WORKER['graph'].recommend_restaurants(user, *_WORKER['arguments'])
+
+
+if __name__ == '__main__':
+    import python_ta
+
+    python_ta.check_all(config={
+        'extra-imports': ['csv', 'io', 'os', 'zlib', 'multiprocessing', 'numpy', 'computation_compiling', 'csr_graph',
+                          'graph_snapshot', 'recommender_data'],
+        'allowed-io': ['load_review_graph_parallel', '_parse_range'],
+        'max-line-length': 120,
+        'max-nested-blocks': 4,
+        'disable': ['E1136', 'W0221']})
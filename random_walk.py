@@ -0,0 +1,275 @@
+"""A personalized PageRank engine that ranks restaurants by random walks with restart
+
+The profile-matching engine of WeightedGraph.recommend_restaurants only looks one hop out from the users
+with the closest preferences. This engine walks the whole bipartite review graph instead: a walk starts at
+one of those seed users, moves to a restaurant the user rated (with probability proportional to the
+rating), then to a user who rated that restaurant, and so on, going back to a seed user with probability
+restart at every step. Restaurants are ranked by the probability of the walk being at them, their
+personalized PageRank, so restaurants close to the seed users through many well rated paths come first.
+
+The scores are computed in one of two ways:
+    - 'power': power iteration with the sparse transition matrices, until the scores change by less than
+      tolerance or max_iterations iterations are done
+    - 'monte_carlo': simulating walks walks, each at most max_iterations steps long, and counting the
+      visits to each restaurant
+
+Either way, a computation stops early once time_budget seconds have passed, and ranks restaurants by the
+scores so far. Rankings are computed once per preference profile for each set of transition matrices, and
+precompute computes all 162 profiles (in batches, for power iteration). A ranking cut short by time_budget
+is only used for the request that computed it, and computed again by the next one, so it never replaces
+the complete ranking for good.
+
+PersonalizedPageRank is a collaborative_filtering.MatrixRecommender, like CollaborativeRecommender: the
+matrices are built by refresh or refresh_in_background, requests are answered from the last ones built until
+new ones replace them, and it can be used wherever CollaborativeRecommender can.
+"""
+from __future__ import annotations
+import time
+from typing import Any, Optional
+import numpy as np
+from scipy import sparse
+from collaborative_filtering import MatrixRecommender, RecommenderMatrices
+from recommender_data import User
+
+# The number of profiles whose scores are computed by one batch of power iterations. Each profile needs a
+# dense row of scores for every user and restaurant, so this bounds that memory.
+PROFILE_BATCH_SIZE = 8
+
+# The number of walks simulated at once by the Monte-Carlo method. The time budget is checked after every
+# step of a batch, so a smaller batch overruns it by less.
+WALK_BATCH_SIZE = 16384
+
+
+class PersonalizedPageRank(MatrixRecommender):
+    """Recommendations ranked by personalized PageRank from the users with the closest preferences.
+
+    Walks restart at the users most similar to the program user, and only restaurants reached by a walk are
+    recommended.
+
+    Instance Attributes:
+        - graph: the WeightedGraph or CSRWeightedGraph the ratings come from
+        - method: 'power' or 'monte_carlo', as described in the module
+        - restart: the probability of a walk going back to a seed user at each step
+        - max_iterations: the most power iterations, or the most steps of a walk
+        - tolerance: power iteration stops once the scores of every profile change by less than this in
+          total from one iteration to the next
+        - walks: the number of walks simulated for each profile by the Monte-Carlo method
+        - time_budget: the most seconds one computation of scores may take, or None for no limit
+        - random_seed: the seed of the walks, so the same graph always gives the same rankings
+
+    Representation Invariants:
+        - self.method in {'power', 'monte_carlo'}
+        - 0 < self.restart <= 1
+        - self.max_iterations >= 1
+        - self.tolerance >= 0
+        - self.walks >= 1
+        - self.time_budget is None or self.time_budget > 0
+    """
+    method: str
+    restart: float
+    max_iterations: int
+    tolerance: float
+    walks: int
+    time_budget: Optional[float]
+    random_seed: int
+
+    def __init__(self, graph: Any, method: str = 'power', restart: float = 0.15, max_iterations: int = 50,
+                 tolerance: float = 1e-6, walks: int = 100000, time_budget: Optional[float] = None,
+                 random_seed: int = 0) -> None:
+        """Initialize a new engine for graph. Nothing is computed until it is first needed, or refresh is called.
+
+        Preconditions:
+        - method in {'power', 'monte_carlo'}
+        - 0 < restart <= 1
+        - max_iterations >= 1
+        - tolerance >= 0
+        - walks >= 1
+        - time_budget is None or time_budget > 0
+        """
+        super().__init__(graph, PROFILE_BATCH_SIZE)
+        self.method = method
+        self.restart = restart
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.walks = walks
+        self.time_budget = time_budget
+        self.random_seed = random_seed
+
+    def _build_matrices(self, version: int, arrays: dict[str, np.ndarray], strings: dict[str, Any]) -> _Matrices:
+        """Return the transition matrices of the to_columns arrays and string tables of the given version of
+        the graph.
+        """
+        shape = (len(strings['user_ids']), len(strings['restaurant_ids']))
+        ratings = sparse.csr_matrix((np.asarray(arrays['user_ratings'], dtype=np.float64),
+                                     np.asarray(arrays['user_neighbours'], dtype=np.int64),
+                                     np.asarray(arrays['user_offsets'], dtype=np.int64)), shape=shape)
+        ratings.sort_indices()
+        return _Matrices(version, list(strings['user_ids']), list(strings['restaurant_ids']), ratings)
+
+    def _rank_profiles(self, matrices: _Matrices, program_users: list[User], num_seeds: int) -> (
+            list[tuple[np.ndarray, bool]]):
+        """Return, for each user in program_users, the restaurant columns with a score ordered from the
+        highest score to the lowest, and whether the computation of the scores finished within time_budget.
+        """
+        seeds = np.zeros((len(program_users), len(matrices.user_rows)))
+        for i, user in enumerate(program_users):
+            rows = self._seed_rows(matrices, user, num_seeds)
+            seeds[i, rows] = 1 / max(len(rows), 1)
+
+        if self.method == 'power':
+            scores, finished = self._power_iteration(matrices, seeds)
+            results = [(row, finished) for row in scores]
+        else:
+            results = [self._monte_carlo(matrices, row, tuple(user.preference_lst()))
+                       for row, user in zip(seeds, program_users)]
+
+        rankings = []
+        for row, finished in results:
+            order = np.argsort(-row, kind='stable')
+            rankings.append((order[row[order] > 0], finished))
+        return rankings
+
+    def _power_iteration(self, matrices: _Matrices, seeds: np.ndarray) -> tuple[np.ndarray, bool]:
+        """Return the scores of every restaurant of matrices for each row of seeds, a probability distribution
+        over the users, by power iteration, and whether the iterations finished (by converging or reaching
+        max_iterations) before the deadline of time_budget stopped them.
+
+        The probability at users with no positive rating, where a walk cannot continue, goes back to the
+        seed users, so the scores of each row always add up to 1 with those of the users.
+        """
+        deadline = None if self.time_budget is None else time.perf_counter() + self.time_budget
+        stuck_users = np.asarray(matrices.to_restaurants.sum(axis=1)).ravel() == 0
+        stuck_restaurants = np.asarray(matrices.to_users.sum(axis=1)).ravel() == 0
+        at_users = seeds.copy()
+        at_restaurants = np.zeros((len(seeds), len(matrices.restaurant_ids)))
+
+        for i in range(self.max_iterations):
+            stuck = at_users[:, stuck_users].sum(axis=1) + at_restaurants[:, stuck_restaurants].sum(axis=1)
+            next_restaurants = (1 - self.restart) * np.asarray(at_users @ matrices.to_restaurants)
+            next_users = (1 - self.restart) * np.asarray(at_restaurants @ matrices.to_users) \
+                + (self.restart + (1 - self.restart) * stuck)[:, None] * seeds
+            change = np.abs(next_users - at_users).sum(axis=1) + np.abs(next_restaurants - at_restaurants).sum(axis=1)
+            at_users, at_restaurants = next_users, next_restaurants
+            if change.max(initial=0) < self.tolerance:
+                return at_restaurants, True
+            if deadline is not None and time.perf_counter() > deadline:
+                return at_restaurants, i == self.max_iterations - 1
+
+        return at_restaurants, True
+
+    def _monte_carlo(self, matrices: _Matrices, seeds: np.ndarray, scores: tuple[int, ...]) -> (
+            tuple[np.ndarray, bool]):
+        """Return the number of visits to every restaurant of matrices of the walks restarting at seeds, a
+        probability distribution over the users, and whether every walk finished before the deadline of
+        time_budget stopped them.
+
+        The walks of a profile always use the same random numbers, seeded by random_seed and the profile
+        scores. The deadline of time_budget is checked after every step of the walks, so a computation
+        overruns it by at most one step of one batch.
+        """
+        deadline = None if self.time_budget is None else time.perf_counter() + self.time_budget
+        rng = np.random.default_rng([self.random_seed, *scores])
+        seed_rows = np.flatnonzero(seeds)
+        visits = np.zeros(len(matrices.restaurant_ids))
+        if len(seed_rows) == 0:
+            return visits, True
+
+        remaining = self.walks
+        while remaining > 0:
+            if deadline is not None and time.perf_counter() > deadline:
+                return visits, False
+            batch = min(remaining, WALK_BATCH_SIZE)
+            users = rng.choice(seed_rows, batch, p=seeds[seed_rows])
+            for _ in range(self.max_iterations):
+                users = users[rng.random(len(users)) >= self.restart]
+                restaurants = _sample_neighbours(rng, matrices.ratings, matrices.rating_prefixes, users)
+                visits += np.bincount(restaurants, minlength=len(visits))
+                restaurants = restaurants[rng.random(len(restaurants)) >= self.restart]
+                users = _sample_neighbours(rng, matrices.ratings_by_restaurant, matrices.rating_prefixes_by_restaurant,
+                                           restaurants)
+                if len(users) == 0:
+                    break
+                if deadline is not None and time.perf_counter() > deadline:
+                    return visits, False
+            remaining -= batch
+
+        return visits, True
+
+
+class _Matrices(RecommenderMatrices):
+    """The transition matrices a PersonalizedPageRank answers requests from, built from one version of its graph.
+
+    Instance Attributes:
+        - version: the version of the graph the matrices were built from
+        - user_rows: maps each user_id to its row in the matrices
+        - restaurant_ids: the restaurant_id of each column in the matrices
+        - ratings, ratings_by_restaurant: the users x restaurants matrix of ratings and its transpose, which
+          the walks sample from
+        - rating_prefixes, rating_prefixes_by_restaurant: the sums of the first i values in the data of
+          ratings and ratings_by_restaurant, for every i
+        - to_restaurants: the users x restaurants transition matrix: row i holds the probability of a walk
+          at user i moving to each restaurant, proportional to the user's ratings. Rows of users whose
+          ratings are all 0 are empty.
+        - to_users: the restaurants x users transition matrix, in the same way
+        - cuisine_index: the restaurants serving each cuisine, by column
+        - rankings: maps each (preference_lst tuple, number of seed users) to the restaurant columns with a
+          score, ordered from the highest score to the lowest
+    """
+    __slots__ = ('ratings', 'ratings_by_restaurant', 'rating_prefixes', 'rating_prefixes_by_restaurant',
+                 'to_restaurants', 'to_users')
+    ratings: sparse.csr_matrix
+    ratings_by_restaurant: sparse.csr_matrix
+    rating_prefixes: np.ndarray
+    rating_prefixes_by_restaurant: np.ndarray
+    to_restaurants: sparse.csr_matrix
+    to_users: sparse.csr_matrix
+
+    def __init__(self, version: int, user_ids: list[str], restaurant_ids: list[str],
+                 ratings: sparse.csr_matrix) -> None:
+        """Initialize the matrices of the given users x restaurants matrix of ratings, with sorted indices,
+        and no rankings yet.
+        """
+        super().__init__(version, user_ids, restaurant_ids)
+        self.ratings = ratings
+        self.ratings_by_restaurant = ratings.T.tocsr()
+        self.ratings_by_restaurant.sort_indices()
+        self.rating_prefixes = np.concatenate([[0.0], np.cumsum(ratings.data)])
+        self.rating_prefixes_by_restaurant = np.concatenate([[0.0], np.cumsum(self.ratings_by_restaurant.data)])
+        self.to_restaurants = _normalize_rows(ratings)
+        self.to_users = _normalize_rows(self.ratings_by_restaurant)
+
+
+def _normalize_rows(matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+    """Return matrix with each row divided by its sum, leaving the rows that add up to 0 empty."""
+    sums = np.asarray(matrix.sum(axis=1)).ravel()
+    scale = np.divide(1, sums, out=np.zeros_like(sums), where=sums > 0)
+    return (sparse.diags(scale) @ matrix).tocsr()
+
+
+def _sample_neighbours(rng: np.random.Generator, weights: sparse.csr_matrix, prefix: np.ndarray,
+                       rows: np.ndarray) -> np.ndarray:
+    """Return one column for each of the given rows of weights, chosen with probability proportional to its
+    weight. Rows whose weights add up to 0 are left out.
+
+    prefix holds the sums of the first i values of weights.data, for every i, so each call takes time in
+    proportion to the number of rows rather than to the size of weights.
+    """
+    starts, ends = weights.indptr[rows], weights.indptr[rows + 1]
+    totals = prefix[ends] - prefix[starts]
+    has_weight = totals > 0
+    starts, ends, totals = starts[has_weight], ends[has_weight], totals[has_weight]
+    targets = prefix[starts] + rng.random(len(starts)) * totals
+    positions = np.clip(np.searchsorted(prefix, targets, side='right') - 1, starts, ends - 1)
+    return weights.indices[positions]
+
+
+if __name__ == '__main__':
+    import python_ta
+
+    python_ta.check_all(config={
+        # the names (strs) of imported modules
+        'extra-imports': ['time', 'numpy', 'scipy', 'collaborative_filtering', 'recommender_data'],
+        'allowed-io': [],  # the names (strs) of functions that call print/open/input
+        'max-line-length': 120,
+        'max-nested-blocks': 4,
+        'disable': ['E1136', 'W0221']})
@@ -0,0 +1,316 @@
+"""A long-running HTTP/JSON service for restaurant recommendations and distances
+
+The review graph is loaded once, and requests are answered by a CachedRecommender. Scoring runs on a single
+worker thread, so the event loop keeps accepting and answering other connections while it runs, and identical
+requests that arrive while one is being scored all wait for that one result. The graph can be reloaded while
+the service is running: requests already being scored finish on the old graph, and later requests use the new
+one.
+
+Endpoints:
+    - GET /recommendations?smoker=...&drink_level=...&dress_preference=...&ambience=...&budget=...
+      &postal_code=...&limit=...[&max_users=...][&max_distance=...][&cuisines=...][&exclude_cuisines=...]
+      cuisines and exclude_cuisines are comma-separated lists of cuisines, such as Sushi,Japanese.
+      The same parameters can also be POSTed as a JSON object.
+    - GET /distances?postal_code=...
+    - POST /reload
+    - GET /health
+"""
+from __future__ import annotations
+import asyncio
+import json
+import signal
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Callable, Hashable, Optional, Union
+from urllib.parse import parse_qsl, urlsplit
+from computation_compiling import load_geocoder_cached, load_review_graph_cached
+from geospatial import FSATable, PostalGeocoder
+from recommender_data import USER_ATTRIBUTES, User
+from result_cache import CachedRecommender
+
+# The largest request body accepted, in bytes.
+MAX_BODY_SIZE = 65536
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class RequestError(Exception):
+    """An error in a request, answered with the given HTTP status and message."""
+    status: int
+
+    def __init__(self, status: int, message: str) -> None:
+        """Initialize a new error with the given status and message."""
+        super().__init__(message)
+        self.status = status
+
+
+def load_data_files() -> tuple[Any, dict, PostalGeocoder]:
+    """Return the review graph, its restaurants and the postal code geocoder from the files in Data Files, as
+    main.py loads them.
+    """
+    data_lst = load_review_graph_cached("Data Files/review_graph_snapshot", "Data Files/rating_final_edited.csv",
+                                        "Data Files/userprofile_new.csv", "Data Files/restaurant_data.csv",
+                                        "Data Files/restaurant_cuisine.csv")
+    geocoder = load_geocoder_cached("Data Files/geocoder_index", "Data Files/Geospatial_Coordinates.csv")
+    return (data_lst[0], data_lst[2], geocoder)
+
+
+class RecommendationService:
+    """The state of a running recommendation service.
+
+    Instance Attributes:
+        - recommender: answers the requests, from the graph that was last loaded
+        - generation: the number of times the graph has been loaded
+        - requests: the number of requests answered
+        - coalesced: the number of requests answered by waiting for an identical request
+    """
+    recommender: Optional[CachedRecommender]
+    generation: int
+    requests: int
+    coalesced: int
+
+    # Private Instance Attributes:
+    #     - _loader:
+    #         Returns the review graph, its restaurants and the FSA table or postal code geocoder. Called on a
+    #         separate thread.
+    #     - _executor:
+    #         Runs every recommendation and distance computation, one at a time.
+    #     - _in_flight:
+    #         Maps the key of each request being computed to the future of its result.
+    #     - _reloading:
+    #         The reload in progress, if any.
+    _loader: Callable[[], tuple[Any, dict, Union[FSATable, PostalGeocoder]]]
+    _executor: Executor
+    _in_flight: dict[Hashable, asyncio.Future]
+    _reloading: Optional[asyncio.Future]
+
+    def __init__(self, loader: Callable[[], tuple[Any, dict, Union[FSATable, PostalGeocoder]]] = load_data_files,
+                 executor: Optional[Executor] = None) -> None:
+        """Initialize a new service that loads its data with loader. Nothing is loaded until reload is called.
+
+        executor runs the computations, and must run at most one at a time, since the graph and caches are
+        not thread safe. By default it is a new single-threaded executor.
+        """
+        self.recommender = None
+        self.generation = 0
+        self.requests = 0
+        self.coalesced = 0
+        self._loader = loader
+        self._executor = executor or ThreadPoolExecutor(max_workers=1)
+        self._in_flight = {}
+        self._reloading = None
+
+    async def reload(self) -> None:
+        """Load the data again on a separate thread, and answer later requests from it.
+
+        A reload requested while another one is in progress waits for that one instead of starting another.
+        """
+        if self._reloading is None:
+            self._reloading = asyncio.ensure_future(self._reload())
+            self._reloading.add_done_callback(lambda _: setattr(self, '_reloading', None))
+        await asyncio.shield(self._reloading)
+
+    async def handle(self, method: str, target: str, body: bytes) -> dict[str, Any]:
+        """Return the JSON response to the request with the given method, target and body.
+
+        Raise a RequestError if the request cannot be answered.
+        """
+        url = urlsplit(target)
+        parameters = dict(parse_qsl(url.query))
+        if method == 'POST' and body:
+            try:
+                parameters.update({key: str(value) for key, value in json.loads(body).items()})
+            except (ValueError, AttributeError) as error:
+                raise RequestError(400, 'the body must be a JSON object') from error
+
+        routes = {'/recommendations': ({'GET', 'POST'}, self._recommendations),
+                  '/distances': ({'GET', 'POST'}, self._distances),
+                  '/reload': ({'POST'}, self._reload_endpoint),
+                  '/health': ({'GET'}, self._health)}
+        if url.path not in routes:
+            raise RequestError(404, 'no such endpoint')
+        methods, endpoint = routes[url.path]
+        if method not in methods:
+            raise RequestError(405, 'use ' + ' or '.join(sorted(methods)))
+
+        self.requests += 1
+        return await endpoint(parameters)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Answer the HTTP/1.1 requests on one connection, until the client closes it or asks to."""
+        try:
+            keep_alive = True
+            while keep_alive:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                line = await reader.readline()
+                while line.strip():
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                    line = await reader.readline()
+
+                parts = request_line.decode('latin-1').split()
+                keep_alive = parts[-1:] == ['HTTP/1.1'] and headers.get('connection', '').lower() != 'close'
+                try:
+                    if len(parts) != 3:
+                        raise RequestError(400, 'malformed request line')
+                    length = int(headers.get('content-length', 0))
+                    if length > MAX_BODY_SIZE:
+                        keep_alive = False
+                        raise RequestError(413, 'the body is too large')
+                    body = await reader.readexactly(length)
+                    status, response = 200, await self.handle(parts[0], parts[1], body)
+                except RequestError as error:
+                    status, response = error.status, {'error': str(error)}
+                except ValueError:
+                    status, response = 400, {'error': 'malformed request'}
+
+                _write_response(writer, status, response, keep_alive)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _reload(self) -> None:
+        """Load the data on a separate thread, and replace the recommender once it is loaded."""
+        graph, restaurants, fsa_table = await asyncio.get_running_loop().run_in_executor(None, self._loader)
+        self.recommender = CachedRecommender(graph, fsa_table, restaurants)
+        self.generation += 1
+
+    async def _compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """Return compute() computed on the executor, or the result of the identical computation with the
+        given key if one is already in progress.
+        """
+        key = (self.generation, key)
+        if key in self._in_flight:
+            self.coalesced += 1
+        else:
+            future = asyncio.get_running_loop().run_in_executor(self._executor, compute)
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(self._in_flight[key])
+
+    async def _recommendations(self, parameters: dict[str, str]) -> dict[str, Any]:
+        """Return the recommended restaurants for the user described by parameters."""
+        recommender = self._get_recommender()
+        missing = [name for name in USER_ATTRIBUTES + ('postal_code', 'limit') if name not in parameters]
+        if missing:
+            raise RequestError(400, 'missing ' + ', '.join(missing))
+        user = User('U2000', *(parameters[attribute] for attribute in USER_ATTRIBUTES))
+        location = self._location(parameters)
+        limit = _number(parameters, 'limit', int)
+        max_users = _number(parameters, 'max_users', int)
+        max_distance = _number(parameters, 'max_distance', float)
+        if limit is None or limit < 1 or (max_users or 0) < 0 or (max_distance or 0) < 0:
+            raise RequestError(400, 'limit must be at least 1, and max_users and max_distance at least 0')
+
+        include, exclude = _cuisines(parameters, 'cuisines'), _cuisines(parameters, 'exclude_cuisines')
+
+        key = ('recommendations', tuple(user.preference_lst()), location, limit, max_users, max_distance, include,
+               exclude)
+        recommendations = await self._compute(key, lambda: recommender.recommend(
+            user, location, limit, max_users, max_distance, include, exclude))
+        return {'restaurants': [{'name': name, 'rating': rating, 'distance': distance, 'cuisine': list(cuisine)}
+                                for name, (rating, distance, cuisine) in recommendations.items()]}
+
+    async def _distances(self, parameters: dict[str, str]) -> dict[str, Any]:
+        """Return the distance to every restaurant from the postal code in parameters."""
+        recommender = self._get_recommender()
+        location = self._location(parameters)
+        distances = await self._compute(('distances', location), lambda: recommender.distances(location))
+        return {'distances': distances}
+
+    async def _reload_endpoint(self, _: dict[str, str]) -> dict[str, Any]:
+        """Reload the data, and return the new generation."""
+        await self.reload()
+        return {'generation': self.generation}
+
+    async def _health(self, _: dict[str, str]) -> dict[str, Any]:
+        """Return the counters of this service and its caches."""
+        stats = {'generation': self.generation, 'requests': self.requests, 'coalesced': self.coalesced,
+                 'in_flight': len(self._in_flight)}
+        if self.recommender is not None:
+            stats['caches'] = self.recommender.stats()
+        return stats
+
+    def _get_recommender(self) -> CachedRecommender:
+        """Return the current recommender, raising a RequestError if nothing has been loaded yet."""
+        if self.recommender is None:
+            raise RequestError(500, 'the graph has not been loaded')
+        return self.recommender
+
+    def _location(self, parameters: dict[str, str]) -> str:
+        """Return the location of the postal code in parameters, as CachedRecommender.location finds it,
+        raising a RequestError if it is unknown.
+        """
+        try:
+            return self.recommender.location(parameters.get('postal_code', '').strip())
+        except KeyError as error:
+            raise RequestError(400, 'unknown postal code') from error
+
+
+async def serve(service: RecommendationService, host: str = '127.0.0.1', port: int = 8080) -> None:
+    """Load the data of service and answer requests on the given host and port until interrupted.
+
+    On Unix, SIGHUP reloads the data, and SIGINT or SIGTERM stop accepting connections and return once the
+    connections being answered are closed.
+    """
+    await service.reload()
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    try:
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(service.reload()))
+        loop.add_signal_handler(signal.SIGINT, stopped.set)
+        loop.add_signal_handler(signal.SIGTERM, stopped.set)
+    except (AttributeError, NotImplementedError):
+        # Signal handlers are not available on this platform; the service is stopped by KeyboardInterrupt.
+        pass
+
+    async with server:
+        await stopped.wait()
+        server.close()
+        await server.wait_closed()
+
+
+def _number(parameters: dict[str, str], name: str, number_type: type) -> Optional[Any]:
+    """Return parameters[name] converted to number_type, or None if it is missing.
+
+    Raise a RequestError if it is not a valid number.
+    """
+    if name not in parameters:
+        return None
+    try:
+        return number_type(parameters[name])
+    except ValueError as error:
+        raise RequestError(400, name + ' must be a number') from error
+
+
+def _cuisines(parameters: dict[str, str], name: str) -> Optional[tuple[str, ...]]:
+    """Return the sorted cuisines in the comma-separated list parameters[name], or None if it is missing."""
+    if name not in parameters:
+        return None
+    return tuple(sorted({cuisine.strip() for cuisine in parameters[name].split(',') if cuisine.strip()}))
+
+
+def _write_response(writer: asyncio.StreamWriter, status: int, response: dict[str, Any], keep_alive: bool) -> None:
+    """Write an HTTP/1.1 response with the given status and JSON body to writer."""
+    body = json.dumps(response).encode('utf-8')
+    head = (f'HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+    writer.write(head.encode('latin-1') + body)
+
+
+if __name__ == '__main__':
+    import python_ta
+
+    python_ta.check_all(config={
+        'extra-imports': ['asyncio', 'json', 'signal', 'concurrent.futures', 'urllib.parse', 'computation_compiling',
+                          'geospatial', 'recommender_data', 'result_cache'],
+        'allowed-io': ['load_data_files'],
+        'max-line-length': 120,
+        'max-nested-blocks': 4,
+        'disable': ['E1136', 'W0221']})
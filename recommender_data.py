@@ -1,8 +1,32 @@
 """User class and loading data"""
 
 from __future__ import annotations
-from typing import Any, Union
-import networkx as nx
+import sys
+from itertools import islice, product
+from typing import TYPE_CHECKING, Any, Callable, Collection, Container, Iterable, Iterator, Optional, Union
+import numpy as np
+import instrumentation
+from graph_snapshot import intern_strings, read_snapshot, write_snapshot
+
+if TYPE_CHECKING:
+    # networkx is only imported by to_networkx, so that scoring never pays for importing it.
+    import networkx as nx
+
+# The User attributes stored in a snapshot, in order.
+USER_ATTRIBUTES = ('smoker', 'drink_level', 'dress_preference', 'ambience', 'budget')
+
+# For each preference in preference_lst, in order: the score of every value that does not get the default
+# score, and the default score.
+PREFERENCE_SCORES = (
+    ({'Smoker': 1}, 0),
+    ({'non-drinker': 0, 'casual drinker': 1}, 2),
+    ({'informal': 0, 'smart-casual': 1}, 2),
+    ({'solitary': 0, 'friends': 1}, 2),
+    ({'low': 0, 'medium': 1}, 2)
+)
+
+# The number of similar users ranked at first when scanning users lazily; doubles for each later block.
+RANKING_BLOCK_SIZE = 32
 
 
 class User:
@@ -25,6 +49,7 @@ class User:
         - self.ambience in {'family', 'friends', 'solitary'}
         - self.budget in {'low', 'medium', 'high'}
         """
+    __slots__ = ('user_id', 'smoker', 'drink_level', 'dress_preference', 'ambience', 'budget', '_scores')
     user_id: str
     smoker: str
     drink_level: str
@@ -32,17 +57,28 @@ class User:
     ambience: str
     budget: str
 
+    # Private Instance Attributes:
+    #     - _scores:
+    #         The preference_lst of this user, computed once when it is initialized.
+    #         The preferences of a user should not be changed after it is initialized.
+    _scores: tuple[int, ...]
+
     def __init__(self, user_id: str, smoker: str, drink_level: str, dress_preference: str, ambience: str,
                  budget: str) -> None:
         """Initialize a new user.
+
+        The preferences are interned, so users with the same preferences share the same strings.
         """
 
         self.user_id = user_id
-        self.smoker = smoker
-        self.drink_level = drink_level
-        self.dress_preference = dress_preference
-        self.ambience = ambience
-        self.budget = budget
+        self.smoker = sys.intern(smoker)
+        self.drink_level = sys.intern(drink_level)
+        self.dress_preference = sys.intern(dress_preference)
+        self.ambience = sys.intern(ambience)
+        self.budget = sys.intern(budget)
+        self._scores = _intern_scores(tuple(
+            scores.get(preference, default) for (scores, default), preference
+            in zip(PREFERENCE_SCORES, (smoker, drink_level, dress_preference, ambience, budget))))
 
     def preference_lst(self) -> list[int]:
         """Return a list of the user's preferences into a list of scores for each preference.
@@ -50,49 +86,14 @@ class User:
         Preconditions:
         - self.kind == 'user'
         """
-        lst = [self.smoker, self.drink_level, self.dress_preference, self.ambience, self.budget]
-
-        if lst[0] == "Smoker":
-            lst[0] = 1
-        else:
-            lst[0] = 0
-
-        lst[1] = self.preference_list_helper()
-
-        if lst[2] == 'informal':
-            lst[2] = 0
-        elif lst[2] == 'smart-casual':
-            lst[2] = 1
-        else:
-            lst[2] = 2
-
-        if lst[3] == 'solitary':
-            lst[3] = 0
-        elif lst[3] == 'friends':
-            lst[3] = 1
-        else:
-            lst[3] = 2
-
-        if lst[4] == 'low':
-            lst[4] = 0
-        elif lst[4] == 'medium':
-            lst[4] = 1
-        else:
-            lst[4] = 2
-
-        return lst
+        return list(self._scores)
 
     def preference_list_helper(self) -> int:
         """
         Return the number associated with the drink level choice.
         """
 
-        if self.drink_level == 'non-drinker':
-            return 0
-        elif self.drink_level == 'casual drinker':
-            return 1
-        else:
-            return 2
+        return self._scores[1]
 
 
 class Restaurant:
@@ -102,12 +103,12 @@ class Restaurant:
         - restaurant_id: the unique id associated with the restaurant
         - name: the restaurant's name
         - cuisine: the types of cuisines the restaurant serves
-        - postal_code: restaurant's postal code
+        - postal_code: restaurant's postal code: its FSA, or a full postal code located by a PostalGeocoder
 
     Representation Invariants:
         - self.restaurant_id != ''
         - self.name != ''
-        - self.cuisine != []
+        - self.cuisine != ()
         - all({cuisine in {'Afghan', 'African', 'American', 'Armenian', 'Asian', 'Bagels', 'Bakery', 'Bar',
         'Bar_Pub_Brewery', 'Barbecue', 'Brazilian', 'Breakfast Brunch', 'Burgers', 'Cafe Coffee Shop', 'Cafeteria',
         'California', 'Caribbean', 'Chinese', 'Contemporary', 'Continental-European', 'Deli-Sandwiches',
@@ -116,23 +117,25 @@ class Restaurant:
         'Juice', 'Korean', 'Latin_American', 'Mediterranean', 'Mexican', 'Mongolian', 'Organic-Healthy', 'Persian',
         'Pizzeria', 'Polish', 'Regional' ,'Seafood', 'Soup', 'Southern' ,'Southwestern, 'Spanish', 'Steaks', 'Sushi',
         'Thai', 'Turkish', 'Vegetarian', 'Vietnamese'} for cuisine in self.cuisine})
-        - len(self.postal_code) == 3
         - self.postal_code != ''
     """
 
+    __slots__ = ('restaurant_id', 'name', 'cuisine', 'postal_code')
     restaurant_id: str
     name: str
-    cuisine: list[str]
+    cuisine: tuple[str, ...]
     postal_code: str
 
     def __init__(self, restaurant_id: str, name: str, postal_code: str) -> None:
         """Initialize a new resturant.
+
+        Set cuisine with intern_cuisines, so restaurants serving the same cuisines share one tuple.
         """
 
         self.restaurant_id = restaurant_id
         self.name = name
-        self.cuisine = []
-        self.postal_code = postal_code
+        self.cuisine = ()
+        self.postal_code = sys.intern(postal_code)
 
 
 class _Vertex:
@@ -149,6 +152,7 @@ class _Vertex:
         - self.kind in {'user', 'restaurant'}
         - all(self in u.neighbours for u in self.neighbours)
     """
+    __slots__ = ('item', 'kind', 'neighbours')
     item: User | Restaurant
     kind: str
     neighbours: set[_Vertex]
@@ -189,6 +193,7 @@ class _WeightedVertex(_Vertex):
         - self.kind in {'user', 'restaurant'}
         - all(self in u.neighbours for u in self.neighbours)
     """
+    __slots__ = ()
     item: User | Restaurant
     kind: str
     neighbours: dict[_WeightedVertex, Union[int, float]]
@@ -287,6 +292,8 @@ class Graph:
 
         Note that this method is provided for you, and you shouldn't change it.
         """
+        import networkx as nx
+
         graph_nx = nx.Graph()
         for v in self._vertices.values():
             graph_nx.add_node(v.item, kind=v.kind)
@@ -309,16 +316,62 @@ class WeightedGraph(Graph):
 
     Note that this is a subclass of the Graph class from Exercise 3, and so inherits any methods
     from that class that aren't overridden here.
+
+    Instance Attributes:
+        - version: a counter increased every time a vertex or edge is added, so that results computed from
+          this graph can tell when they are out of date
     """
+    version: int
+
     # Private Instance Attributes:
     #     - _vertices:
     #         A collection of the vertices contained in this graph.
     #         Maps item to _WeightedVertex object.
+    #     - _user_index:
+    #         Maps each user_id to the vertex of that user.
+    #     - _restaurant_index:
+    #         Maps each restaurant_id to the vertex of that restaurant.
+    #     - _restaurant_numbers:
+    #         Maps each restaurant_id to its number in _cuisine_index, the order it was added in.
+    #     - _cuisine_index:
+    #         The restaurants serving each cuisine.
+    #     - _preference_ids:
+    #         The user_ids of every user in this graph, in sorted order.
+    #     - _preference_matrix:
+    #         Row i is the preference_lst of the user _preference_ids[i].
+    #         None when it has to be rebuilt because a user was added.
+    #     - _review_sums:
+    #         Maps each restaurant_id to the sum of the weights of the edges of that restaurant.
+    #     - _review_counts:
+    #         Maps each restaurant_id to the number of edges of that restaurant.
+    #     - _recommendations:
+    #         The candidate restaurants of each preference profile, computed as they are needed.
     _vertices: dict[Any, _WeightedVertex]
+    _user_index: dict[str, _WeightedVertex]
+    _restaurant_index: dict[str, _WeightedVertex]
+    _restaurant_numbers: dict[str, int]
+    _cuisine_index: CuisineIndex
+    _preference_ids: list[str]
+    _preference_matrix: Optional[np.ndarray]
+    _review_sums: dict[str, Union[int, float]]
+    _review_counts: dict[str, int]
+    _recommendations: RecommendationTable
 
     def __init__(self) -> None:
         """Initialize an empty graph (no vertices or edges)."""
+        self.version = 0
         self._vertices = {}
+        self._user_index = {}
+        self._restaurant_index = {}
+        self._restaurant_numbers = {}
+        self._cuisine_index = CuisineIndex()
+        self._preference_ids = []
+        self._preference_matrix = None
+        self._review_sums = {}
+        self._review_counts = {}
+        self._recommendations = RecommendationTable(
+            self._iter_similar_users, lambda u_id: (u_id, tuple(self._user_index[u_id].item.preference_lst())),
+            self._rated_restaurants)
 
         # This call isn't necessary, except to satisfy PythonTA.
         Graph.__init__(self)
@@ -330,10 +383,22 @@ class WeightedGraph(Graph):
         Do nothing if the given item is already in this graph.
 
         Preconditions:
-            - kind in {'user', 'book'}
+            - kind in {'user', 'restaurant'}
         """
         if item not in self._vertices:
-            self._vertices[item] = _WeightedVertex(item, kind)
+            vertex = _WeightedVertex(item, kind)
+            self._vertices[item] = vertex
+            self.version += 1
+            if kind == 'user':
+                self._user_index[item.user_id] = vertex
+                self._preference_matrix = None
+                self._recommendations.user_added(item)
+            elif kind == 'restaurant':
+                self._restaurant_index[item.restaurant_id] = vertex
+                self._restaurant_numbers[item.restaurant_id] = len(self._restaurant_numbers)
+                self._cuisine_index.add(self._restaurant_numbers[item.restaurant_id], item.cuisine)
+                self._review_sums[item.restaurant_id] = 0
+                self._review_counts[item.restaurant_id] = 0
 
     def add_edge(self, item1: Any, item2: Any, weight: Union[int, float] = 1) -> None:
         """Add an edge between the two vertices with the given items in this graph,
@@ -348,13 +413,124 @@ class WeightedGraph(Graph):
             v1 = self._vertices[item1]
             v2 = self._vertices[item2]
 
+            # Update the review aggregates of the restaurant, replacing the old weight if the edge exists
+            for user, restaurant in ((v1, v2), (v2, v1)):
+                if user.kind == 'user':
+                    self._recommendations.user_changed(user.item)
+                if restaurant.kind == 'restaurant' and user.kind != 'restaurant':
+                    restaurant_id = restaurant.item.restaurant_id
+                    if user in restaurant.neighbours:
+                        self._review_sums[restaurant_id] -= restaurant.neighbours[user]
+                    else:
+                        self._review_counts[restaurant_id] += 1
+                    self._review_sums[restaurant_id] += weight
+
             # Add the new edge
             v1.neighbours[v2] = weight
             v2.neighbours[v1] = weight
+            self.version += 1
         else:
             # We didn't find an existing vertex for both items.
             raise ValueError
 
+    def add_edges(self, edges: Iterable[tuple[Any, Any, Union[int, float]]]) -> None:
+        """Add every (item1, item2, weight) edge in edges to this graph.
+
+        This is the bulk version of add_edge, for loading many reviews at once.
+
+        Raise a ValueError if an item in edges does not appear as a vertex in this graph.
+        Edges before the invalid one are still added.
+        """
+        for item1, item2, weight in edges:
+            self.add_edge(item1, item2, weight)
+
+    def remove_edge(self, item1: Any, item2: Any) -> None:
+        """Remove the edge between the two vertices with the given items in this graph.
+
+        Do nothing if item1 and item2 are not adjacent.
+        Raise a ValueError if item1 or item2 do not appear as vertices in this graph.
+        """
+        if item1 in self._vertices and item2 in self._vertices:
+            v1 = self._vertices[item1]
+            v2 = self._vertices[item2]
+            if v2 not in v1.neighbours:
+                return
+
+            for user, restaurant in ((v1, v2), (v2, v1)):
+                if user.kind == 'user':
+                    self._recommendations.user_changed(user.item)
+                if restaurant.kind == 'restaurant' and user.kind != 'restaurant':
+                    restaurant_id = restaurant.item.restaurant_id
+                    self._review_sums[restaurant_id] -= restaurant.neighbours[user]
+                    self._review_counts[restaurant_id] -= 1
+
+            del v1.neighbours[v2]
+            del v2.neighbours[v1]
+            self.version += 1
+        else:
+            raise ValueError
+
+    def apply_ratings(self, ratings: Iterable[tuple[str, str, Optional[Union[int, float]]]]) -> None:
+        """Apply every (user_id, restaurant_id, rating) event in ratings to this graph, in order.
+
+        A rating adds the review of the restaurant by the user, or replaces it if there is one already.
+        A rating of None deletes the review, if there is one. Review averages, recommendations and the
+        version of this graph are all kept up to date.
+
+        Raise a ValueError if a user_id or restaurant_id does not appear in this graph.
+        Events before the invalid one are still applied.
+        """
+        for user_id, restaurant_id, rating in ratings:
+            user, restaurant = self.get_user(user_id), self.get_restaurant(restaurant_id)
+            if rating is None:
+                self.remove_edge(user, restaurant)
+            else:
+                self.add_edge(user, restaurant, rating)
+
+    def get_user(self, user_id: str) -> User:
+        """Return the user in this graph with the given user_id.
+
+        Raise a ValueError if no such user appears in this graph.
+        """
+        if user_id in self._user_index:
+            return self._user_index[user_id].item
+        else:
+            raise ValueError
+
+    def get_restaurant(self, restaurant_id: str) -> Restaurant:
+        """Return the restaurant in this graph with the given restaurant_id.
+
+        Raise a ValueError if no such restaurant appears in this graph.
+        """
+        if restaurant_id in self._restaurant_index:
+            return self._restaurant_index[restaurant_id].item
+        else:
+            raise ValueError
+
+    def get_all_items(self, kind: str) -> list[Any]:
+        """Return the items of every vertex of the given kind in this graph, in the order they were added.
+
+        Preconditions:
+            - kind in {'user', 'restaurant'}
+        """
+        index = self._user_index if kind == 'user' else self._restaurant_index
+        return [vertex.item for vertex in index.values()]
+
+    def get_all_vertices(self, kind: str = '') -> set[_WeightedVertex]:
+        """Return a set of all vertex in this graph.
+
+        If kind != '', only return the items of the given vertex kind.
+
+        Preconditions:
+            - kind in {'', 'user', 'restaurant'}
+        """
+        if kind == 'user':
+            return set(self._user_index.values())
+        elif kind == 'restaurant':
+            return set(self._restaurant_index.values())
+        else:
+            return Graph.get_all_vertices(self, kind)
+
     def get_weight(self, item1: Any, item2: Any) -> Union[int, float]:
         """Return the weight of the edge between the given items.
 
@@ -375,6 +551,8 @@ class WeightedGraph(Graph):
 
         Note that this method is provided for you, and you shouldn't change it.
         """
+        import networkx as nx
+
         graph_nx = nx.Graph()
         for v in self._vertices.values():
             graph_nx.add_node(v.item, kind=v.kind)
@@ -391,72 +569,610 @@ class WeightedGraph(Graph):
 
         return graph_nx
 
-    def get_similar_users(self, program_user: User) -> list[str]:
+    def get_similar_users(self, program_user: User, limit: Optional[int] = None) -> list[str]:
         """Return a list of the similar users that match the program user's preferences.
+
+        Users are ranked by how many preferences they share with program_user, then by the total
+        difference between their preferences, and ties are broken by user_id.
+        If limit is not None, only return the first limit users of this ranking.
+
+        Preconditions:
+        - limit is None or limit >= 0
         """
-        vertices_list = sorted(list(self.get_all_vertices('user')), key=lambda x: x.item.user_id)
+        with instrumentation.stage('get_similar_users'):
+            keys = self._similarity_keys(program_user)
+            instrumentation.count('users_ranked', len(keys))
+            return [self._preference_ids[i] for i in top_ranked(keys, limit)]
 
-        subtracted_numbers_dict = {}
-        for vertex in vertices_list:
-            subtracted_numbers_dict[vertex.item.user_id] = vertex.similarity_list(program_user)
+    def _similarity_keys(self, program_user: User) -> np.ndarray:
+        """Return an array where the i-th value is the ranking key of the user _preference_ids[i].
 
-        zeros_dict = {}
-        for item in subtracted_numbers_dict:
-            num_zeroes = subtracted_numbers_dict[item].count(0)
-            sum_of_list = sum(subtracted_numbers_dict[item])
-            zeros_dict[item] = (num_zeroes, sum_of_list)
+        Sorting the keys in increasing order gives the ranking described in get_similar_users.
+        """
+        if self._preference_matrix is None:
+            self._preference_ids = sorted(self._user_index)
+            self._preference_matrix = np.array(
+                [self._user_index[u_id].item.preference_lst() for u_id in self._preference_ids],
+                dtype=np.int8).reshape(-1, 5)
+
+        return similarity_keys(self._preference_matrix, program_user)
+
+    def _iter_similar_users(self, program_user: User, max_users: Optional[int] = None) -> Iterator[str]:
+        """Yield the user_ids of get_similar_users(program_user, max_users) in order.
 
-        sorted_subtracted_numbers_dict = dict(sorted(zeros_dict.items(), key=lambda item: (item[1][0], item[1][1]),
-                                                     reverse=True))
-        return list(sorted_subtracted_numbers_dict.keys())
+        Users are ranked in growing blocks, so only about as many users as are consumed get sorted.
+        """
+        keys = self._similarity_keys(program_user)
+        user_ids = self._preference_ids
+        num_users = len(keys) if max_users is None else min(max_users, len(keys))
+        start = 0
+        block = RANKING_BLOCK_SIZE
+        while start < num_users:
+            end = min(start + block, num_users)
+            for i in top_ranked(keys, end)[start:]:
+                yield user_ids[i]
+            start = end
+            block *= 2
+
+    def _rated_restaurants(self, user_id: str) -> list[tuple[_WeightedVertex, str]]:
+        """Return (vertex, name) for each restaurant rated at least 4 by the given user, in neighbour order."""
+        return [(restaurant, restaurant.item.name)
+                for restaurant, weight in self._user_index[user_id].neighbours.items() if weight >= 4]
+
+    def precompute_recommendations(self, max_users: Optional[int] = None) -> None:
+        """Compute the candidate restaurants of every preference profile ahead of time, scanning up to
+        max_users similar users for each (every user if max_users is None).
+
+        recommend_restaurants then only reads them. Profiles are recomputed when the users they scanned change.
+        """
+        self._recommendations.precompute(max_users)
 
-    def recommend_restaurants(self, program_user: User, limit: int, all_users: dict, distances: dict) -> (
-            dict[str, tuple[float, str, list[str]]]):
+    def clear_recommendations(self) -> None:
+        """Forget the candidate restaurants computed for every preference profile, so that the next request
+        for each profile computes them again.
+        """
+        self._recommendations.clear()
+
+    def recommend_restaurants(self, program_user: User, limit: int, all_users: dict, distances: dict,
+                              max_users: Optional[int] = None, max_distance: Optional[float] = None,
+                              include_cuisines: Optional[Collection[str]] = None,
+                              exclude_cuisines: Optional[Collection[str]] = None) -> (
+            dict[str, tuple[float, float, tuple[str, ...]]]):
         """Return a list of recommended restaurants based on user's preferences
 
+        Each restaurant name maps to its average review, its distance from the user taken from distances,
+        and its cuisines. Candidates are read from the table of candidate restaurants of the user's
+        preference profile, and similar users are only scanned to extend it until limit restaurants are found.
+        If max_users is not None, at most max_users similar users are scanned.
+        If max_distance is not None, only restaurants in distances at most max_distance kilometres away
+        are recommended, so distances may hold just the nearby restaurants (see get_nearby_distances).
+        If include_cuisines is not None, only restaurants serving at least one of its cuisines are
+        recommended, and restaurants serving any cuisine in exclude_cuisines never are. Both filters are
+        looked up in the cuisine index, so filtered out restaurants are skipped before they are averaged.
+        all_users is no longer used, since users are looked up by user_id in this graph.
+
         Preconditions:
-        - all_users != {} and all({u in self._vertices for u in all_users})
         - distances != {}
         - limit >= 1
+        - max_users is None or max_users >= 0
+        - max_distance is None or max_distance >= 0
         """
+        with instrumentation.stage('recommend_restaurants'):
+            allowed = None
+            if max_distance is not None:
+                allowed = {name for name, distance in distances.items() if distance <= max_distance}
+
+            mask = None
+            if include_cuisines is not None or exclude_cuisines is not None:
+                mask = self._cuisine_index.mask(include_cuisines, exclude_cuisines)
+
+            with instrumentation.stage('recommend_restaurants.candidates'):
+                numbers = self._restaurant_numbers
+                candidates = self._recommendations.candidates(
+                    program_user, limit, max_users, allowed,
+                    None if mask is None else lambda restaurant: mask[numbers[restaurant.item.restaurant_id]])
+
+            dict_so_far = {}
+            with instrumentation.stage('recommend_restaurants.averages'):
+                for restaurant in candidates:
+                    dict_so_far[restaurant.item.name] = (
+                        self.get_average_review(restaurant.item), distances[restaurant.item.name],
+                        restaurant.item.cuisine)
+            instrumentation.count('candidates_produced', len(dict_so_far))
+
+        return dict_so_far
+
+    def get_cuisine_index(self) -> CuisineIndex:
+        """Return the index of the restaurants serving each cuisine, numbered in the order they were added."""
+        return self._cuisine_index
 
-        similar_users = self.get_similar_users(program_user)
+    def get_average_review(self, restaurant: Restaurant) -> float:
+        """
+        Return the average rating given by users of the restaurant.
 
-        dict_so_far = {}
-        for u_id in similar_users:
-            user = self._vertices[all_users[u_id]]
-            restaurants = user.neighbours
+        Return 0.0 if no user has reviewed the restaurant.
 
-            for restaurant in restaurants:
-                if self.get_weight(user.item, restaurant.item) >= 4:
-                    if restaurant.item.name not in dict_so_far:
-                        dict_so_far[restaurant.item.name] = (
-                            self.get_average_review(restaurant.item), distances[restaurant.item.name],
-                            restaurant.item.cuisine)
+        Preconditions:
+        - restaurant in self._vertices
+        """
+        count = self._review_counts[restaurant.restaurant_id]
+        if count == 0:
+            return 0.0
+        return round(self._review_sums[restaurant.restaurant_id] / count, 2)
 
-        return dict(list(dict_so_far.items())[:limit])
+    def get_all_average_reviews(self) -> tuple[list[str], np.ndarray]:
+        """Return the restaurant_ids of every restaurant in this graph, in sorted order, together with
+        an array of their average ratings.
 
-    def get_average_review(self, restaurant: Restaurant) -> float:
+        The i-th average belongs to the i-th restaurant_id, and is 0.0 for a restaurant with no reviews.
         """
-        Return the average rating given by users of the restaurant.
+        restaurant_ids = sorted(self._restaurant_index)
+        sums = np.array([self._review_sums[r_id] for r_id in restaurant_ids], dtype=np.float64)
+        counts = np.array([self._review_counts[r_id] for r_id in restaurant_ids], dtype=np.float64)
+        averages = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+        return (restaurant_ids, np.round(averages, 2))
+
+    def save_snapshot(self, path: str, sources: Iterable[str] = ()) -> None:
+        """Save this graph as a binary snapshot in the directory path.
+
+        sources are the files this graph was loaded from; the snapshot records their sizes and modification
+        times so that graph_snapshot.snapshot_is_current can tell when it is out of date.
 
         Preconditions:
-        - restaurant in self._vertices
+            - all vertex items are User or Restaurant objects
+            - every edge is between a user and a restaurant
+        """
+        arrays, strings = self.to_columns()
+        write_snapshot(path, arrays, strings, sources)
+
+    def to_columns(self) -> tuple[dict[str, np.ndarray], dict[str, list[str]]]:
+        """Return the arrays and string tables of a snapshot of this graph, as written by save_snapshot.
+
+        Preconditions:
+            - all vertex items are User or Restaurant objects
+            - every edge is between a user and a restaurant
+        """
+        users = self.get_all_items('user')
+        restaurants = self.get_all_items('restaurant')
+        user_positions = {user: i for i, user in enumerate(users)}
+        restaurant_positions = {restaurant: i for i, restaurant in enumerate(restaurants)}
+
+        arrays = {'vertex_kinds': np.array([v.kind == 'restaurant' for v in self._vertices.values()], dtype=np.int8)}
+        strings = {'user_ids': [user.user_id for user in users],
+                   'restaurant_ids': [restaurant.restaurant_id for restaurant in restaurants],
+                   'restaurant_names': [restaurant.name for restaurant in restaurants]}
+
+        for attribute in USER_ATTRIBUTES:
+            strings['user_' + attribute + '_values'], arrays['user_' + attribute] = intern_strings(
+                getattr(user, attribute) for user in users)
+        strings['postal_codes'], arrays['restaurant_postal_codes'] = intern_strings(
+            restaurant.postal_code for restaurant in restaurants)
+        strings['cuisines'], arrays['cuisine_codes'] = intern_strings(
+            cuisine for restaurant in restaurants for cuisine in restaurant.cuisine)
+        arrays['cuisine_offsets'] = _offsets([len(restaurant.cuisine) for restaurant in restaurants])
+
+        # The edges are stored twice in compressed sparse row form, once from each side, so that the
+        # neighbours of every vertex keep their order.
+        user_vertices = list(self._user_index.values())
+        restaurant_vertices = list(self._restaurant_index.values())
+        ratings = [weight for vertex in user_vertices for weight in vertex.neighbours.values()]
+        is_integer = all(isinstance(rating, int) for rating in ratings)
+        arrays['user_offsets'] = _offsets([len(vertex.neighbours) for vertex in user_vertices])
+        arrays['user_neighbours'] = np.array(
+            [restaurant_positions[u.item] for vertex in user_vertices for u in vertex.neighbours], dtype=np.int32)
+        arrays['user_ratings'] = np.array(ratings, dtype=np.int32 if is_integer else np.float64)
+        arrays['restaurant_offsets'] = _offsets([len(vertex.neighbours) for vertex in restaurant_vertices])
+        arrays['restaurant_neighbours'] = np.array(
+            [user_positions[u.item] for vertex in restaurant_vertices for u in vertex.neighbours], dtype=np.int32)
+        arrays['restaurant_ratings'] = np.array(
+            [weight for vertex in restaurant_vertices for weight in vertex.neighbours.values()],
+            dtype=arrays['user_ratings'].dtype)
+
+        return (arrays, strings)
+
+    @classmethod
+    def load_snapshot(cls, path: str) -> WeightedGraph:
+        """Return the graph saved in the snapshot in the directory path.
+
+        Raise a ValueError if path does not hold a complete snapshot.
+        """
+        return cls.from_columns(*read_snapshot(path))
+
+    @classmethod
+    def from_columns(cls, arrays: dict[str, np.ndarray], strings: dict[str, Any]) -> WeightedGraph:
+        """Return the graph with the given snapshot arrays and string tables, as returned by to_columns.
+
+        strings maps each name to a sequence of strings, such as a StringTable.
+        """
+        attributes = []
+        for attribute in USER_ATTRIBUTES:
+            values = list(strings['user_' + attribute + '_values'])
+            attributes.append([values[code] for code in arrays['user_' + attribute].tolist()])
+        users = [User(user_id, *preferences) for user_id, *preferences in zip(strings['user_ids'], *attributes)]
+
+        postal_codes = list(strings['postal_codes'])
+        cuisines = list(strings['cuisines'])
+        cuisine_offsets = arrays['cuisine_offsets'].tolist()
+        cuisine_codes = arrays['cuisine_codes'].tolist()
+        restaurants = []
+        for i, (restaurant_id, name, code) in enumerate(zip(strings['restaurant_ids'], strings['restaurant_names'],
+                                                            arrays['restaurant_postal_codes'].tolist())):
+            restaurant = Restaurant(restaurant_id, name, postal_codes[code])
+            restaurant.cuisine = intern_cuisines(
+                cuisines[c] for c in cuisine_codes[cuisine_offsets[i]:cuisine_offsets[i + 1]])
+            restaurants.append(restaurant)
+
+        graph = cls()
+        remaining = {0: iter(users), 1: iter(restaurants)}
+        for kind in arrays['vertex_kinds'].tolist():
+            graph.add_vertex(next(remaining[kind]), 'restaurant' if kind else 'user')
+
+        user_vertices = list(graph._user_index.values())
+        restaurant_vertices = list(graph._restaurant_index.values())
+        user_offsets = arrays['user_offsets'].tolist()
+        user_neighbours = arrays['user_neighbours'].tolist()
+        ratings = arrays['user_ratings'].tolist()
+        for i, vertex in enumerate(user_vertices):
+            for j in range(user_offsets[i], user_offsets[i + 1]):
+                vertex.neighbours[restaurant_vertices[user_neighbours[j]]] = ratings[j]
+
+        restaurant_offsets = arrays['restaurant_offsets'].tolist()
+        restaurant_neighbours = arrays['restaurant_neighbours'].tolist()
+        for i, vertex in enumerate(restaurant_vertices):
+            for j in range(restaurant_offsets[i], restaurant_offsets[i + 1]):
+                user = user_vertices[restaurant_neighbours[j]]
+                vertex.neighbours[user] = user.neighbours[vertex]
+            graph._review_sums[vertex.item.restaurant_id] = sum(vertex.neighbours.values())
+            graph._review_counts[vertex.item.restaurant_id] = len(vertex.neighbours)
+
+        return graph
+
+
+class RecommendationTable:
+    """A table of the candidate restaurants of each preference profile, the preference_lst that decides
+    which users are similar to a user.
+
+    For a fixed graph, the ranked similar users and the restaurants they rate at least 4 only depend on the
+    profile, so they are computed once per profile and reused. Each profile is only computed as far as
+    requests have needed, or as far as precompute asked, and a profile is recomputed only when a user
+    that was already scanned for it changes, or a new user ranks among them.
+
+    The graph using this table gives it three functions:
+        - rank_users(program_user) yields the users similar to program_user in ranking order, as tokens
+        - user_key(token) returns the (user_id, preference_lst tuple) of the user with that token
+        - rated_restaurants(token) returns (restaurant token, name) for each restaurant rated at least 4 by
+          that user, in neighbour order
+    """
+    # Private Instance Attributes:
+    #     - _rank_users, _user_key, _rated_restaurants:
+    #         The functions described above.
+    #     - _profiles:
+    #         Maps each computed profile to its _ProfileEntry.
+    _rank_users: Callable[[User], Iterator[Any]]
+    _user_key: Callable[[Any], tuple[str, tuple[int, ...]]]
+    _rated_restaurants: Callable[[Any], list[tuple[Any, str]]]
+    _profiles: dict[tuple[int, ...], _ProfileEntry]
+
+    def __init__(self, rank_users: Callable[[User], Iterator[Any]],
+                 user_key: Callable[[Any], tuple[str, tuple[int, ...]]],
+                 rated_restaurants: Callable[[Any], list[tuple[Any, str]]]) -> None:
+        """Initialize an empty table for a graph with the given functions."""
+        self._rank_users = rank_users
+        self._user_key = user_key
+        self._rated_restaurants = rated_restaurants
+        self._profiles = {}
+
+    def __len__(self) -> int:
+        """Return the number of profiles computed in this table."""
+        return len(self._profiles)
+
+    def candidates(self, program_user: User, limit: int, max_users: Optional[int] = None,
+                   allowed: Optional[Container[str]] = None, accept: Optional[Callable[[Any], bool]] = None) -> (
+            list[Any]):
+        """Return the tokens of the first limit restaurants rated at least 4 by the users similar to
+        program_user, in the order of get_similar_users, at most once per restaurant name.
+
+        If max_users is not None, only the max_users most similar users are scanned.
+        If allowed is not None, restaurants whose names are not in allowed are skipped.
+        If accept is not None, restaurants whose tokens it returns False for are skipped.
+
+        Preconditions:
+        - limit >= 1
+        - max_users is None or max_users >= 0
+        """
+        entry = self._entry(tuple(program_user.preference_lst()))
+        tokens = []
+        i = 0
+        while len(tokens) < limit:
+            if i == len(entry.candidates):
+                if not self._scan_next_user(entry, max_users):
+                    break
+            else:
+                token, name, rank = entry.candidates[i]
+                if max_users is not None and rank >= max_users:
+                    break
+                if (allowed is None or name in allowed) and (accept is None or accept(token)):
+                    tokens.append(token)
+                i += 1
+
+        return tokens
+
+    def precompute(self, max_users: Optional[int] = None) -> None:
+        """Compute the candidate restaurants of all 162 profiles, scanning up to max_users similar users for
+        each, or every user if max_users is None.
+        """
+        for scores in product(*(sorted(set(values.values()) | {default})
+                                          for values, default in PREFERENCE_SCORES)):
+            entry = self._entry(scores)
+            while self._scan_next_user(entry, max_users):
+                pass
+
+    def user_added(self, user: User) -> None:
+        """Update this table after user was added to the graph."""
+        for scores, entry in list(self._profiles.items()):
+            if entry.ranks_before_last(user.user_id, tuple(user.preference_lst())):
+                del self._profiles[scores]
+            else:
+                # The users scanned so far stay the same, but the rest of the ranking now includes user.
+                entry.remaining = None
+                entry.exhausted = False
+
+    def user_changed(self, user: User) -> None:
+        """Update this table after the edges of user changed."""
+        for scores, entry in list(self._profiles.items()):
+            if entry.ranks_before_last(user.user_id, tuple(user.preference_lst()), True):
+                del self._profiles[scores]
+
+    def clear(self) -> None:
+        """Remove every computed profile from this table."""
+        self._profiles = {}
+
+    def _entry(self, scores: tuple[int, ...]) -> _ProfileEntry:
+        """Return the entry of the given profile, creating it if needed."""
+        if scores not in self._profiles:
+            self._profiles[scores] = _ProfileEntry(scores)
+        return self._profiles[scores]
+
+    def _scan_next_user(self, entry: _ProfileEntry, max_users: Optional[int]) -> bool:
+        """Add the restaurants rated by the next similar user of entry to its candidates.
+
+        Return False, without scanning, if there is no next user or max_users users were already scanned.
+        """
+        if entry.exhausted or (max_users is not None and entry.users_scanned >= max_users):
+            return False
+        if entry.remaining is None:
+            entry.remaining = islice(self._rank_users(_profile_user(entry.scores)), entry.users_scanned, None)
+
+        token = next(entry.remaining, None)
+        if token is None:
+            entry.exhausted = True
+            return False
+
+        rated = self._rated_restaurants(token)
+        for restaurant, name in rated:
+            if name not in entry.names:
+                entry.names.add(name)
+                entry.candidates.append((restaurant, name, entry.users_scanned))
+        entry.users_scanned += 1
+        instrumentation.count('users_scanned')
+        instrumentation.count('edges_visited', len(rated))
+        entry.last = self._user_key(token)
+        return True
+
+
+class _ProfileEntry:
+    """The candidate restaurants of one profile in a RecommendationTable, as far as they are computed.
+
+    Instance Attributes:
+        - scores: the profile
+        - users_scanned: the number of similar users scanned so far
+        - last: the (user_id, preference_lst tuple) of the last user scanned, or None if none were
+        - candidates: (restaurant token, name, number of users scanned before it was found) for each
+          candidate found so far, in order
+        - names: the names of the candidates found so far
+        - remaining: the rest of the ranked users, or None if it has to be restarted
+        - exhausted: whether every user has been scanned
+    """
+    __slots__ = ('scores', 'users_scanned', 'last', 'candidates', 'names', 'remaining', 'exhausted')
+    scores: tuple[int, ...]
+    users_scanned: int
+    last: Optional[tuple[str, tuple[int, ...]]]
+    candidates: list[tuple[Any, str, int]]
+    names: set[str]
+    remaining: Optional[Iterator[Any]]
+    exhausted: bool
+
+    def __init__(self, scores: tuple[int, ...]) -> None:
+        """Initialize a new entry for the given profile with nothing scanned."""
+        self.scores = scores
+        self.users_scanned = 0
+        self.last = None
+        self.candidates = []
+        self.names = set()
+        self.remaining = None
+        self.exhausted = False
+
+    def ranks_before_last(self, user_id: str, user_scores: tuple[int, ...], inclusive: bool = False) -> bool:
+        """Return whether the user with the given user_id and preference scores ranks before the last user
+        scanned for this profile, or is that user when inclusive is True.
+        """
+        if self.last is None:
+            return False
+        key = _similarity_key(self.scores, user_scores, user_id)
+        last_key = _similarity_key(self.scores, self.last[1], self.last[0])
+        return key < last_key or (inclusive and key == last_key)
+
+
+class CuisineIndex:
+    """An inverted index from each cuisine to the restaurants serving it.
+
+    Restaurants are identified by numbers from 0, given by the graph that owns the index (the order its
+    restaurants were added in). The restaurants passing a cuisine filter are found with mask, as a boolean
+    array indexed by restaurant number, so a filter costs a few array operations however many restaurants
+    serve each cuisine.
+
+    Instance Attributes:
+        - num_restaurants: one more than the largest restaurant number added, so the length of every mask
+    """
+    num_restaurants: int
+
+    # Private Instance Attributes:
+    #     - _numbers:
+    #         Maps each cuisine to the numbers of the restaurants serving it, in the order they were added.
+    #     - _arrays:
+    #         Maps each cuisine to _numbers[cuisine] as an array. Emptied whenever a restaurant is added.
+    _numbers: dict[str, list[int]]
+    _arrays: dict[str, np.ndarray]
+
+    def __init__(self) -> None:
+        """Initialize an empty index."""
+        self.num_restaurants = 0
+        self._numbers = {}
+        self._arrays = {}
+
+    @classmethod
+    def from_columns(cls, codes: np.ndarray, offsets: np.ndarray, cuisines: list[str]) -> CuisineIndex:
+        """Return the index of the restaurants in the cuisine_codes, cuisine_offsets and cuisines columns of
+        a snapshot, where the restaurant at position i is number i.
         """
-        restaurant_vertex = self._vertices[restaurant]
-        users = restaurant_vertex.neighbours
-        reviews_so_far = 0
-        for user in users:
-            reviews_so_far += self.get_weight(user.item, restaurant_vertex.item)
+        index = cls()
+        index.num_restaurants = len(offsets) - 1
+        numbers = np.repeat(np.arange(index.num_restaurants), np.diff(offsets))
+        order = np.argsort(codes, kind='stable')
+        boundaries = np.searchsorted(codes[order], np.arange(len(cuisines) + 1))
+        for code, cuisine in enumerate(cuisines):
+            index._arrays[cuisine] = numbers[order[boundaries[code]:boundaries[code + 1]]]
+            index._numbers[cuisine] = index._arrays[cuisine].tolist()
+        return index
+
+    def add(self, number: int, cuisines: Iterable[str]) -> None:
+        """Add the restaurant with the given number, serving the given cuisines, to this index.
+
+        Preconditions:
+            - number has not been added to this index
+        """
+        for cuisine in cuisines:
+            self._numbers.setdefault(cuisine, []).append(number)
+        self.num_restaurants = max(self.num_restaurants, number + 1)
+        self._arrays = {}
+
+    def cuisines(self) -> list[str]:
+        """Return every cuisine served by a restaurant in this index, in sorted order."""
+        return sorted(self._numbers)
+
+    def restaurants(self, cuisine: str) -> np.ndarray:
+        """Return the numbers of the restaurants serving cuisine, in the order they were added."""
+        if cuisine not in self._arrays:
+            self._arrays[cuisine] = np.array(self._numbers.get(cuisine, ()), dtype=np.int64)
+        return self._arrays[cuisine]
+
+    def mask(self, include: Optional[Collection[str]] = None,
+             exclude: Optional[Collection[str]] = None) -> np.ndarray:
+        """Return a boolean array whose element i is whether restaurant number i serves at least one of the
+        cuisines in include (or any cuisine if include is None) and none of the cuisines in exclude.
+        """
+        if include is None:
+            mask = np.ones(self.num_restaurants, dtype=bool)
+        else:
+            mask = np.zeros(self.num_restaurants, dtype=bool)
+            for cuisine in include:
+                mask[self.restaurants(cuisine)] = True
+        for cuisine in exclude or ():
+            mask[self.restaurants(cuisine)] = False
+        return mask
+
+
+# The interned score tuples and cuisine tuples. There are only 162 different score tuples.
+_SCORE_TUPLES = {}
+_CUISINE_TUPLES = {}
+
+
+def _intern_scores(scores: tuple[int, ...]) -> tuple[int, ...]:
+    """Return the shared tuple equal to scores."""
+    return _SCORE_TUPLES.setdefault(scores, scores)
+
+
+def intern_cuisines(cuisines: Iterable[str]) -> tuple[str, ...]:
+    """Return the shared tuple of the given cuisines, in order.
+
+    Restaurants serving the same cuisines in the same order get the same tuple object.
+    """
+    cuisine_tuple = tuple(sys.intern(cuisine) for cuisine in cuisines)
+    return _CUISINE_TUPLES.setdefault(cuisine_tuple, cuisine_tuple)
+
 
-        return round(reviews_so_far / len(users), 2)
+def _similarity_key(scores: tuple[int, ...], user_scores: tuple[int, ...], user_id: str) -> tuple[int, str]:
+    """Return a key that orders users the same way as similarity_keys does for the given profile."""
+    differences = [abs(a - b) for a, b in zip(scores, user_scores)]
+    return (-(differences.count(0) * 16 + sum(differences)), user_id)
+
+
+def profile_users() -> list[User]:
+    """Return a user with each of the 162 possible preference_lsts."""
+    return [_profile_user(scores) for scores in product(*(sorted(set(values.values()) | {default})
+                                                          for values, default in PREFERENCE_SCORES))]
+
+
+def _profile_user(scores: tuple[int, ...]) -> User:
+    """Return a user whose preference_lst is the given scores."""
+    preferences = []
+    for score, (values, default) in zip(scores, PREFERENCE_SCORES):
+        preferences.append(next((value for value in values if values[value] == score), '')
+                           if score != default else '')
+    return User('', *preferences)
+
+
+def similarity_keys(preference_matrix: np.ndarray, program_user: User) -> np.ndarray:
+    """Return an array where the i-th value is the ranking key of the user whose preference_lst is
+    row i of preference_matrix.
+
+    Sorting the keys in increasing order ranks users by how many preferences they share with program_user,
+    then by the total difference between their preferences, and then by row.
+    """
+    differences = np.abs(preference_matrix - np.array(program_user.preference_lst(), dtype=np.int8))
+    num_zeroes = np.count_nonzero(differences == 0, axis=1)
+    sum_of_list = differences.sum(axis=1, dtype=np.int64)
+
+    # Every sum_of_list is below 16, so this key orders by (num_zeroes, sum_of_list) descending,
+    # and adding the row number keeps the keys unique so that ties stay in row order.
+    num_users = len(preference_matrix)
+    return -(num_zeroes * 16 + sum_of_list) * num_users + np.arange(num_users)
+
+
+def top_ranked(keys: np.ndarray, limit: Optional[int] = None) -> np.ndarray:
+    """Return the indices of the limit smallest keys, sorted by key.
+
+    If limit is None, return the indices of all the keys.
+
+    Preconditions:
+    - limit is None or limit >= 0
+    - all keys are distinct
+    """
+    if limit is None or limit >= len(keys):
+        return np.argsort(keys)
+    elif limit == 0:
+        return np.arange(0)
+
+    top = np.argpartition(keys, limit - 1)[:limit]
+    return top[np.argsort(keys[top])]
+
+
+def _offsets(lengths: list[int]) -> np.ndarray:
+    """Return the compressed sparse row offsets of rows with the given lengths.
+
+    Row i is stored at positions offsets[i] to offsets[i + 1] - 1.
+    """
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
 
 
 if __name__ == '__main__':
     import python_ta
 
     python_ta.check_all(config={
-        'extra-imports': ['networkx'],  # the names (strs) of imported modules
+        # the names (strs) of imported modules
+        'extra-imports': ['sys', 'networkx', 'numpy', 'instrumentation', 'graph_snapshot'],
         'allowed-io': [],  # the names (strs) of functions that call print/open/input
         'max-line-length': 120,
         'max-nested-blocks': 4,
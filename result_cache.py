@@ -0,0 +1,212 @@
+"""Caching recommendations and distances for repeated requests"""
+from __future__ import annotations
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Collection, Hashable, Optional, Union
+from computation_compiling import get_distance
+from geospatial import FSATable, PostalGeocoder
+from recommender_data import User
+
+
+class ResultCache:
+    """A bounded cache that evicts the least recently used result, and results older than a time to live.
+
+    Instance Attributes:
+        - maxsize: the most results kept at once
+        - ttl: the number of seconds a result is kept, or None to keep results until they are evicted
+        - hits: the number of lookups that found a result
+        - misses: the number of lookups that did not find a result
+        - evictions: the number of results removed to make room for another
+        - expirations: the number of results removed because they were older than ttl
+
+    Representation Invariants:
+        - self.maxsize >= 1
+        - self.ttl is None or self.ttl > 0
+    """
+    maxsize: int
+    ttl: Optional[float]
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+
+    # Private Instance Attributes:
+    #     - _results:
+    #         Maps each key to the time it was stored and its result, from least to most recently used.
+    #     - _clock:
+    #         Returns the current time in seconds.
+    _results: OrderedDict[Hashable, tuple[float, Any]]
+    _clock: Callable[[], float]
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        """Initialize an empty cache.
+
+        Preconditions:
+        - maxsize >= 1
+        - ttl is None or ttl > 0
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._results = OrderedDict()
+        self._clock = clock
+
+    def __len__(self) -> int:
+        """Return the number of results in this cache, including any that have expired but not been removed."""
+        return len(self._results)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """Return the result stored for key, or store and return compute() if there is none."""
+        now = self._clock()
+        if key in self._results:
+            stored_at, result = self._results[key]
+            if self.ttl is None or now - stored_at < self.ttl:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return result
+            del self._results[key]
+            self.expirations += 1
+
+        self.misses += 1
+        result = compute()
+        self._results[key] = (now, result)
+        if len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+            self.evictions += 1
+        return result
+
+    def clear(self) -> None:
+        """Remove every result from this cache, keeping its counters."""
+        self._results.clear()
+
+    def stats(self) -> dict[str, int]:
+        """Return the counters of this cache and its current size."""
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations, 'size': len(self._results)}
+
+
+class CachedRecommender:
+    """Recommendations from a review graph and distances from an FSA table or postal code geocoder, with
+    repeated requests answered from a ResultCache.
+
+    Requests are keyed by the user's preference_lst, the user's location and the other arguments, where the
+    location is the longest prefix of the user's postal code in the geocoder, or its FSA in an FSA table. Two
+    users with the same preferences at the same location share a result. Every result, distances included, is
+    dropped once the graph's version changes, that is, once a vertex or edge is added to it.
+
+    Instance Attributes:
+        - graph: the WeightedGraph, CSRWeightedGraph or CollaborativeRecommender recommendations come from
+        - fsa_table: the FSATable or PostalGeocoder that locates postal codes
+        - restaurants: maps each restaurant_id to the restaurant, as returned by load_review_graph
+        - recommendation_cache: the cache of recommend results
+        - distance_cache: the cache of distances results
+        - invalidations: the number of times both caches were cleared because the graph changed
+    """
+    graph: Any
+    fsa_table: Union[FSATable, PostalGeocoder]
+    restaurants: dict
+    recommendation_cache: ResultCache
+    distance_cache: ResultCache
+    invalidations: int
+
+    # Private Instance Attributes:
+    #     - _version:
+    #         The version of the graph the cached results were computed from.
+    _version: int
+
+    def __init__(self, graph: Any, fsa_table: Union[FSATable, PostalGeocoder], restaurants: dict, maxsize: int = 1024,
+                 ttl: Optional[float] = None) -> None:
+        """Initialize a new recommender with empty caches of the given size and time to live.
+
+        Preconditions:
+        - maxsize >= 1
+        - ttl is None or ttl > 0
+        """
+        self.graph = graph
+        self.fsa_table = fsa_table
+        self.restaurants = restaurants
+        self.recommendation_cache = ResultCache(maxsize, ttl)
+        self.distance_cache = ResultCache(maxsize, ttl)
+        self.invalidations = 0
+        self._version = graph.version
+
+    def distances(self, user_postal_code: str) -> dict[str, float]:
+        """Return get_distance(user_postal_code, self.fsa_table, self.restaurants).
+
+        The returned dictionary is shared with later calls, and must not be changed.
+
+        Raise a KeyError if fsa_table does not locate user_postal_code.
+        """
+        self._check_version()
+        location = self.location(user_postal_code)
+        return self.distance_cache.get_or_compute(location,
+                                                  lambda: get_distance(location, self.fsa_table, self.restaurants))
+
+    def location(self, user_postal_code: str) -> str:
+        """Return the location results for user_postal_code are cached by: the longest prefix of it in
+        fsa_table if it is a PostalGeocoder, or its FSA if it is an FSATable.
+
+        Raise a KeyError if fsa_table does not locate user_postal_code.
+        """
+        if isinstance(self.fsa_table, PostalGeocoder):
+            return self.fsa_table.match(user_postal_code)
+        fsa = user_postal_code[:3].upper()
+        if fsa not in self.fsa_table:
+            raise KeyError(user_postal_code)
+        return fsa
+
+    def recommend(self, program_user: User, user_postal_code: str, limit: int, max_users: Optional[int] = None,
+                  max_distance: Optional[float] = None, include_cuisines: Optional[Collection[str]] = None,
+                  exclude_cuisines: Optional[Collection[str]] = None) -> (
+            dict[str, tuple[float, float, tuple[str, ...]]]):
+        """Return the graph's recommend_restaurants for program_user, with the distances from the user's postal
+        code and the given cuisine filters.
+
+        Raise a KeyError if fsa_table does not locate user_postal_code.
+
+        Preconditions:
+        - limit >= 1
+        - max_users is None or max_users >= 0
+        - max_distance is None or max_distance >= 0
+        """
+        self._check_version()
+        location = self.location(user_postal_code)
+        include = None if include_cuisines is None else tuple(sorted(set(include_cuisines)))
+        exclude = None if exclude_cuisines is None else tuple(sorted(set(exclude_cuisines)))
+        key = (tuple(program_user.preference_lst()), location, limit, max_users, max_distance, include, exclude)
+        result = self.recommendation_cache.get_or_compute(
+            key, lambda: self.graph.recommend_restaurants(program_user, limit, {}, self.distances(location),
+                                                          max_users, max_distance, include, exclude))
+        return dict(result)
+
+    def stats(self) -> dict[str, Any]:
+        """Return the counters of both caches and the number of invalidations."""
+        return {'recommendations': self.recommendation_cache.stats(), 'distances': self.distance_cache.stats(),
+                'invalidations': self.invalidations}
+
+    def _check_version(self) -> None:
+        """Clear both caches if the graph's version changed since the cached results were computed.
+
+        Distances are cleared too, since a restaurant added to the graph, or to restaurants, is missing from
+        the ones already cached.
+        """
+        if self.graph.version != self._version:
+            self.recommendation_cache.clear()
+            self.distance_cache.clear()
+            self.invalidations += 1
+            self._version = self.graph.version
+
+
+if __name__ == '__main__':
+    import python_ta
+
+    python_ta.check_all(config={
+        'extra-imports': ['time', 'collections', 'computation_compiling', 'geospatial', 'recommender_data'],
+        'allowed-io': [],  # the names (strs) of functions that call print/open/input
+        'max-line-length': 120,
+        'max-nested-blocks': 4,
+        'disable': ['E1136', 'W0221']})
@@ -0,0 +1,45 @@
+"""RUN THIS FILE TO BENCHMARK THE RECOMMENDER
+
+For example, to time every stage on synthetic data sets of 10^3 to 10^5 reviews, save the results, and
+compare a later run against them:
+
+    python run_benchmarks.py --edges 1000 10000 100000 --save baseline.json
+    python run_benchmarks.py --edges 1000 10000 100000 --compare baseline.json
+
+The exit status is 1 if any stage regressed against the baseline, or if a module used for scoring takes longer
+than its budget to import (see benchmarks.IMPORT_BUDGETS).
+"""
+
+import argparse
+import sys
+from benchmarks import check_import_budgets, compare_results, format_results, load_results, run_benchmarks, \
+    save_results
+from csr_graph import CSRWeightedGraph
+from recommender_data import WeightedGraph
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the recommender on synthetic data sets.')
+    parser.add_argument('--edges', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='the number of reviews of each data set')
+    parser.add_argument('--graph', choices=['weighted', 'csr'], default='weighted', help='the graph class to use')
+    parser.add_argument('--queries', type=int, default=200, help='the number of requests timed for each stage')
+    parser.add_argument('--loads', type=int, default=3, help='the number of times each graph is loaded')
+    parser.add_argument('--data', default='benchmark_data', help='the directory the data sets are kept in')
+    parser.add_argument('--save', help='save the results as a baseline at this path')
+    parser.add_argument('--compare', help='compare the results against the baseline at this path')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='the slowdown allowed before a regression')
+    arguments = parser.parse_args()
+
+    graph_type = CSRWeightedGraph if arguments.graph == 'csr' else WeightedGraph
+    runs = [run_benchmarks(num_edges, arguments.data, arguments.queries, arguments.loads, graph_type)
+            for num_edges in arguments.edges]
+    print(format_results(runs))
+
+    if arguments.save:
+        save_results(runs, arguments.save)
+
+    regressions = check_import_budgets()
+    if arguments.compare:
+        regressions.extend(compare_results(runs, load_results(arguments.compare), arguments.tolerance))
+    print('\n'.join(regressions) if regressions else 'No regressions.')
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,8 @@
+"""RUN THIS FILE TO START THE RECOMMENDATION SERVICE"""
+
+import asyncio
+from recommendation_service import RecommendationService, serve
+
+if __name__ == "__main__":
+    # Answers requests on http://127.0.0.1:8080 until stopped; see recommendation_service for the endpoints.
+    asyncio.run(serve(RecommendationService(), '127.0.0.1', 8080))
@@ -0,0 +1,152 @@
+"""Generating synthetic data sets in the format of the files in Data Files
+
+A data set with a given number of reviews is written as the same five csv files, so it can be loaded by
+load_review_graph and the other loaders exactly like the real data. Users review about as many restaurants
+as in the real data, every user reviews a restaurant at most once, and the same seed always gives the same
+files.
+"""
+from __future__ import annotations
+import os
+from typing import Iterable, TextIO
+import numpy as np
+
+RATING_FILE = 'rating_final_edited.csv'
+USER_FILE = 'userprofile_new.csv'
+RESTAURANT_FILE = 'restaurant_data.csv'
+CUISINE_FILE = 'restaurant_cuisine.csv'
+GEOSPATIAL_FILE = 'Geospatial_Coordinates.csv'
+
+# The values of each user attribute, in the order of USER_ATTRIBUTES, as they appear in the real data.
+USER_VALUES = (
+    ('Non-smoker', 'Smoker'),
+    ('non-drinker', 'casual drinker', 'heavy drinker'),
+    ('informal', 'smart casual', 'formal'),
+    ('solitary', 'friends', 'family'),
+    ('low', 'medium', 'high')
+)
+
+CUISINES = ('Mexican', 'Bar', 'Cafeteria', 'Fast_Food', 'Seafood', 'Bar_Pub_Brewery', 'Pizzeria', 'Chinese',
+            'American', 'International', 'Contemporary', 'Burgers', 'Japanese', 'Italian', 'Family',
+            'Cafe-Coffee_Shop', 'Breakfast-Brunch', 'Game', 'Vietnamese', 'Bakery', 'Mediterranean', 'Regional',
+            'Steaks', 'Sushi')
+
+# The number of reviews of each user in the real data is about this, on average.
+REVIEWS_PER_USER = 8
+
+# The number of rows written to a file at once.
+CHUNK_SIZE = 100000
+
+
+def generate_dataset(directory: str, num_edges: int, seed: int = 0) -> dict[str, str]:
+    """Write a synthetic data set with about num_edges reviews to directory, and return its dataset_paths.
+
+    The rating file is written last, under a temporary name that is replaced once it is complete, so a data
+    set whose rating file exists is complete.
+
+    Preconditions:
+    - num_edges >= 1
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    num_users = max(1, num_edges // REVIEWS_PER_USER)
+    num_restaurants = max(10, num_edges // 50)
+    num_fsas = max(100, num_restaurants // 20)
+
+    paths = dataset_paths(directory)
+
+    fsas = _fsas(num_fsas)
+    num_fsas = len(fsas)
+    with open(paths['geospatial'], 'w') as file:
+        latitudes = rng.uniform(43.58, 43.86, num_fsas)
+        longitudes = rng.uniform(-79.64, -79.12, num_fsas)
+        _write_rows(file, (f'{fsa},{lat:.7f},{lon:.7f}' for fsa, lat, lon in zip(fsas, latitudes, longitudes)))
+
+    with open(paths['user'], 'w') as file:
+        for start in range(0, num_users, CHUNK_SIZE):
+            end = min(start + CHUNK_SIZE, num_users)
+            columns = [np.array(values)[rng.integers(0, len(values), end - start)] for values in USER_VALUES]
+            _write_rows(file, (f'U{i + 1},' + ','.join(row) for i, row in zip(range(start, end), zip(*columns))))
+
+    with open(paths['restaurant'], 'w') as restaurant_file, open(paths['cuisine'], 'w') as cuisine_file:
+        for start in range(0, num_restaurants, CHUNK_SIZE):
+            end = min(start + CHUNK_SIZE, num_restaurants)
+            postal_codes = np.array(fsas)[rng.integers(0, num_fsas, end - start)]
+            _write_rows(restaurant_file, (f'{100000 + i},Restaurant {i},{postal_code}'
+                                          for i, postal_code in zip(range(start, end), postal_codes)))
+            num_cuisines = rng.integers(0, 4, end - start)
+            cuisines = np.array(CUISINES)[rng.integers(0, len(CUISINES), int(num_cuisines.sum()))]
+            restaurant_ids = np.repeat(np.arange(start, end), num_cuisines)
+            _write_rows(cuisine_file, (f'{100000 + i},{cuisine}' for i, cuisine in zip(restaurant_ids, cuisines)))
+
+    # Each user reviews the restaurants start, start + step, start + 2 * step, ... (modulo the number of
+    # restaurants), which are all different because degree * step <= num_restaurants.
+    with open(paths['rating'] + '.tmp', 'w') as file:
+        written = 0
+        for start in range(0, num_users, CHUNK_SIZE):
+            end = min(start + CHUNK_SIZE, num_users)
+            remaining = num_edges - written
+            degrees = _degrees(rng, end - start, remaining if end == num_users else (end - start) * REVIEWS_PER_USER,
+                               num_restaurants)
+            users = np.repeat(np.arange(start, end), degrees)
+            firsts = np.repeat(rng.integers(0, num_restaurants, end - start), degrees)
+            steps = np.repeat(rng.integers(1, num_restaurants // np.maximum(degrees, 1) + 1), degrees)
+            within = np.arange(len(users)) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+            restaurants = (firsts + within * steps) % num_restaurants
+            ratings = rng.choice(6, len(users), p=[0.06, 0.1, 0.16, 0.16, 0.28, 0.24])
+            _write_rows(file, (f'U{u + 1},{100000 + r},{rating}'
+                               for u, r, rating in zip(users.tolist(), restaurants.tolist(), ratings.tolist())))
+            written += len(users)
+
+    os.replace(paths['rating'] + '.tmp', paths['rating'])
+    return paths
+
+
+def dataset_paths(directory: str) -> dict[str, str]:
+    """Return a dictionary mapping the role of each file of a data set in directory ('rating', 'user',
+    'restaurant', 'cuisine' and 'geospatial') to its path.
+    """
+    return {role: os.path.join(directory, name) for role, name in
+            [('rating', RATING_FILE), ('user', USER_FILE), ('restaurant', RESTAURANT_FILE),
+             ('cuisine', CUISINE_FILE), ('geospatial', GEOSPATIAL_FILE)]}
+
+
+def _degrees(rng: np.random.Generator, num_users: int, num_edges: int, num_restaurants: int) -> np.ndarray:
+    """Return the number of reviews of each of num_users users, adding up to num_edges where possible.
+
+    Every user reviews at least one and at most num_restaurants restaurants.
+    """
+    degrees = rng.poisson(max(num_edges / num_users - 1, 0), num_users) + 1
+    degrees = np.minimum(degrees, num_restaurants)
+    difference = num_edges - int(degrees.sum())
+    if difference != 0:
+        # Spread the difference over the first users with room for it.
+        room = num_restaurants - degrees if difference > 0 else degrees - 1
+        change = np.minimum(room, abs(difference) // num_users + 1)
+        change[np.cumsum(change) > abs(difference)] = 0
+        degrees += int(np.sign(difference)) * change
+    return degrees
+
+
+def _fsas(num_fsas: int) -> list[str]:
+    """Return up to num_fsas different forward sortation areas, in the form letter, digit, letter, starting
+    with the Toronto ones.
+    """
+    letters = 'MLKNPHABCEGJRSTVXYZ'
+    return [first + digit + last for first in letters for digit in '0123456789' for last in letters][:num_fsas]
+
+
+def _write_rows(file: TextIO, rows: Iterable[str]) -> None:
+    """Write each row to file, followed by a new line."""
+    for row in rows:
+        file.write(row + '\n')
+
+
+if __name__ == '__main__':
+    import python_ta
+
+    python_ta.check_all(config={
+        'extra-imports': ['os', 'numpy'],  # the names (strs) of imported modules
+        'allowed-io': ['generate_dataset'],  # the names (strs) of functions that call print/open/input
+        'max-line-length': 120,
+        'max-nested-blocks': 4,
+        'disable': ['E1136', 'W0221']})
@@ -20,11 +20,17 @@ please consult our Course Syllabus.
 
 This file is Copyright (c) 2024 CSC111 Teaching Team
 """
-import networkx as nx
-from plotly.graph_objs import Scatter, Figure
-
+from __future__ import annotations
+import hashlib
+import json
+import os
+from collections import deque
+from typing import Any, Optional
+import numpy as np
 import recommender_data
 
+# networkx and plotly are imported by the functions that use them, so importing this module is cheap.
+
 # Colours to use when visualizing different clusters.
 COLOUR_SCHEME = [
     '#2E91E5', '#E15F99', '#1CA71C', '#FB0D0D', '#DA16FF', '#222A2A', '#B68100',
@@ -48,6 +54,8 @@ def setup_graph(graph: recommender_data.Graph,
     Optional arguments:
         - weighted: True when weight data should be visualized
     """
+    import networkx as nx
+    from plotly.graph_objs import Scatter
 
     graph_nx = graph.to_networkx(max_vertices)
 
@@ -61,7 +69,7 @@ def setup_graph(graph: recommender_data.Graph,
 
     kinds = [graph_nx.nodes[k]['kind'] for k in graph_nx.nodes]
 
-    colours = [BOOK_COLOUR if kind == 'book' else USER_COLOUR for kind in kinds]
+    colours = [USER_COLOUR if kind == 'user' else BOOK_COLOUR for kind in kinds]
 
     x_edges = []
     y_edges = []
@@ -146,6 +154,7 @@ def draw_graph(data: list, output_file: str = '', weight_positions=None) -> None
             in your web browser)
         - weight_positions: weights to draw on edges for a weighted graph
     """
+    from plotly.graph_objs import Figure
 
     fig = Figure(data=data)
     fig.update_layout({'showlegend': False})
@@ -153,15 +162,287 @@ def draw_graph(data: list, output_file: str = '', weight_positions=None) -> None
     fig.update_yaxes(showgrid=False, zeroline=False, visible=False)
 
     if weight_positions:
-        for w in weight_positions:
-            fig.add_annotation(
-                x=w[0], y=w[1],  # Text annotation position
-                xref="x", yref="y",  # Coordinate reference system
-                text=w[2],  # Text content
-                showarrow=False  # Hide arrow
-            )
+        # One text trace for every weight, rather than one annotation per edge.
+        x_weights, y_weights, texts = zip(*weight_positions)
+        fig.add_trace(_weight_trace(x_weights, y_weights, texts))
 
     if output_file == '':
         fig.show()
     else:
         fig.write_image(output_file)
+
+
+class VisualGraph:
+    """A small graph to draw, sampled or aggregated from a review graph.
+
+    Instance Attributes:
+        - labels: the label of each vertex
+        - kinds: the kind of each vertex, 'user', 'restaurant' or 'cluster'
+        - sizes: the marker size of each vertex
+        - sources, targets, weights: edge i is between vertices sources[i] and targets[i], with weight weights[i]
+
+    Representation Invariants:
+        - len(self.labels) == len(self.kinds) == len(self.sizes)
+        - len(self.sources) == len(self.targets) == len(self.weights)
+    """
+    labels: list[str]
+    kinds: list[str]
+    sizes: list[float]
+    sources: np.ndarray
+    targets: np.ndarray
+    weights: np.ndarray
+
+    def __init__(self, labels: list[str], kinds: list[str], sizes: list[float], sources: np.ndarray,
+                 targets: np.ndarray, weights: np.ndarray) -> None:
+        """Initialize a new graph with the given vertices and edges."""
+        self.labels = labels
+        self.kinds = kinds
+        self.sizes = sizes
+        self.sources = sources
+        self.targets = targets
+        self.weights = weights
+
+    def cache_key(self, layout: str) -> str:
+        """Return a name for the positions of this graph's vertices under the given layout, which changes
+        whenever the vertices or edges do.
+        """
+        contents = json.dumps([layout, self.labels, self.sources.tolist(), self.targets.tolist(),
+                               self.weights.tolist()])
+        return hashlib.sha1(contents.encode('utf-8')).hexdigest()
+
+
+def ego_network(graph: Any, item_id: str, radius: int = 2, max_vertices: int = 300) -> VisualGraph:
+    """Return the part of graph within radius edges of the user or restaurant with the given id, with at
+    most max_vertices vertices, closest vertices first.
+
+    graph is a WeightedGraph or CSRWeightedGraph. Only the neighbours of the vertices that are reached are
+    read, so the time taken depends on their number of reviews rather than on the size of the graph (apart
+    from the id lookups a CSRWeightedGraph builds on first use). The neighbours of each vertex are visited in
+    order of id, so the same graph always gives the same sample.
+
+    Raise a ValueError if no user or restaurant has the given id.
+
+    Preconditions:
+    - radius >= 0
+    - max_vertices >= 1
+    """
+    try:
+        start = graph.get_user(item_id)
+    except ValueError:
+        start = graph.get_restaurant(item_id)
+
+    positions = {_item_key(start): 0}
+    items, neighbours = [start], {}
+    queue = deque([(start, 0)])
+    while queue and len(positions) < max_vertices:
+        item, distance = queue.popleft()
+        if distance == radius:
+            continue
+        neighbours[_item_key(item)] = sorted(graph.get_neighbours(item), key=_item_key)
+        for neighbour in neighbours[_item_key(item)]:
+            if _item_key(neighbour) not in positions and len(positions) < max_vertices:
+                positions[_item_key(neighbour)] = len(positions)
+                items.append(neighbour)
+                queue.append((neighbour, distance + 1))
+
+    sources, targets, weights = [], [], []
+    for position, item in enumerate(items):
+        if isinstance(item, recommender_data.User):
+            if _item_key(item) not in neighbours:
+                neighbours[_item_key(item)] = sorted(graph.get_neighbours(item), key=_item_key)
+            for restaurant in neighbours[_item_key(item)]:
+                if _item_key(restaurant) in positions:
+                    sources.append(position)
+                    targets.append(positions[_item_key(restaurant)])
+                    weights.append(graph.get_weight(item, restaurant))
+
+    labels = [item.user_id if isinstance(item, recommender_data.User) else item.name for item in items]
+    kinds = ['user' if isinstance(item, recommender_data.User) else 'restaurant' for item in items]
+    sizes = [10.0 if position == 0 else 5.0 for position in range(len(items))]
+    return VisualGraph(labels, kinds, sizes, np.array(sources, dtype=np.int64), np.array(targets, dtype=np.int64),
+                       np.array(weights))
+
+
+def restaurant_clusters(graph: Any, by: str = 'cuisine', max_edges: int = 500) -> VisualGraph:
+    """Return a graph with one vertex for each cuisine or FSA, whose restaurants are grouped together.
+
+    A restaurant serving several cuisines is in the cluster of each. The edge between two clusters is
+    weighted by the number of users who reviewed restaurants in both, and only the max_edges heaviest edges
+    are kept. Each vertex is labelled with its number of restaurants and their average rating, and sized by
+    its number of reviews. The vectorized grouping takes time proportional to the number of reviews, and
+    the result has at most one vertex per cuisine or FSA however large graph is.
+
+    Preconditions:
+    - by in {'cuisine', 'fsa'}
+    - max_edges >= 0
+    """
+    arrays, strings = graph.to_columns()
+    num_restaurants = len(strings['restaurant_ids'])
+    if by == 'cuisine':
+        names = list(strings['cuisines'])
+        member_restaurants = np.repeat(np.arange(num_restaurants), np.diff(arrays['cuisine_offsets']))
+        member_clusters = np.asarray(arrays['cuisine_codes'], dtype=np.int64)
+    else:
+        fsa_codes = {}
+        for postal_code in strings['postal_codes']:
+            fsa_codes.setdefault(postal_code[:3].upper(), len(fsa_codes))
+        names = list(fsa_codes)
+        codes = np.array([fsa_codes[postal_code[:3].upper()] for postal_code in strings['postal_codes']],
+                         dtype=np.int64)
+        member_restaurants = np.arange(num_restaurants)
+        member_clusters = codes[np.asarray(arrays['restaurant_postal_codes'], dtype=np.int64)]
+    num_clusters = len(names)
+    if num_clusters == 0:
+        return VisualGraph([], [], [], np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64))
+
+    # The reviews of each restaurant, repeated once for each cluster it is in.
+    review_counts = np.diff(arrays['restaurant_offsets'])
+    rating_sums = np.bincount(np.repeat(np.arange(num_restaurants), review_counts),
+                              weights=arrays['restaurant_ratings'], minlength=num_restaurants)
+    cluster_restaurants = np.bincount(member_clusters, minlength=num_clusters)
+    cluster_reviews = np.bincount(member_clusters, weights=review_counts[member_restaurants], minlength=num_clusters)
+    cluster_sums = np.bincount(member_clusters, weights=rating_sums[member_restaurants], minlength=num_clusters)
+
+    # The distinct (user, cluster) pairs of every review, sorted by user, and then every pair of clusters
+    # that share a user, found k positions apart.
+    edge_users = np.repeat(np.arange(len(arrays['user_offsets']) - 1), np.diff(arrays['user_offsets']))
+    member_offsets = np.asarray(arrays['cuisine_offsets']) if by == 'cuisine' else np.arange(num_restaurants + 1)
+    edge_restaurants = np.asarray(arrays['user_neighbours'], dtype=np.int64)
+    memberships = np.diff(member_offsets)[edge_restaurants]
+    users = np.repeat(edge_users, memberships)
+    firsts = np.repeat(member_offsets[edge_restaurants], memberships)
+    clusters = member_clusters[firsts + np.arange(len(users)) - np.repeat(np.cumsum(memberships) - memberships,
+                                                                          memberships)]
+    pairs = np.unique(users * num_clusters + clusters)
+    users, clusters = pairs // num_clusters, pairs % num_clusters
+
+    shared = []
+    k = 1
+    while k < len(users):
+        same = users[k:] == users[:-k]
+        if not same.any():
+            break
+        shared.append(clusters[:-k][same] * num_clusters + clusters[k:][same])
+        k += 1
+    cluster_pairs, counts = np.unique(np.concatenate(shared or [np.zeros(0, np.int64)]), return_counts=True)
+    heaviest = np.argsort(-counts, kind='stable')[:max_edges]
+
+    averages = np.divide(cluster_sums, cluster_reviews, out=np.zeros(num_clusters), where=cluster_reviews > 0)
+    labels = [f'{name}: {n} restaurants, average rating {average:.2f}'
+              for name, n, average in zip(names, cluster_restaurants.tolist(), averages.tolist())]
+    sizes = (5 + 25 * np.sqrt(cluster_reviews / max(cluster_reviews.max(), 1))).tolist()
+    return VisualGraph(labels, ['cluster'] * num_clusters, sizes, cluster_pairs[heaviest] // num_clusters,
+                       cluster_pairs[heaviest] % num_clusters, counts[heaviest])
+
+
+def compute_layout(visual_graph: VisualGraph, layout: str = 'spring_layout',
+                   cache_dir: Optional[str] = None) -> np.ndarray:
+    """Return an array whose row i is the (x, y) position of vertex i of visual_graph under the given
+    networkx layout.
+
+    If cache_dir is not None, positions are saved there, and read back instead of being computed again
+    whenever the same graph is laid out with the same layout.
+    """
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, visual_graph.cache_key(layout) + '.npy')
+        if os.path.exists(path):
+            return np.load(path)
+
+    import networkx as nx
+
+    graph_nx = nx.Graph()
+    graph_nx.add_nodes_from(range(len(visual_graph.labels)))
+    graph_nx.add_weighted_edges_from(zip(visual_graph.sources.tolist(), visual_graph.targets.tolist(),
+                                         visual_graph.weights.tolist()))
+    arguments = {'seed': 0} if layout == 'spring_layout' else {}
+    positions_by_vertex = getattr(nx, layout)(graph_nx, **arguments)
+    positions = np.array([positions_by_vertex[i] for i in range(len(visual_graph.labels))],
+                         dtype=np.float64).reshape(-1, 2)
+
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(path, positions)
+    return positions
+
+
+def draw_visual_graph(visual_graph: VisualGraph, positions: np.ndarray, output_file: str = '',
+                      show_weights: bool = True) -> None:
+    """Draw visual_graph with its vertices at the given positions, as returned by compute_layout.
+
+    Edges, vertices and weights are each drawn as one trace, whatever the number of edges.
+
+    Optional arguments:
+        - output_file: a filename to save the plotly image to (rather than displaying
+            in your web browser)
+        - show_weights: whether to write the weight of each edge at its middle
+    """
+    from plotly.graph_objs import Figure, Scatter
+
+    starts, ends = positions[visual_graph.sources], positions[visual_graph.targets]
+    # Each edge is drawn from its start to its end, followed by a gap.
+    lines = np.full((len(starts), 3, 2), np.nan)
+    lines[:, 0], lines[:, 1] = starts, ends
+    lines = lines.reshape(-1, 2)
+
+    colours = [USER_COLOUR if kind == 'user' else BOOK_COLOUR if kind == 'restaurant' else COLOUR_SCHEME[i % 24]
+               for i, kind in enumerate(visual_graph.kinds)]
+    data = [Scatter(x=lines[:, 0], y=lines[:, 1], mode='lines', name='edges', hoverinfo='skip',
+                    line=dict(color=LINE_COLOUR, width=1)),
+            Scatter(x=positions[:, 0], y=positions[:, 1], mode='markers', name='nodes',
+                    marker=dict(symbol='circle-dot', size=visual_graph.sizes, color=colours,
+                                line=dict(color=VERTEX_BORDER_COLOUR, width=0.5)),
+                    text=visual_graph.labels, hovertemplate='%{text}', hoverlabel={'namelength': 0})]
+
+    if show_weights and len(starts) > 0:
+        middles = (starts + ends) / 2
+        data.append(_weight_trace(middles[:, 0], middles[:, 1], [str(w) for w in visual_graph.weights.tolist()]))
+
+    fig = Figure(data=data)
+    fig.update_layout({'showlegend': False})
+    fig.update_xaxes(showgrid=False, zeroline=False, visible=False)
+    fig.update_yaxes(showgrid=False, zeroline=False, visible=False)
+
+    if output_file == '':
+        fig.show()
+    else:
+        fig.write_image(output_file)
+
+
+def visualize_ego_network(graph: Any, item_id: str, radius: int = 2, max_vertices: int = 300,
+                          output_file: str = '', cache_dir: Optional[str] = None) -> None:
+    """Draw the part of graph around the user or restaurant with the given id (see ego_network).
+
+    Layouts are cached in cache_dir, if it is not None.
+    """
+    visual_graph = ego_network(graph, item_id, radius, max_vertices)
+    draw_visual_graph(visual_graph, compute_layout(visual_graph, cache_dir=cache_dir), output_file)
+
+
+def visualize_clusters(graph: Any, by: str = 'cuisine', max_edges: int = 500, output_file: str = '',
+                       cache_dir: Optional[str] = None) -> None:
+    """Draw the restaurants of graph grouped by cuisine or FSA (see restaurant_clusters).
+
+    Layouts are cached in cache_dir, if it is not None.
+
+    Preconditions:
+    - by in {'cuisine', 'fsa'}
+    """
+    visual_graph = restaurant_clusters(graph, by, max_edges)
+    draw_visual_graph(visual_graph, compute_layout(visual_graph, cache_dir=cache_dir), output_file)
+
+
+def _item_key(item: Any) -> tuple[str, str]:
+    """Return ('user', user_id) for a user, or ('restaurant', restaurant_id) for a restaurant."""
+    if isinstance(item, recommender_data.User):
+        return ('user', item.user_id)
+    else:
+        return ('restaurant', item.restaurant_id)
+
+
+def _weight_trace(x_values: Any, y_values: Any, texts: Any) -> Any:
+    """Return a single plotly trace writing each text at its position."""
+    from plotly.graph_objs import Scatter
+
+    return Scatter(x=x_values, y=y_values, mode='text', text=texts, name='weights', hoverinfo='skip',
+                   textfont=dict(size=9))